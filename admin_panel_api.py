@@ -5,6 +5,7 @@ import json
 import os
 from datetime import datetime
 import hashlib
+import stock_cursor
 
 app = Flask(__name__)
 app.secret_key = "change-this-secret-key-in-production"
@@ -67,25 +68,15 @@ def get_stock_file(pid, vid):
     return f"{DB_FOLDER}/stock_{pid}_{safe_vid}.txt"
 
 def get_stock_count(pid, vid):
-    filename = get_stock_file(pid, vid)
-    if not os.path.exists(filename):
-        return 0
-    with open(filename, 'r') as f:
-        lines = [l for l in f.readlines() if l.strip()]
-    return len(lines)
+    return len(get_stock_lines(pid, vid))
 
 def get_stock_lines(pid, vid):
-    filename = get_stock_file(pid, vid)
-    if not os.path.exists(filename):
-        return []
-    with open(filename, 'r') as f:
-        return [l.strip() for l in f.readlines() if l.strip()]
+    """Unsold items (the bot keeps its sold-offset in <stock file>.pos)"""
+    return stock_cursor.read_lines(get_stock_file(pid, vid))
 
 def save_stock_lines(pid, vid, lines):
-    filename = get_stock_file(pid, vid)
-    with open(filename, 'w') as f:
-        for line in lines:
-            f.write(f"{line}\n")
+    # Replaced together with a fresh .pos, under the lock the bot sells under
+    stock_cursor.replace_lines(get_stock_file(pid, vid), lines)
 
 def get_dashboard_stats():
     products = load_products()
@@ -199,9 +190,7 @@ def api_products():
         if pid not in products:
             return jsonify({'error': 'Product not found'}), 404
         for vid in products[pid].get('variants', {}).keys():
-            filename = get_stock_file(pid, vid)
-            if os.path.exists(filename):
-                os.remove(filename)
+            stock_cursor.remove(get_stock_file(pid, vid))
         del products[pid]
         save_products(products)
         return jsonify({'success': True})
@@ -247,9 +236,7 @@ def api_variants():
         vid = data.get('variant_id')
         if pid not in products or vid not in products[pid].get('variants', {}):
             return jsonify({'error': 'Variant not found'}), 404
-        filename = get_stock_file(pid, vid)
-        if os.path.exists(filename):
-            os.remove(filename)
+        stock_cursor.remove(get_stock_file(pid, vid))
         del products[pid]['variants'][vid]
         save_products(products)
         return jsonify({'success': True})
@@ -288,15 +275,14 @@ def api_stock(pid, vid):
         if not stock_text:
             return jsonify({'error': 'No stock provided'}), 400
         new_lines = [line.strip() for line in stock_text.split('\n') if line.strip()]
-        existing_lines = get_stock_lines(pid, vid)
-        all_lines = existing_lines + new_lines
-        save_stock_lines(pid, vid, all_lines)
+        # Held across read and rewrite so a sale in between is not undone
+        with stock_cursor.stock_lock(get_stock_file(pid, vid)):
+            all_lines = get_stock_lines(pid, vid) + new_lines
+            save_stock_lines(pid, vid, all_lines)
         return jsonify({'success': True, 'count': len(all_lines), 'added': len(new_lines)})
     
     elif request.method == 'DELETE':
-        filename = get_stock_file(pid, vid)
-        if os.path.exists(filename):
-            os.remove(filename)
+        stock_cursor.remove(get_stock_file(pid, vid))
         return jsonify({'success': True})
 
 @app.route('/users')
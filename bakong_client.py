@@ -0,0 +1,110 @@
+"""
+Bakong Proxy Client - pooled async HTTP client for BAKONG_PROXY_URL
+One keep-alive connection pool (HTTP/2 when the h2 package is installed) is
+shared by QR creation and payment checks, so each call reuses an open
+TLS connection to the Cambodia proxy instead of paying a new handshake.
+"""
+import asyncio
+import logging
+import time
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (enables httpx HTTP/2 support)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Worth another try: the proxy (or its upstream) was briefly unavailable
+RETRY_STATUS = (502, 503, 504)
+
+
+class BakongProxyClient:
+    """Async client for the bakong_proxy.py endpoints"""
+
+    FEATURES_TTL = 300.0
+
+    def __init__(self, base_url, timeout=15.0, connect_timeout=5.0, retries=2, backoff=0.5,
+                 max_connections=20, keepalive_expiry=60.0):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        self._client = None
+        # /health result, re-read every FEATURES_TTL seconds
+        self._features = None
+        self._features_at = 0.0
+
+    def _get_client(self):
+        # Created lazily so the pool belongs to the running event loop
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.base_url, http2=HTTP2_AVAILABLE,
+                                             timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    async def request(self, method, path, json=None, timeout=None, retries=None):
+        """Send a request and return the decoded JSON body
+
+        Connection errors, timeouts and 502/503/504 are retried up to
+        `retries` times with exponential backoff; anything else raises.
+        """
+        retries = self.retries if retries is None else retries
+        kwargs = {"json": json}
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        for attempt in range(retries + 1):
+            try:
+                resp = await self._get_client().request(method, path, **kwargs)
+                if resp.status_code in RETRY_STATUS and attempt < retries:
+                    logging.warning(f"[PROXY] {method} {path} -> {resp.status_code}, retrying ({attempt + 1}/{retries})")
+                else:
+                    resp.raise_for_status()
+                    return resp.json()
+            except httpx.TransportError as e:
+                if attempt >= retries:
+                    raise
+                logging.warning(f"[PROXY] {method} {path} failed: {e!r}, retrying ({attempt + 1}/{retries})")
+            await asyncio.sleep(self.backoff * (2 ** attempt))
+
+    async def create_qr(self, payload, timeout=None):
+        """POST /create_qr -> {"qr_code": ..., "md5": ...}"""
+        return await self.request("POST", "/create_qr", json=payload, timeout=timeout)
+
+    async def check(self, md5, timeout=None):
+        """GET /check/<md5> -> Bakong check_payment result"""
+        return await self.request("GET", f"/check/{md5}", timeout=timeout)
+
+    async def check_batch(self, md5_list, timeout=None):
+        """POST /check_batch -> {md5: status} ("PAID", "UNPAID" or None on error)"""
+        data = await self.request("POST", "/check_batch", json={"md5_list": list(md5_list)}, timeout=timeout)
+        return data.get("results", {})
+
+    async def features(self):
+        """What the proxy advertises on /health: {"features": [...], "batch_max": n}"""
+        now = time.monotonic()
+        if self._features is None or now - self._features_at > self.FEATURES_TTL:
+            try:
+                health = await self.request("GET", "/health", retries=0)
+            except Exception as e:
+                logging.warning(f"[PROXY] Health check failed: {e!r}")
+                health = {}
+            self._features = {"features": set(health.get("features", [])),
+                              "batch_max": health.get("batch_max", 50)}
+            self._features_at = now
+        return self._features
+
+    async def supports(self, feature):
+        return feature in (await self.features())["features"]
+
+    def forget_features(self):
+        """Re-read /health on next use (e.g. after the proxy was redeployed)"""
+        self._features = None
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -4,7 +4,12 @@ Deploy this in Cambodia (VPS with Cambodia IP) to bypass IP restrictions
 """
 from flask import Flask, request, jsonify
 from bakong_khqr import KHQR
+from concurrent.futures import ThreadPoolExecutor, Future
 import os
+import json
+import time
+import sqlite3
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,6 +18,119 @@ app = Flask(__name__)
 BAKONG_TOKEN = os.getenv("BAKONG_TOKEN", "")
 khqr = KHQR(BAKONG_TOKEN)
 
+# /check_batch: max md5s per request, and threads for libraries without bulk checks
+BATCH_MAX = int(os.getenv("CHECK_BATCH_MAX", "500"))
+CHECK_WORKERS = int(os.getenv("CHECK_WORKERS", "8"))
+BULK_CHUNK = 50  # Bakong's limit for check_transaction_by_md5_list
+check_pool = ThreadPoolExecutor(max_workers=CHECK_WORKERS)
+
+# Paid results never change, so they are kept in SQLite (shared by all
+# gunicorn workers) and answered without calling Bakong again.
+CACHE_FILE = os.getenv("PAID_CACHE_FILE", "paid_cache.sqlite3")
+CACHE_MAX = int(os.getenv("PAID_CACHE_MAX", "50000"))
+UPSTREAM_TIMEOUT = 30  # seconds a coalesced check waits for the one in flight
+
+def is_terminal(result):
+    """True for results that can be cached forever (the QR was paid)"""
+    if isinstance(result, str):
+        return result.strip().upper() == "PAID"
+    if isinstance(result, dict):
+        return result.get('responseCode') == 0 or (result.get('data') or {}).get('responseCode') == 0
+    return False
+
+class PaidCache:
+    """SQLite store of terminal check results with LRU eviction"""
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._puts = 0
+        with self._conn() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS paid (md5 TEXT PRIMARY KEY, result TEXT, used REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS paid_used ON paid (used)")
+
+    def _conn(self):
+        # One connection per thread; WAL lets gunicorn workers read while one writes
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get_many(self, md5_list):
+        if not md5_list:
+            return {}
+        db = self._conn()
+        found = {}
+        for i in range(0, len(md5_list), 500):
+            chunk = md5_list[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for md5, result in db.execute(f"SELECT md5, result FROM paid WHERE md5 IN ({marks})", chunk):
+                found[md5] = json.loads(result)
+        if found:
+            with db:
+                db.executemany("UPDATE paid SET used = ? WHERE md5 = ?", [(time.time(), m) for m in found])
+        return found
+
+    def put_many(self, results):
+        if not results:
+            return
+        db = self._conn()
+        now = time.time()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO paid (md5, result, used) VALUES (?, ?, ?)",
+                           [(md5, json.dumps(result), now) for md5, result in results.items()])
+        self._puts += len(results)
+        if self._puts >= 100:
+            self._puts = 0
+            self.evict()
+
+    def evict(self):
+        """Drop least recently used entries beyond max_entries"""
+        db = self._conn()
+        with db:
+            db.execute("DELETE FROM paid WHERE md5 IN (SELECT md5 FROM paid ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                       (self.max_entries,))
+
+paid_cache = PaidCache(CACHE_FILE, CACHE_MAX)
+
+# md5 -> Future of the upstream check currently running for it (this process)
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def coalesced(md5_list, fetch):
+    """Run fetch(md5s) -> {md5: result} only for md5s nobody is checking yet;
+    md5s already in flight wait for that check's result instead"""
+    mine, theirs = {}, {}
+    with _inflight_lock:
+        for md5 in md5_list:
+            if md5 in _inflight:
+                theirs[md5] = _inflight[md5]
+            else:
+                mine[md5] = _inflight[md5] = Future()
+    results = {}
+    try:
+        if mine:
+            results = fetch(list(mine))
+            paid_cache.put_many({md5: r for md5, r in results.items() if is_terminal(r)})
+        for md5, fut in mine.items():
+            fut.set_result(results.get(md5))
+    except Exception as e:
+        for fut in mine.values():
+            if not fut.done():
+                fut.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            for md5 in mine:
+                _inflight.pop(md5, None)
+    for md5, fut in theirs.items():
+        results[md5] = fut.result(timeout=UPSTREAM_TIMEOUT)
+    return results
+
 @app.route('/create_qr', methods=['POST'])
 def create_qr():
     """Create KHQR QR code"""
@@ -21,6 +139,8 @@ def create_qr():
         amount = data.get('amount')
         bank_account = data.get('bank_account')
         merchant_name = data.get('merchant_name')
+        # Bots send an order-scoped bill number; old clients fall back to the amount
+        bill_number = data.get('bill_number') or f"INV-{int(amount*1000)}"
         
         qr_code = khqr.create_qr(
             bank_account=bank_account,
@@ -30,7 +150,7 @@ def create_qr():
             currency="USD",
             store_label="Store",
             phone_number="85512345678",
-            bill_number=f"INV-{int(amount*1000)}",
+            bill_number=bill_number,
             terminal_label="Bot01"
         )
         
@@ -51,7 +171,9 @@ def create_qr():
 def check_payment(md5):
     """Check payment status"""
     try:
-        result = khqr.check_payment(md5)
+        result = paid_cache.get_many([md5]).get(md5)
+        if result is None:
+            result = coalesced([md5], lambda md5s: {md5s[0]: khqr.check_payment(md5s[0])})[md5]
         return jsonify(result)
     except Exception as e:
         return jsonify({
@@ -59,12 +181,65 @@ def check_payment(md5):
             "status": "error"
         }), 500
 
+def fetch_one(md5):
+    try:
+        return khqr.check_payment(md5)
+    except Exception:
+        return None
+
+def fetch_many(md5_list):
+    """Ask Bakong about md5_list: {md5: "PAID" / "UNPAID" / None (check failed)}"""
+    results = {}
+    if hasattr(khqr, "check_bulk_payments"):
+        # One upstream call per 50 md5s
+        for i in range(0, len(md5_list), BULK_CHUNK):
+            chunk = md5_list[i:i + BULK_CHUNK]
+            try:
+                paid = set(khqr.check_bulk_payments(chunk))
+                results.update({md5: "PAID" if md5 in paid else "UNPAID" for md5 in chunk})
+            except Exception:
+                results.update(zip(chunk, check_pool.map(fetch_one, chunk)))
+        return results
+    # Older bakong_khqr: fan out single checks over a bounded pool
+    return dict(zip(md5_list, check_pool.map(fetch_one, md5_list)))
+
+def check_many(md5_list):
+    """Cached results first, then one coalesced upstream pass for the rest"""
+    results = paid_cache.get_many(md5_list)
+    missing = [md5 for md5 in md5_list if md5 not in results]
+    if missing:
+        results.update(coalesced(missing, fetch_many))
+    return results
+
+@app.route('/check_batch', methods=['POST'])
+def check_batch():
+    """Check many payments in one round trip: {"md5_list": [...]}"""
+    try:
+        md5_list = (request.json or {}).get('md5_list')
+        if not isinstance(md5_list, list) or not all(isinstance(m, str) for m in md5_list):
+            return jsonify({"error": "md5_list must be a list of strings", "status": "error"}), 400
+        if len(md5_list) > BATCH_MAX:
+            return jsonify({"error": f"At most {BATCH_MAX} md5s per request", "status": "error"}), 400
+        md5_list = list(dict.fromkeys(md5_list))
+        return jsonify({
+            "results": check_many(md5_list),
+            "status": "success"
+        })
+    except Exception as e:
+        return jsonify({
+            "error": str(e),
+            "status": "error"
+        }), 500
+
 @app.route('/health', methods=['GET'])
 def health():
-    """Health check endpoint"""
+    """Health check endpoint (also tells clients which extras are available)"""
     return jsonify({
         "status": "ok",
-        "service": "bakong-khqr-proxy"
+        "service": "bakong-khqr-proxy",
+        "features": ["check_batch", "paid_cache"],
+        "batch_max": BATCH_MAX,
+        "bulk_upstream": hasattr(khqr, "check_bulk_payments")
     })
 
 if __name__ == '__main__':
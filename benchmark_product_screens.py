@@ -0,0 +1,105 @@
+"""
+Benchmark - product list / product view rendering, uncached vs cached
+Builds a 500-product catalog in a scratch folder and times how long one tap
+on the list and on a product takes to render: the old way (rebuild text and
+keyboard every time) against render_product_list / render_product_view.
+
+    python benchmark_product_screens.py [products]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="storebot-bench-"))
+
+import storebot as sb  # noqa: E402  (needs BOT_TOKEN and the scratch cwd first)
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup  # noqa: E402
+
+PRODUCTS = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+ROUNDS = 200
+
+
+def build_catalog():
+    products = {}
+    for i in range(1, PRODUCTS + 1):
+        pid = str(i)
+        products[pid] = {"name": f"Product {i}", "desc": "Benchmark item", "sold": i,
+                         "variants": {f"{m}M": {"name": f"{m} Month", "price": 1.5 * m, "tutorial": None}
+                                      for m in (1, 3, 12)}}
+    sb.save_products(products)
+    for i in range(1, PRODUCTS + 1, 2):
+        sb.add_stock(str(i), "1M", f"user{i}@mail.com,pass")
+
+
+def old_list():
+    products = sb.load_products()
+    list_text = "╭ - - - - - - - - - - - - - - - - - - - ╮\n┊  **PRODUCT LIST**\n┊  _page 1 / 1_\n┊- - - - - - - - - - - - - - - - - - - - -\n"
+    keyboard = []; row = []
+    for pid in sorted(products.keys(), key=lambda x: int(x)):
+        list_text += f"┊ [{pid}] {products[pid]['name'].upper()}\n"
+        row.append(InlineKeyboardButton(f"{pid}", callback_data=f"view_{pid}"))
+        if len(row) == 4: keyboard.append(row); row = []
+    if row: keyboard.append(row)
+    list_text += "╰ - - - - - - - - - - - - - - - - - - - ╯"
+    return list_text, InlineKeyboardMarkup(keyboard)
+
+
+def old_view(pid):
+    products = sb.load_products()
+    prod = products[pid]
+    text = f"┊ • **Product:** {prod['name']}\n┊ • **Sold:** {prod['sold']} pcs\n┊ • **Desc:** {prod['desc']}\n"
+    keyboard = []
+    product_stock = sb.get_product_stock(pid, True)
+    for vid, var in prod['variants'].items():
+        status = "🟢" if product_stock.get(vid, 0) > 0 else "🔴"
+        text += f"┊ • {var['name']} (${var['price']:.2f}) - {status}\n"
+        keyboard.append([InlineKeyboardButton(f"{var['name']} - ${var['price']:.2f}", callback_data=f"confirm_{pid}_{vid}_1")])
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_list")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def timed(label, func, *args):
+    func(*args)  # warm up (fills the cache for the cached variants)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        func(*args)
+    per_call = (time.perf_counter() - start) / ROUNDS * 1000
+    print(f"{label:<32} {per_call:8.3f} ms/render")
+    return per_call
+
+
+def main():
+    print("=" * 60)
+    print(f"PRODUCT SCREEN BENCHMARK ({PRODUCTS} products, {ROUNDS} renders each)")
+    print("=" * 60)
+    build_catalog()
+
+    before = timed("list, rebuilt every tap", old_list)
+    after = timed("list, cached", sb.render_product_list)
+    print(f"{'':<32} {before / after:8.1f}x faster\n")
+
+    pid = str(PRODUCTS // 2 + 1)
+    before = timed("view, rebuilt every tap", old_view, pid)
+    after = timed("view, cached", sb.render_product_view, pid)
+    print(f"{'':<32} {before / after:8.1f}x faster\n")
+
+    # A catalog change must produce a fresh screen
+    screen = sb.render_product_list()
+    products = sb.load_products_for_update()
+    products["1"]["name"] = "Renamed"
+    sb.save_products(products)
+    ok = sb.render_product_list() is not screen and "RENAMED" in sb.render_product_list()[0]
+    print(f"{'✅' if ok else '❌'} list re-rendered after a catalog change")
+
+    view = sb.render_product_view(pid)
+    sb.add_stock(pid, "3M", "new@mail.com,pass")
+    ok = sb.render_product_view(pid) is not view
+    print(f"{'✅' if ok else '❌'} view re-rendered after a variant came back in stock")
+
+
+if __name__ == "__main__":
+    main()
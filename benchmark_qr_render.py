@@ -0,0 +1,96 @@
+"""
+Benchmark - KHQR card rendering, temp-file pipeline vs in-memory renderer
+Times the old create_styled_qr (re-open template, re-try the font, save a
+qr_card_XXXX.png, read it back, delete it) against qr_render.QRCardRenderer
+on the same payload. Uses ./template.png if present, otherwise a generated
+1080x1600 stand-in.
+
+    python benchmark_qr_render.py [renders]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+from khqr_payload import build_proxy_khqr, new_bill_number
+from qr_render import QRCardRenderer
+
+RENDERS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+
+def old_create_styled_qr(template_path, qr_data, amount):
+    """create_styled_qr as it was before qr_render.py, plus the read-back"""
+    card = Image.open(template_path).convert("RGBA")
+    W, H = card.size
+    qr = qrcode.QRCode(box_size=20, border=0)
+    qr.add_data(qr_data)
+    qr.make(fit=True)
+    qr_img = qr.make_image(fill_color="#107c42", back_color="white").convert("RGBA")
+    qr_target_size = int(W * 0.55)
+    qr_img = qr_img.resize((qr_target_size, qr_target_size), Image.LANCZOS)
+    pos_x = (W - qr_target_size) // 2; pos_y = (H - qr_target_size) // 2
+    card.paste(qr_img, (pos_x, pos_y))
+    draw = ImageDraw.Draw(card)
+    try: font = ImageFont.truetype("/system/fonts/Roboto-Bold.ttf", 60)
+    except: font = ImageFont.load_default()
+    text = f"${amount:.2f}"
+    bbox = draw.textbbox((0, 0), text, font=font)
+    text_x = (W - (bbox[2] - bbox[0])) // 2
+    text_y = pos_y + qr_target_size + 30
+    for off in [(-2,-2), (-2,2), (2,-2), (2,2)]:
+        draw.text((text_x+off[0], text_y+off[1]), text, font=font, fill="black")
+    draw.text((text_x, text_y), text, font=font, fill="white")
+    filename = f"qr_card_{random.randint(1000,9999)}.png"
+    card.save(filename)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    os.remove(filename)
+    return data
+
+
+def find_template(workdir):
+    here = os.path.join(os.path.dirname(os.path.abspath(__file__)), "template.png")
+    if os.path.exists(here):
+        return here, "template.png"
+    path = os.path.join(workdir, "template.png")
+    Image.new("RGBA", (1080, 1600), (16, 124, 66, 255)).save(path)
+    return path, "generated 1080x1600 stand-in"
+
+
+def timed(label, func):
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(RENDERS):
+        size = len(func())
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {RENDERS / elapsed:7.1f} renders/s  ({elapsed / RENDERS * 1000:6.1f} ms, {size // 1024} KB)")
+    return RENDERS / elapsed
+
+
+def main():
+    print("=" * 60)
+    print(f"QR CARD RENDER BENCHMARK ({RENDERS} renders each)")
+    print("=" * 60)
+    workdir = tempfile.mkdtemp(prefix="qr-bench-")
+    os.chdir(workdir)
+    template, source = find_template(workdir)
+    print(f"Template: {source}\n")
+
+    qr_data, _ = build_proxy_khqr("store_test@aclb", "Test Store", 12.5, bill_number=new_bill_number())
+    renderer = QRCardRenderer([template])
+
+    before = timed("temp file (old)", lambda: old_create_styled_qr(template, qr_data, 12.5))
+    after = timed("in memory (qr_render)", lambda: renderer.render(qr_data, 12.5))
+    print(f"\n{after / before:.1f}x renders per second")
+
+    leftovers = [f for f in os.listdir(workdir) if f.startswith("qr_")]
+    print(f"{'✅' if not leftovers else '❌'} no temp files left behind ({len(leftovers)})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Benchmark - webhook throughput, POSTing recorded updates at full speed
+Starts a WebhookServer in front of an offline Application (Bot API calls are
+answered locally, nothing reaches Telegram) whose handlers reply to every
+message and button tap through the ChatOrderedUpdateProcessor, then fires
+the updates at it over keep-alive connections the way Telegram does and
+reports requests/s, POST latency and end-to-end handled updates/s.
+
+Updates come from a JSONL file recorded with WEBHOOK_RECORD_FILE, or are
+generated (/start, product taps, text) when no file is given. Each one gets
+a fresh update_id so replays are not dropped as duplicates.
+
+    python benchmark_webhook.py [updates] [connections] [recorded.jsonl]
+"""
+
+import asyncio
+import json
+import random
+import sys
+import time
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, CallbackQueryHandler, MessageHandler, filters
+from telegram.request import BaseRequest
+
+from update_processor import ChatOrderedUpdateProcessor
+from webhook_server import WebhookServer, serve_webhook
+
+UPDATES = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+CONNECTIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+RECORDED = sys.argv[3] if len(sys.argv) > 3 else None
+SECRET = "benchmark-secret"
+PATH = "/webhook"
+
+
+class OfflineRequest(BaseRequest):
+    """Answers the Bot API locally, after a small fake network delay"""
+
+    def __init__(self, delay=0.005):
+        self.delay = delay
+        self.calls = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        if url.endswith("getMe"):
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif url.endswith("sendMessage"):
+            await asyncio.sleep(self.delay)
+            result = {"message_id": self.calls, "date": int(time.time()), "text": "ok",
+                      "chat": {"id": 1, "type": "private"}}
+        else:
+            await asyncio.sleep(self.delay)
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def generated_updates(count, users=500):
+    rnd = random.Random(1)
+    updates = []
+    for i in range(count):
+        uid = rnd.randrange(1, users + 1)
+        user = {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+        chat = {"id": uid, "type": "private"}
+        if rnd.random() < 0.5:
+            text = rnd.choice(["/start", "hello", "📦 Products", "/help"])
+            updates.append({"message": {"message_id": i, "date": int(time.time()), "chat": chat, "from": user, "text": text}})
+        else:
+            message = {"message_id": i, "date": int(time.time()), "chat": chat, "text": "menu"}
+            updates.append({"callback_query": {"id": str(i), "from": user, "chat_instance": str(uid),
+                                                "message": message, "data": f"view_{rnd.randrange(1, 50)}"}})
+    return updates
+
+
+def recorded_updates(path, count):
+    with open(path, 'r', encoding='utf-8') as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    return [dict(recorded[i % len(recorded)]) for i in range(count)]
+
+
+def build_app():
+    request = OfflineRequest()
+    app = ApplicationBuilder().token("1:bench").request(request).get_updates_request(OfflineRequest()) \
+        .concurrent_updates(ChatOrderedUpdateProcessor(16)).build()
+    app.handled = 0
+
+    async def on_message(update, context):
+        await context.bot.send_message(update.effective_chat.id, "ok")
+        app.handled += 1
+
+    async def on_button(update, context):
+        await update.callback_query.answer()
+        app.handled += 1
+
+    app.add_handler(MessageHandler(filters.ALL, on_message))
+    app.add_handler(CallbackQueryHandler(on_button))
+    return app
+
+
+async def post(reader, writer, path, body, secret=SECRET, method="POST"):
+    """One keep-alive HTTP request; returns (status, response body)"""
+    head = f"{method} {path} HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+    if secret:
+        head += f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+    writer.write(head.encode() + b"\r\n" + body)
+    await writer.drain()
+    status_line = await reader.readuntil(b"\r\n\r\n")
+    status = int(status_line.split(b" ", 2)[1])
+    length = int(status_line.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+    return status, await reader.readexactly(length)
+
+
+async def request(port, path, body=b"", secret=SECRET, method="POST"):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        return await post(reader, writer, path, body, secret, method)
+    finally:
+        writer.close()
+
+
+async def load(port, bodies):
+    """Send bodies over CONNECTIONS keep-alive connections; returns per-POST latencies"""
+    latencies, statuses = [], {}
+    queue = iter(bodies)
+
+    async def connection():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            for body in queue:
+                start = time.perf_counter()
+                status, _ = await post(reader, writer, PATH, body)
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(connection() for _ in range(CONNECTIONS)))
+    return latencies, statuses
+
+
+async def stalled(server, partial, read_timeout=0.2):
+    """Send part of a request and stop; the server must answer 408 and close within read_timeout"""
+    saved, server.read_timeout = server.read_timeout, read_timeout
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+    try:
+        writer.write(partial)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), read_timeout * 10)
+        return response.startswith(b"HTTP/1.1 408")
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        writer.close()
+        server.read_timeout = saved
+
+
+def check(ok, text):
+    print(f"{'✅' if ok else '❌'} {text}")
+    return ok
+
+
+async def main():
+    print("=" * 60)
+    print(f"WEBHOOK BENCHMARK ({UPDATES} updates, {CONNECTIONS} connections)")
+    print("=" * 60)
+    updates = recorded_updates(RECORDED, UPDATES) if RECORDED else generated_updates(UPDATES)
+    print(f"Updates: {RECORDED or 'generated'}\n")
+    bodies = [json.dumps(dict(u, update_id=i)).encode() for i, u in enumerate(updates, 1)]
+
+    app = build_app()
+    server = WebhookServer(app, PATH, SECRET, "127.0.0.1", 0)
+    stop = asyncio.Event()
+    runner = asyncio.create_task(serve_webhook(app, server, f"https://bench.local{PATH}", stop_event=stop))
+    while not app.running or server.started_at is None:
+        await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    latencies, statuses = await load(server.port, bodies)
+    posted = time.perf_counter() - start
+    while app.handled < UPDATES and time.perf_counter() - start < 120:
+        await asyncio.sleep(0.005)
+    handled = time.perf_counter() - start
+
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000  # noqa: E731
+    print(f"POSTs accepted     {UPDATES / posted:8.0f} req/s   ({posted:.2f}s)")
+    print(f"POST latency       p50 {p(0.5):.1f}ms  p99 {p(0.99):.1f}ms  max {latencies[-1] * 1000:.1f}ms")
+    print(f"Updates handled    {app.handled / handled:8.0f} upd/s   ({handled:.2f}s, replies through the fake API)\n")
+
+    passed = check(statuses == {200: UPDATES}, f"every POST answered 200 ({statuses})")
+    passed &= check(app.handled == UPDATES, f"every update handled ({app.handled}/{UPDATES})")
+
+    status, _ = await request(server.port, PATH, bodies[0], secret="wrong")
+    passed &= check(status == 403, f"wrong secret token rejected ({status})")
+    status, _ = await request(server.port, PATH, b"{not json")
+    passed &= check(status == 400, f"malformed body rejected ({status})")
+    status, _ = await request(server.port, PATH, bodies[-1])
+    passed &= check(status == 200 and server.stats["duplicates"] == 1, "redelivered update_id answered 200 and skipped")
+    status, _ = await request(server.port, PATH, b"x" * (server.max_body + 1))
+    passed &= check(status == 413, f"body over max_body rejected ({status})")
+    passed &= check(await stalled(server, b"POST " + PATH.encode() + b" HTTP/1.1\r\nContent-Length: 100\r\n\r\n{"),
+                    "client stalling mid-body gets 408 and is disconnected")
+    passed &= check(await stalled(server, b"POST " + PATH.encode() + b" HTTP/1.1\r\nHost: be"),
+                    "client stalling mid-headers gets 408 and is disconnected")
+    status, body = await request(server.port, "/health", method="GET", secret=None)
+    health = json.loads(body)
+    passed &= check(status == 200 and health["ok"] and health["received"] == UPDATES, f"/health: {health}")
+
+    stop.set()
+    await runner
+    passed &= check(not app.running, "clean shutdown")
+    print(f"\n{'✅ All checks passed' if passed else '❌ Some checks failed'}")
+    return passed
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if asyncio.run(main()) else 1)
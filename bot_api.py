@@ -10,6 +10,7 @@ import json
 import os
 import glob
 import hashlib
+import stock_cursor
 
 app = Flask(__name__)
 CORS(app)  # Allow cross-origin requests from Railway
@@ -109,6 +110,14 @@ def delete_product(product_id):
 
 # ==================== STOCK API ====================
 
+def read_stock_lines(stock_file):
+    """Unsold lines of a stock file (the bot keeps a sold-offset in <file>.pos)"""
+    return stock_cursor.read_lines(stock_file)
+
+def remove_stock_file(stock_file):
+    stock_cursor.remove(stock_file)
+
+
 @app.route('/api/stock', methods=['GET'])
 def get_all_stock():
     """Get stock summary for all products"""
@@ -121,10 +130,7 @@ def get_all_stock():
     for pid, product in products.items():
         for vid, variant in product.get('variants', {}).items():
             stock_file = os.path.join(DB_DIR, f'stock_{pid}_{vid}.txt')
-            count = 0
-            if os.path.exists(stock_file):
-                with open(stock_file, 'r', encoding='utf-8') as f:
-                    count = len([line for line in f if line.strip()])
+            count = len(read_stock_lines(stock_file))
             
             stock_data.append({
                 'product_id': pid,
@@ -144,11 +150,7 @@ def get_stock(product_id, variant_id):
     
     stock_file = os.path.join(DB_DIR, f'stock_{product_id}_{variant_id}.txt')
     
-    if not os.path.exists(stock_file):
-        return jsonify({'accounts': [], 'count': 0})
-    
-    with open(stock_file, 'r', encoding='utf-8') as f:
-        accounts = [line.strip() for line in f if line.strip()]
+    accounts = read_stock_lines(stock_file)
     
     return jsonify({'accounts': accounts, 'count': len(accounts)})
 
@@ -164,9 +166,10 @@ def add_stock(product_id, variant_id):
     stock_file = os.path.join(DB_DIR, f'stock_{product_id}_{variant_id}.txt')
     os.makedirs(DB_DIR, exist_ok=True)
     
-    with open(stock_file, 'a', encoding='utf-8') as f:
-        for account in accounts:
-            f.write(account.strip() + '\n')
+    with stock_cursor.stock_lock(stock_file):
+        with open(stock_file, 'a', encoding='utf-8') as f:
+            for account in accounts:
+                f.write(account.strip() + '\n')
     
     return jsonify({'success': True, 'added': len(accounts)})
 
@@ -178,8 +181,7 @@ def clear_stock(product_id, variant_id):
     
     stock_file = os.path.join(DB_DIR, f'stock_{product_id}_{variant_id}.txt')
     
-    if os.path.exists(stock_file):
-        os.remove(stock_file)
+    remove_stock_file(stock_file)
     
     return jsonify({'success': True})
 
@@ -248,12 +250,10 @@ def get_stats():
     for pid, product in products.items():
         for vid in product.get('variants', {}).keys():
             stock_file = os.path.join(DB_DIR, f'stock_{pid}_{vid}.txt')
-            if os.path.exists(stock_file):
-                with open(stock_file, 'r', encoding='utf-8') as f:
-                    count = len([line for line in f if line.strip()])
-                    stock_count += count
-                    if count > 0:
-                        products_in_stock += 1
+            count = len(read_stock_lines(stock_file))
+            stock_count += count
+            if count > 0:
+                products_in_stock += 1
     
     # Calculate total revenue
     total_revenue = sum(user.get('total_spent', 0) for user in users.values())
@@ -0,0 +1,294 @@
+"""
+Broadcast Engine - rate-limited concurrent sending to many users
+A pool of sender tasks shares one token bucket kept just under Telegram's
+~30 messages/second limit. A RetryAfter (flood wait) pauses the whole bucket
+for the time Telegram asks and the message is retried; every recipient ends
+with one recorded outcome.
+
+A BroadcastJob keeps a broadcast on disk, so one interrupted by a restart
+carries on where it stopped instead of starting over.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+import logging
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+# Per-recipient outcomes
+SENT = "sent"
+BLOCKED = "blocked"  # 403: blocked the bot / deactivated
+FAILED = "failed"
+
+
+class TokenBucket:
+    """Async token bucket: acquire() waits until a send is allowed"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        # capacity 1 spreads sends evenly instead of bursting at the start
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Stop all sending for a while (Telegram flood wait)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def retry_seconds(error):
+    """RetryAfter.retry_after is an int in PTB 20 and a timedelta in later versions"""
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+
+class Broadcast:
+    """Send to every recipient through a shared bucket; outcomes land in self.outcomes"""
+
+    def __init__(self, recipients, send, bucket, concurrency=20, max_retries=3, on_result=None, outcomes=None):
+        # send(uid) -> awaitable; on_result(uid, outcome) is called after each recipient.
+        # outcomes: results from an earlier, interrupted run; those users are skipped
+        self.recipients = list(recipients)
+        self.send = send
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.on_result = on_result
+        self.outcomes = dict(outcomes or {})
+        self.counts = {SENT: 0, BLOCKED: 0, FAILED: 0}
+        for outcome in self.outcomes.values():
+            self.counts[outcome] += 1
+        self._resumed = len(self.outcomes)
+        self.flood_waits = 0
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def total(self):
+        return len(self.recipients)
+
+    @property
+    def done(self):
+        return len(self.outcomes)
+
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def progress_text(self):
+        elapsed = self.elapsed()
+        rate = (self.done - self._resumed) / elapsed if elapsed else 0.0
+        return (f"📢 Broadcast: {self.done}/{self.total}\n"
+                f"✅ Sent: {self.counts[SENT]} | 🚫 Blocked: {self.counts[BLOCKED]} | ❌ Failed: {self.counts[FAILED]}\n"
+                f"⏱ {elapsed:.0f}s, {rate:.1f} msg/s, {self.flood_waits} flood waits")
+
+    async def _deliver(self, uid):
+        attempts = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self.send(uid)
+                return SENT
+            except RetryAfter as e:
+                # Not counted as an attempt: Telegram told us exactly when to come back
+                self.flood_waits += 1
+                delay = retry_seconds(e)
+                logging.warning(f"[BROADCAST] Flood wait {delay:.0f}s")
+                self.bucket.pause(delay)
+            except Forbidden:
+                return BLOCKED
+            except BadRequest as e:
+                logging.warning(f"[BROADCAST] Failed to send to {uid}: {e}")
+                return FAILED
+            except NetworkError as e:
+                attempts += 1
+                if attempts > self.max_retries:
+                    logging.warning(f"[BROADCAST] Failed to send to {uid}: {e}")
+                    return FAILED
+                await asyncio.sleep(attempts)
+            except Exception as e:
+                logging.warning(f"[BROADCAST] Failed to send to {uid}: {e}")
+                return FAILED
+
+    def _record(self, uid, outcome):
+        self.outcomes[uid] = outcome
+        self.counts[outcome] += 1
+        if self.on_result:
+            try:
+                self.on_result(uid, outcome)
+            except Exception as e:
+                logging.error(f"[BROADCAST] on_result failed for {uid}: {e}")
+
+    async def _worker(self, queue):
+        # One shared iterator: each recipient is taken by exactly one worker
+        for uid in queue:
+            self._record(uid, await self._deliver(uid))
+
+    async def run(self, on_progress=None, progress_interval=5.0):
+        """Send to everyone; on_progress(self) is awaited every progress_interval seconds and at the end"""
+        self.started_at = time.monotonic()
+        queue = iter([uid for uid in self.recipients if uid not in self.outcomes])
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(max(1, self.concurrency))]
+        reporter = asyncio.create_task(self._report(on_progress, progress_interval)) if on_progress else None
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            if reporter:
+                reporter.cancel()
+            self.finished_at = time.monotonic()
+        logging.info(f"[BROADCAST] Finished {self.total} recipients in {self.elapsed():.0f}s: {self.counts}")
+        if on_progress:
+            await self._safe_progress(on_progress)
+        return self
+
+    async def _report(self, on_progress, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self._safe_progress(on_progress)
+
+    async def _safe_progress(self, on_progress):
+        try:
+            await on_progress(self)
+        except Exception as e:
+            logging.warning(f"[BROADCAST] Progress update failed: {e}")
+
+
+class BroadcastJob:
+    """A broadcast on disk: <id>.json holds the message and recipient list,
+    <id>.log gets one line per finished recipient.
+
+    record() only buffers; flush() appends the buffered lines and is meant
+    to run off the event loop (every second while a broadcast runs). After
+    a crash, recipients finished since the last flush and sends in flight
+    at that moment can go out twice.
+    """
+
+    def __init__(self, folder, job_id, message, recipients, created=None, status="running", extra=None):
+        self.folder = folder
+        self.id = job_id
+        self.message = message
+        self.recipients = recipients
+        self.created = created or time.time()
+        self.status = status
+        # Caller data kept with the job (e.g. where to post progress)
+        self.extra = extra or {}
+        self.outcomes = {}
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        # Orders flush() on the executor with close() on the loop, so the log
+        # is never closed (or reopened) under a write
+        self._log_lock = threading.RLock()
+        self._log = None
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, f"{self.id}.json")
+
+    @property
+    def log_path(self):
+        return os.path.join(self.folder, f"{self.id}.log")
+
+    @classmethod
+    def create(cls, folder, message, recipients, extra=None):
+        os.makedirs(folder, exist_ok=True)
+        job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        job = cls(folder, job_id, message, list(recipients), extra=extra)
+        job.save()
+        return job
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        job = cls(os.path.dirname(path), data["id"], data["message"], data["recipients"],
+                  created=data["created"], status=data["status"], extra=data.get("extra"))
+        if os.path.exists(job.log_path):
+            with open(job.log_path, 'r') as f:
+                for line in f:
+                    try:
+                        uid, outcome = json.loads(line)
+                    except ValueError:
+                        # Torn last line from a crash mid-append
+                        continue
+                    job.outcomes[uid] = outcome
+        return job
+
+    @classmethod
+    def unfinished(cls, folder):
+        """Jobs that were still running when the bot stopped"""
+        if not os.path.isdir(folder):
+            return []
+        jobs = []
+        for fname in sorted(os.listdir(folder)):
+            if not fname.endswith(".json"):
+                continue
+            try:
+                job = cls.load(os.path.join(folder, fname))
+            except Exception as e:
+                logging.error(f"[BROADCAST] Could not read job {fname}: {e}")
+                continue
+            if job.status == "running":
+                jobs.append(job)
+        return jobs
+
+    def save(self):
+        data = {"id": self.id, "created": self.created, "status": self.status, "message": self.message,
+                "recipients": self.recipients, "extra": self.extra}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def record(self, uid, outcome):
+        """Note one finished recipient (use as Broadcast's on_result); written by flush()"""
+        self.outcomes[uid] = outcome
+        with self._pending_lock:
+            self._pending.append(json.dumps([uid, outcome]) + "\n")
+
+    def flush(self):
+        """Append the buffered outcomes to the log (blocking)"""
+        with self._log_lock:
+            with self._pending_lock:
+                lines, self._pending = self._pending, []
+            if not lines:
+                return
+            if self._log is None:
+                self._log = open(self.log_path, 'a')
+            self._log.write("".join(lines))
+            self._log.flush()
+
+    def close(self):
+        with self._log_lock:
+            self.flush()
+            if self._log:
+                self._log.close()
+                self._log = None
+
+    def finish(self):
+        self.status = "done"
+        self.close()
+        self.save()
@@ -0,0 +1,142 @@
+"""
+Delivery Journal - exactly-once delivery of paid orders
+Every paid order goes through four states, each appended as one JSON line
+and fsynced before the bot moves on:
+
+    begin  - payment confirmed, about to take stock
+    taking - the items at this stock offset are about to be taken
+    taken  - these accounts were taken for the order
+    done   - the buyer has been sent their message
+
+An md5 that already has an entry is never started again, so a second
+confirmation of the same payment is a no-op. On startup, unfinished orders
+are finished from the journal: "taken" orders get the same accounts re-sent
+instead of new ones, and "taking" orders are checked against the stock
+cursor so their items are never taken twice.
+
+Done entries keep no accounts, and are dropped at compaction once their
+payment can no longer be confirmed again.
+"""
+import os
+import json
+import logging
+import threading
+import time
+
+
+class DeliveryJournal:
+    """Append-only JSONL journal with an in-memory {md5: entry} index"""
+
+    # Rewrite the file (one line per order) once it has this many
+    # superseded lines
+    COMPACT_LINES = 5000
+    # What a finished order no longer needs (the buyer's credentials)
+    SCRUB = ("accounts", "stock")
+
+    def __init__(self, path, retention=None, keep=None):
+        self.path = path
+        # Seconds a done entry is kept; None keeps them all
+        self.retention = retention
+        # Optional keep() -> md5s that may still be confirmed (the pending
+        # store); their entries are never dropped
+        self.keep = keep
+        self._index = {}
+        self._lock = threading.Lock()
+        self._appended = 0
+
+    def load(self):
+        """Rebuild the index from the file; returns the number of orders"""
+        if not os.path.exists(self.path):
+            return 0
+        lines = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn last line from a crash mid-write
+                    logging.warning(f"[DELIVERY] Skipping unreadable journal line {lines}")
+                    continue
+                entry = self._index.setdefault(record["md5"], {})
+                entry.update(record)
+        scrubbed = sum(self._scrub(entry) for entry in self._index.values())
+        if scrubbed or self._expired() or lines - len(self._index) >= self.COMPACT_LINES:
+            self.compact()
+        return len(self._index)
+
+    def compact(self):
+        """Rewrite the journal with just the latest state of each order, less expired done ones"""
+        keep = set(self.keep()) if self.keep and self.retention is not None else set()
+        with self._lock:
+            for md5 in self._expired():
+                if md5 not in keep:
+                    del self._index[md5]
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for entry in self._index.values():
+                    f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._appended = 0
+
+    def _expired(self):
+        if self.retention is None:
+            return []
+        cutoff = time.time() - self.retention
+        return [md5 for md5, e in self._index.items() if e["state"] == "done" and e["at"] < cutoff]
+
+    def _scrub(self, entry):
+        """Drop a finished order's credentials; True if it had any"""
+        if entry["state"] != "done":
+            return False
+        found = [k for k in self.SCRUB if k in entry]
+        for k in found:
+            del entry[k]
+        return bool(found)
+
+    def _append(self, record):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._appended += 1
+
+    def _write(self, md5, state, **fields):
+        record = dict(fields, md5=md5, state=state, at=time.time())
+        with self._lock:
+            self._append(record)
+            entry = self._index.setdefault(md5, {})
+            entry.update(record)
+            self._scrub(entry)
+
+    def begin(self, md5, order):
+        """Claim an order for delivery; False if it was already claimed"""
+        with self._lock:
+            if md5 in self._index:
+                return False
+            record = {"md5": md5, "state": "begin", "at": time.time(), "order": order}
+            self._append(record)
+            self._index[md5] = record
+            return True
+
+    def taking(self, md5, stock):
+        """stock: {"offset", "ino", "accounts"} of the items about to be taken"""
+        self._write(md5, "taking", stock=stock)
+
+    def taken(self, md5, accounts, trx_id=None):
+        self._write(md5, "taken", accounts=accounts, trx_id=trx_id)
+
+    def done(self, md5):
+        self._write(md5, "done")
+        # The file still has the accounts until it is rewritten
+        if self._appended >= self.COMPACT_LINES:
+            self.compact()
+
+    def get(self, md5):
+        return self._index.get(md5)
+
+    def unfinished(self):
+        """Entries that were begun but never marked done"""
+        return [dict(e) for e in self._index.values() if e["state"] != "done"]
@@ -31,7 +31,7 @@ source venv/bin/activate
 # Install Python dependencies
 echo "[5/8] Installing Python packages..."
 pip install --upgrade pip
-pip install python-telegram-bot==20.7 python-dotenv==1.0.0 qrcode==7.4.2 Pillow==10.1.0 bakong-khqr==1.3.0 pymongo==4.6.0 requests==2.31.0
+pip install python-telegram-bot==20.7 python-dotenv==1.0.0 qrcode==7.4.2 Pillow==10.1.0 bakong-khqr==0.6.5 pymongo==4.6.0 requests==2.31.0 httpx==0.25.2
 
 # Create .env file if it doesn't exist
 if [ ! -f .env ]; then
@@ -0,0 +1,169 @@
+"""
+KHQR Payload - build Bakong KHQR strings locally
+Same EMV layout as bakong_khqr's KHQR.create_qr (offline mode), so the bot
+can make the QR and its md5 itself and use the Cambodia proxy only for
+payment checks. test_khqr_payload.py keeps this byte-for-byte in line with
+the library through golden files, generated with the bakong-khqr version
+the bot and the proxy pin (0.6.5; recorded in khqr_golden.json).
+"""
+import hashlib
+import itertools
+import random
+import time
+
+# Merchant parameters bakong_proxy.create_qr uses; keep the two in sync
+PROXY_MERCHANT = {
+    "merchant_city": "PP",
+    "store_label": "Store",
+    "phone_number": "85512345678",
+    "terminal_label": "Bot01",
+}
+
+CURRENCY_CODES = {"USD": "840", "KHR": "116"}
+
+# Field limits enforced by bakong_khqr
+MAX_ACCOUNT = 32
+MAX_MERCHANT_NAME = 25
+MAX_MERCHANT_CITY = 15
+MAX_AMOUNT = 13
+MAX_SUBFIELD = 25
+
+
+_BASE36 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_bill_seq = itertools.count(random.randrange(36 ** 2))
+
+
+def _base36(n, width):
+    digits = []
+    for _ in range(width):
+        n, r = divmod(n, 36)
+        digits.append(_BASE36[r])
+    return "".join(reversed(digits))
+
+
+def new_bill_number(prefix="INV"):
+    """Order-scoped bill number, e.g. INV-MJV3K2Q0-0A7XQ (18 chars, limit is 25)
+
+    Millisecond clock + a per-process sequence + random suffix, so two
+    orders never share one even for the same amount in the same second,
+    across restarts or between bot processes.
+    """
+    now_ms = int(time.time() * 1000)
+    seq = next(_bill_seq) % (36 ** 2)
+    return f"{prefix}-{_base36(now_ms, 8)}-{_base36(seq, 2)}{_base36(random.randrange(36 ** 3), 3)}"
+
+
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+_CRC_TABLE = _crc16_table()
+
+
+def crc16(data):
+    """CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) over the UTF-8 bytes"""
+    crc = 0xFFFF
+    for byte in data.encode('utf-8'):
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC_TABLE[((crc >> 8) ^ byte) & 0xFF]
+    return crc
+
+
+def tlv(tag, value):
+    return f"{tag}{len(value):02}{value}"
+
+
+def _check_length(value, limit, name):
+    if len(value) > limit:
+        raise ValueError(f"{name} cannot exceed {limit} characters. Your input length: {len(value)} characters.")
+
+
+def format_amount(amount):
+    text = f"{float(amount):.2f}".rstrip("0").rstrip(".")
+    _check_length(text, MAX_AMOUNT, "Formatted Amount")
+    return text
+
+
+def additional_data(store_label=None, phone_number=None, bill_number=None, terminal_label=None):
+    """Tag 62: store label, mobile number, bill number, terminal label"""
+    fields = []
+    if store_label:
+        _check_length(store_label, MAX_SUBFIELD, "Store label")
+        fields.append(("03", store_label))
+    if phone_number:
+        digits = ''.join(c for c in str(phone_number) if c.isdigit())
+        if digits.startswith('855'):
+            digits = digits[3:]
+        if not digits.startswith('0'):
+            digits = '0' + digits
+        _check_length(digits, MAX_SUBFIELD, "Phone number")
+        fields.append(("02", digits))
+    if bill_number:
+        _check_length(bill_number, MAX_SUBFIELD, "Bill number")
+        fields.append(("01", bill_number))
+    if terminal_label:
+        _check_length(terminal_label, MAX_SUBFIELD, "Terminal label")
+        fields.append(("07", terminal_label))
+    combined = "".join(tlv(tag, str(value).strip()) for tag, value in fields if str(value).strip())
+    return tlv("62", combined) if combined else ""
+
+
+def build_khqr(account_id, merchant_name, merchant_city, amount, currency="USD", store_label=None,
+               phone_number=None, bill_number=None, terminal_label=None, expiration_days=1, now_ms=None):
+    """KHQR string for a payment; amount <= 0 gives a static QR"""
+    if not account_id:
+        raise ValueError("Missing required argument: 'account_id'.")
+    if not merchant_name:
+        raise ValueError("Merchant Name cannot be empty.")
+    if not merchant_city:
+        raise ValueError("Merchant city cannot be empty.")
+    _check_length(account_id, MAX_ACCOUNT, "Account ID")
+    _check_length(merchant_name, MAX_MERCHANT_NAME, "Merchant Name")
+    _check_length(merchant_city, MAX_MERCHANT_CITY, "Merchant City")
+    code = CURRENCY_CODES.get(currency.upper())
+    if code is None:
+        raise ValueError(f"Invalid currency code '{currency}'. Supported codes are 'USD' and 'KHR'.")
+
+    static = amount <= 0
+    qr = tlv("00", "01")
+    qr += "010211" if static else "010212"
+    qr += tlv("29", tlv("00", account_id))
+    qr += tlv("52", "5999")
+    qr += tlv("53", code)
+    if not static:
+        qr += tlv("54", format_amount(amount))
+    qr += tlv("58", "KH")
+    qr += tlv("59", merchant_name)
+    qr += tlv("60", merchant_city)
+    qr += additional_data(store_label, phone_number, bill_number, terminal_label)
+
+    # Tag 99: creation time and, for dynamic QRs, expiry (ms since epoch)
+    if now_ms is None:
+        now_ms = int(time.time() * 1000)
+    stamp = tlv("00", str(now_ms))
+    if not static:
+        if expiration_days < 1:
+            raise ValueError(f"Expiration time cannot be less than 1 day. Your input: {expiration_days} days.")
+        stamp += tlv("01", str(now_ms + expiration_days * 86400 * 1000))
+    qr += tlv("99", stamp)
+
+    qr += f"6304{crc16(qr + '6304'):04X}"
+    return qr
+
+
+def khqr_md5(qr):
+    """The md5 Bakong uses to look the payment up"""
+    return hashlib.md5(qr.encode('utf-8')).hexdigest()
+
+
+def build_proxy_khqr(account_id, merchant_name, amount, bill_number=None, now_ms=None):
+    """Same QR bakong_proxy's /create_qr would return; (qr, md5)"""
+    if bill_number is None:
+        bill_number = f"INV-{int(amount*1000)}"
+    qr = build_khqr(account_id, merchant_name, amount=amount, currency="USD",
+                    bill_number=bill_number, now_ms=now_ms, **PROXY_MERCHANT)
+    return qr, khqr_md5(qr)
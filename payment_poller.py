@@ -0,0 +1,473 @@
+"""
+Payment Poller - one scheduler for every open KHQR order
+Pending orders are registered by md5 and checked together in rounds, with a
+cap on how many checks run at once. Paid orders are handed to on_paid, orders
+that run out of time to on_expired.
+
+How often an order is checked depends on its age (see parse_schedule), and
+every order gets one last check just before it expires.
+
+With a PendingStore the open orders are also kept on disk, so a restart
+resumes checking them instead of abandoning every QR that was on screen.
+"""
+import os
+import json
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+
+def parse_schedule(spec):
+    """Parse "90:2,300:5,600:15" into [(90.0, 2.0), (300.0, 5.0), (600.0, 15.0)]
+
+    Each entry is "<until age>:<interval>" in seconds: orders younger than
+    90s are checked every 2s, then every 5s until 300s, and so on. The last
+    interval applies past the last age.
+    """
+    steps = []
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        until, interval = part.split(":")
+        steps.append((float(until), float(interval)))
+    if not steps or any(interval <= 0 for _, interval in steps):
+        raise ValueError(f"Invalid payment check schedule: {spec!r}")
+    return sorted(steps)
+
+
+class PaymentStats:
+    """Counts of checks and of which attempt / order age caught each payment"""
+
+    BUCKET = 10  # seconds per hit-age bucket
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = self._empty()
+        self.dirty = False
+        self.saved_at = 0.0
+
+    @staticmethod
+    def _empty():
+        return {"since": str(datetime.now()), "checks": 0, "paid": 0, "expired": 0,
+                "cancelled": 0, "hit_attempt": {}, "hit_age": {}}
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self.data.update(json.load(f))
+        except Exception as e:
+            logging.error(f"[PAYMENT STATS] Could not read {self.path}: {e}")
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.data, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.dirty = True
+            logging.error(f"[PAYMENT STATS] Could not write {self.path}: {e}")
+
+    def _bump(self, table, key):
+        table[key] = table.get(key, 0) + 1
+
+    def record_check(self):
+        self.data["checks"] += 1
+        self.dirty = True
+
+    def record_paid(self, attempt, age):
+        self.data["paid"] += 1
+        self._bump(self.data["hit_attempt"], str(attempt))
+        self._bump(self.data["hit_age"], str(int(age // self.BUCKET) * self.BUCKET))
+        self.dirty = True
+
+    def record_expired(self):
+        self.data["expired"] += 1
+        self.dirty = True
+
+    def record_cancelled(self):
+        self.data["cancelled"] += 1
+        self.dirty = True
+
+    def reset(self):
+        self.data = self._empty()
+        self.dirty = True
+
+
+class PendingStore:
+    """Open orders on disk as one small JSON file ({md5: order})"""
+
+    # Runtime-only scheduling fields that are not worth persisting
+    SKIP = ("next_check", "final_checked")
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"[PENDING] Could not read {self.path}: {e}")
+            return {}
+
+    def save(self, orders):
+        data = {md5: {k: v for k, v in o.items() if k not in self.SKIP} for md5, o in orders.items()}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class PaymentPoller:
+    """Owns all pending md5s and polls them in batched rounds"""
+
+    CLAIM_RETRY = 5.0
+    # Seconds stop() waits for running callbacks before cancelling them
+    STOP_TIMEOUT = 10.0
+
+    def __init__(self, check, on_paid, on_expired, schedule=((600.0, 5.0),), timeout=600.0,
+                 concurrency=4, final_check_lead=3.0, stats=None, executor=None, stats_interval=30.0,
+                 store=None, check_batch=None, batch_size=50, claim=None):
+        # check(md5) -> bool (awaitable); on_paid / on_expired(bot, order) (awaitable)
+        self.check = check
+        # Optional claim(order) -> bool, blocking (runs on the executor): makes a
+        # paid order durable elsewhere before it leaves the pending store, so a
+        # crash in between cannot lose it; False = claimed before, not delivered again
+        self.claim = claim
+        # Optional check_batch(md5_list) -> {md5: paid} or None when batching
+        # is unavailable right now (then the single check is used)
+        self.check_batch = check_batch
+        self.batch_size = batch_size
+        self.on_paid = on_paid
+        self.on_expired = on_expired
+        self.schedule = list(schedule)
+        self.timeout = timeout
+        self.concurrency = concurrency
+        # Seconds before expiry of the guaranteed last check
+        self.final_check_lead = final_check_lead
+        self.stats = stats or PaymentStats()
+        # Executor for writing the stats / pending files
+        self.executor = executor
+        self.stats_interval = stats_interval
+        self.store = store
+        self._store_dirty = False
+        # The md5 -> order registry, plus bill_number -> md5; each md5 maps to
+        # exactly one order, so a (batched) check result resolves in O(1)
+        self._pending = {}
+        self._bills = {}
+        # Paid orders not claimed yet; still written to the store
+        self._claiming = {}
+        self._bot = None
+        self._task = None
+        self._wakeup = None
+        # Running on_paid / on_expired callbacks; referenced so they are not
+        # garbage-collected mid-delivery, and finished by stop()
+        self._dispatching = set()
+
+    # ---------- lifecycle ----------
+
+    def restore(self):
+        """Reload open orders from the store (call before start)"""
+        if not self.store:
+            return 0
+        now = time.time()
+        restored = 0
+        for md5, order in self.store.load().items():
+            if order["expires_at"] <= now:
+                # Expired while we were down: one last check, then expire
+                order["final_checked"] = True
+                order["expires_at"] = now + self.final_check_lead
+                order["next_check"] = now
+            else:
+                order["final_checked"] = False
+                order["next_check"] = self._next_check(order, now)
+            self._add(md5, order)
+            restored += 1
+        if restored:
+            logging.info(f"[PAYMENT POLLER] Restored {restored} pending orders")
+        return restored
+
+    def start(self, bot):
+        """Start the scheduler task on the running event loop"""
+        if self._task:
+            return
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._dispatching:
+            # Let deliveries in flight finish; the journal covers a hard kill
+            _, running = await asyncio.wait(self._dispatching, timeout=self.STOP_TIMEOUT)
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.wait(running)
+                logging.warning(f"[PAYMENT POLLER] Cancelled {len(running)} callbacks still running at stop")
+        self._save_stats()
+        if self.store and self._store_dirty:
+            self._save_store(self._snapshot())
+
+    def _save_stats(self):
+        try:
+            self.stats.save()
+        except Exception as e:
+            logging.error(f"[PAYMENT POLLER] Could not save stats: {e}")
+
+    def _save_store(self, orders):
+        try:
+            self.store.save(orders)
+        except Exception as e:
+            self._store_dirty = True
+            logging.error(f"[PAYMENT POLLER] Could not save pending orders: {e}")
+
+    async def _persist(self):
+        """Write the pending set once per round, however many orders changed"""
+        if not self.store or not self._store_dirty:
+            return
+        self._store_dirty = False
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._save_store, self._snapshot())
+
+    def _snapshot(self):
+        # Unclaimed paid orders stay on disk; after a restart they are checked, found paid and claimed
+        return {**self._pending, **self._claiming}
+
+    def _changed(self):
+        self._store_dirty = True
+        if self._wakeup:
+            self._wakeup.set()
+
+    # ---------- orders ----------
+
+    def _add(self, md5, order):
+        self._pending[md5] = order
+        if order.get("bill_number"):
+            self._bills[order["bill_number"]] = md5
+
+    def _remove(self, md5):
+        order = self._pending.pop(md5)
+        self._bills.pop(order.get("bill_number"), None)
+        return order
+
+    def register(self, md5, order):
+        """Start watching an order; order is a dict handed back to the callbacks"""
+        if md5 in self._pending:
+            # Two open orders on one QR would both be delivered by one payment
+            raise ValueError(f"md5={md5} is already pending")
+        if order.get("bill_number") in self._bills:
+            raise ValueError(f"Bill number {order['bill_number']} is already pending")
+        now = time.time()
+        order = dict(order, md5=md5)
+        order.setdefault("created_at", now)
+        order.setdefault("expires_at", order["created_at"] + self.timeout)
+        order["attempts"] = 0
+        order["final_checked"] = False
+        order["next_check"] = self._next_check(order, now)
+        self._add(md5, order)
+        logging.info(f"[PAYMENT POLLER] Registered md5={md5} ({len(self._pending)} pending)")
+        self._changed()
+
+    def cancel(self, md5, chat_id=None):
+        """Stop watching an order; with chat_id, only if it belongs to that chat"""
+        order = self._pending.get(md5)
+        if not order or (chat_id is not None and order.get("chat_id") != chat_id):
+            return None
+        self._remove(md5)
+        self.stats.record_cancelled()
+        logging.info(f"[PAYMENT POLLER] Cancelled md5={md5}")
+        self._changed()
+        return order
+
+    def update(self, md5, **fields):
+        """Set fields of a pending order (e.g. the QR message id once it is sent)"""
+        order = self._pending.get(md5)
+        if order is not None:
+            order.update(fields)
+            self._changed()
+        return order
+
+    def get(self, md5):
+        return self._pending.get(md5)
+
+    def get_by_bill(self, bill_number):
+        md5 = self._bills.get(bill_number)
+        return self._pending.get(md5) if md5 else None
+
+    def orders(self):
+        return list(self._pending.values())
+
+    def __len__(self):
+        return len(self._pending)
+
+    # ---------- scheduling ----------
+
+    def interval_for(self, age):
+        """Check interval for an order of the given age (seconds)"""
+        for until, interval in self.schedule:
+            if age < until:
+                return interval
+        return self.schedule[-1][1]
+
+    def _next_check(self, order, now):
+        nxt = now + self.interval_for(now - order["created_at"])
+        final = order["expires_at"] - self.final_check_lead
+        if not order["final_checked"] and nxt >= final:
+            # Never let the schedule step over the last moments before expiry
+            order["final_checked"] = True
+            nxt = max(now, final)
+        return nxt
+
+    async def _run(self):
+        while True:
+            try:
+                await self._round()
+            except Exception as e:
+                logging.error(f"[PAYMENT POLLER] Round failed: {e}")
+            delay = self._next_delay()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _next_delay(self):
+        if self._claiming:
+            # A claim failed; try again soon
+            return self.CLAIM_RETRY
+        if not self._pending:
+            return None
+        now = time.time()
+        soonest = min(min(o["next_check"], o["expires_at"]) for o in self._pending.values())
+        return max(0.0, soonest - now)
+
+    async def _round(self):
+        now = time.time()
+        # Expired orders leave the store together, in this round's single write
+        for md5, order in list(self._pending.items()):
+            if order["expires_at"] <= now:
+                self._remove(md5)
+                self._store_dirty = True
+                self.stats.record_expired()
+                self._spawn(self._dispatch(self.on_expired, order))
+
+        due = [md5 for md5, o in self._pending.items() if o["next_check"] <= now]
+        if not due:
+            await self._claim_paid()
+            await self._persist()
+            await self._maybe_save_stats()
+            return
+
+        sem = asyncio.Semaphore(self.concurrency)
+        batched = set()
+
+        async def check_chunk(chunk):
+            async with sem:
+                chunk = [md5 for md5 in chunk if md5 in self._pending]
+                if not chunk:
+                    return
+                try:
+                    results = await self.check_batch(chunk)
+                except Exception as e:
+                    logging.error(f"[PAYMENT POLLER] Batch check of {len(chunk)} failed: {e}")
+                    results = None
+                if results is None:
+                    # Batch path unavailable: these go through single checks below
+                    return
+                batched.update(chunk)
+                for md5 in chunk:
+                    self._apply(md5, bool(results.get(md5)))
+
+        async def check_one(md5):
+            async with sem:
+                # Cancelled while waiting for a slot
+                if md5 not in self._pending:
+                    return
+                try:
+                    paid = await self.check(md5)
+                except Exception as e:
+                    logging.error(f"[PAYMENT POLLER] Check failed for md5={md5}: {e}")
+                    paid = False
+                self._apply(md5, paid)
+
+        if self.check_batch:
+            chunks = [due[i:i + self.batch_size] for i in range(0, len(due), self.batch_size)]
+            await asyncio.gather(*(check_chunk(chunk) for chunk in chunks))
+        await asyncio.gather(*(check_one(md5) for md5 in due if md5 not in batched))
+        logging.info(f"[PAYMENT POLLER] Checked {len(due)} orders ({len(batched)} batched, {len(self._pending)} pending)")
+        # Claimed before the write below drops them from the store
+        await self._claim_paid()
+        await self._persist()
+        await self._maybe_save_stats()
+
+    def _apply(self, md5, paid):
+        """Record one check result for an order"""
+        self.stats.record_check()
+        order = self._pending.get(md5)
+        if order is None:
+            return
+        order["attempts"] += 1
+        now = time.time()
+        if paid:
+            self._remove(md5)
+            self._claiming[md5] = order
+            self._store_dirty = True
+            self.stats.record_paid(order["attempts"], now - order["created_at"])
+        else:
+            order["next_check"] = self._next_check(order, now)
+
+    async def _claim_paid(self):
+        """Claim this round's paid orders, then hand them to on_paid"""
+        loop = asyncio.get_running_loop()
+        for md5, order in list(self._claiming.items()):
+            fresh = True
+            if self.claim:
+                try:
+                    fresh = await loop.run_in_executor(self.executor, self.claim, order)
+                except Exception as e:
+                    # Stays in the store; retried next round
+                    logging.error(f"[PAYMENT POLLER] Could not claim paid md5={md5}: {e}")
+                    continue
+            del self._claiming[md5]
+            self._store_dirty = True
+            if fresh:
+                self._spawn(self._dispatch(self.on_paid, order))
+            else:
+                logging.warning(f"[PAYMENT POLLER] md5={md5} was already claimed, not delivering again")
+
+    async def _maybe_save_stats(self):
+        if not self.stats.dirty or time.monotonic() - self.stats.saved_at < self.stats_interval:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._save_stats)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._dispatching.add(task)
+        task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, callback, order):
+        try:
+            await callback(self._bot, order)
+        except Exception as e:
+            logging.error(f"[PAYMENT POLLER] Callback failed for md5={order.get('md5')}: {e}")
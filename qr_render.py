@@ -0,0 +1,295 @@
+"""
+QR Render - KHQR payment cards rendered in memory
+The template is decoded once and kept (reloaded only if the file changes),
+the font is loaded once per thread, and each card is composited onto a copy
+of the template and encoded straight into memory. No files are written, so
+nothing leaks when a send fails and names can never collide.
+
+QRRenderPool optionally moves that CPU work into worker processes so a
+burst of checkouts is rendered on every core instead of one.
+
+ImageOutput decides what is uploaded: pixel width and encoding (RGBA PNG,
+palette PNG, JPEG, WebP, or "auto" - the best-looking rung of AUTO_LADDER
+that fits a byte budget). Every rung is checked to still decode by
+test_qr_scan.py.
+"""
+import io
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+BAKONG_GREEN = (0x10, 0x7c, 0x42)
+WHITE = (255, 255, 255)
+FONT_PATHS = ("/system/fonts/Roboto-Bold.ttf",)
+
+
+def qr_matrix_image(qr_data, border=0, error_correction=qrcode.constants.ERROR_CORRECT_M):
+    """One pixel per module, green on white, as a palette image"""
+    qr = qrcode.QRCode(border=border, error_correction=error_correction)
+    qr.add_data(qr_data)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    size = len(matrix)
+    img = Image.frombytes("P", (size, size), bytes(1 if cell else 0 for row in matrix for cell in row))
+    img.putpalette(WHITE + BAKONG_GREEN)
+    return img
+
+
+def encode_png(img):
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def encode_image(img, fmt, quality=80):
+    """Encode as png (as is), palette (64-colour PNG), jpeg or webp"""
+    buf = io.BytesIO()
+    if fmt == "png":
+        img.save(buf, "PNG")
+    elif fmt == "palette":
+        img.convert("RGB").quantize(64, method=Image.Quantize.FASTOCTREE).save(buf, "PNG", optimize=True)
+    elif fmt == "jpeg":
+        # 4:4:4 keeps the green/white module edges sharp
+        img.convert("RGB").save(buf, "JPEG", quality=quality, optimize=True, progressive=True, subsampling=0)
+    elif fmt == "webp":
+        img.convert("RGB").save(buf, "WEBP", quality=quality, method=4)
+    else:
+        raise ValueError(f"Unknown image format: {fmt}")
+    return buf.getvalue()
+
+
+# "auto" tries these from best looking to smallest; each one is proven to
+# scan by test_qr_scan.py, so none goes below the quality that still decodes
+AUTO_LADDER = (("palette", None), ("webp", 90), ("jpeg", 85), ("webp", 75), ("jpeg", 70), ("webp", 60))
+FORMATS = ("png", "palette", "jpeg", "webp", "auto")
+
+
+class ImageOutput:
+    """How rendered cards are encoded for upload
+
+    width: output width in pixels (0 = template width; never upscaled, and
+    never below MIN_WIDTH - narrower cards fail test_qr_scan.py's phone photo)
+    quality: JPEG/WebP quality for the jpeg and webp formats
+    max_bytes: budget for "auto" (0 = smallest rung); the first rung of
+    AUTO_LADDER that fits is used, else the smallest one
+    """
+
+    MIN_WIDTH = 540
+
+    def __init__(self, fmt="png", width=0, quality=80, max_bytes=0):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown image format: {fmt} (use one of {', '.join(FORMATS)})")
+        self.format = fmt
+        self.width = max(width, self.MIN_WIDTH) if width else 0
+        self.quality = quality
+        self.max_bytes = max_bytes
+
+    def encode(self, img):
+        if self.format != "auto":
+            return encode_image(img, self.format, self.quality)
+        smallest = None
+        for fmt, quality in AUTO_LADDER:
+            data = encode_image(img, fmt, quality)
+            if self.max_bytes and len(data) <= self.max_bytes:
+                return data
+            if smallest is None or len(data) < len(smallest):
+                smallest = data
+        return smallest
+
+
+class QRCardRenderer:
+    """Renders KHQR cards as image bytes (see ImageOutput); safe to share between threads"""
+
+    def __init__(self, template_paths, font_paths=FONT_PATHS, font_size=60, output=None):
+        self.template_paths = list(template_paths)
+        self.font_paths = list(font_paths)
+        self.font_size = font_size
+        self.output = output or ImageOutput()
+        # (path, file stamp, decoded RGBA image at the output width, scale)
+        self._template = (None, None, None, 1.0)
+        self._template_lock = threading.Lock()
+        self._local = threading.local()
+
+    def template(self):
+        """Decoded template image (scaled to the output width), or None when there is no template file"""
+        for path in self.template_paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stamp = (st.st_mtime_ns, st.st_size)
+            cached_path, cached_stamp, image, _ = self._template
+            if (cached_path, cached_stamp) == (path, stamp):
+                return image
+            with self._template_lock:
+                if self._template[:2] != (path, stamp):
+                    image = Image.open(path).convert("RGBA")
+                    image.load()
+                    scale = 1.0
+                    width = self.output.width
+                    if width and width < image.width:
+                        scale = width / image.width
+                        image = image.resize((width, round(image.height * scale)), Image.LANCZOS)
+                    self._template = (path, stamp, image, scale)
+                    logging.info(f"[QR IMAGE] Loaded template {path} {image.size}")
+                return self._template[2]
+        return None
+
+    def font(self, size=None):
+        # FreeType faces are not shared between threads
+        size = size or self.font_size
+        fonts = getattr(self._local, "fonts", None)
+        if fonts is None:
+            fonts = self._local.fonts = {}
+        font = fonts.get(size)
+        if font is None:
+            font = ImageFont.load_default()
+            for path in self.font_paths:
+                try:
+                    font = ImageFont.truetype(path, size)
+                    break
+                except OSError:
+                    continue
+            fonts[size] = font
+        return font
+
+    def render(self, qr_data, amount):
+        """Encoded payment card (plain green QR without a template)"""
+        try:
+            template = self.template()
+            if template is None:
+                return self.output.encode(self.basic(qr_data))
+            return self.output.encode(self.card(template, qr_data, amount))
+        except Exception as e:
+            logging.error(f"[QR IMAGE] Styled render failed, using plain QR: {e}")
+            return encode_png(qrcode.make(qr_data).get_image())
+
+    def basic(self, qr_data):
+        """Green KHQR on white, 10px modules (fewer to fit the output width) with a 4-module quiet zone"""
+        qr_img = qr_matrix_image(qr_data, border=4, error_correction=qrcode.constants.ERROR_CORRECT_L)
+        box = 10
+        if self.output.width:
+            box = max(2, min(box, self.output.width // qr_img.width))
+        return qr_img.resize((qr_img.width * box, qr_img.height * box), Image.NEAREST)
+
+    def card(self, template, qr_data, amount):
+        path, stamp, cached, scale = self._template
+        if cached is not template:
+            scale = 1.0
+        card = template.copy()
+        W, H = card.size
+        qr_target_size = int(W * 0.55)
+        # Scale modules up to just above the target with NEAREST, then smooth down.
+        # The 2-module white quiet zone lets scanners find the code on a busy template.
+        qr_img = qr_matrix_image(qr_data, border=2)
+        box = -(-qr_target_size // qr_img.width)
+        qr_img = qr_img.resize((qr_img.width * box, qr_img.height * box), Image.NEAREST).convert("RGB")
+        qr_img = qr_img.resize((qr_target_size, qr_target_size), Image.LANCZOS)
+        pos_x = (W - qr_target_size) // 2; pos_y = (H - qr_target_size) // 2
+        card.paste(qr_img, (pos_x, pos_y))
+
+        draw = ImageDraw.Draw(card)
+        font = self.font(max(10, round(self.font_size * scale)))
+        text = f"${amount:.2f}"
+        bbox = draw.textbbox((0, 0), text, font=font)
+        text_w = bbox[2] - bbox[0]
+        text_x = (W - text_w) // 2
+        text_y = pos_y + qr_target_size + round(30 * scale)
+
+        d = max(1, round(2 * scale))
+        for off in [(-d,-d), (-d,d), (d,-d), (d,d)]:
+            draw.text((text_x+off[0], text_y+off[1]), text, font=font, fill="black")
+        draw.text((text_x, text_y), text, font=font, fill="white")
+        return card
+
+
+# Renderer of the current pool worker process (set by _init_worker)
+_worker_renderer = None
+
+
+def _init_worker(template_paths, font_paths, font_size, output):
+    global _worker_renderer
+    _worker_renderer = QRCardRenderer(template_paths, font_paths, font_size, output)
+    # Decode the template and load the font before the first order arrives
+    _worker_renderer.template()
+    _worker_renderer.font()
+
+
+def _worker_render(qr_data, amount):
+    return _worker_renderer.render(qr_data, amount)
+
+
+def _worker_ping(_):
+    return os.getpid()
+
+
+class QRRenderPool:
+    """Renders cards in worker processes; render() has QRCardRenderer's signature
+
+    At most workers + max_queue renders are in the pool at once. Past that
+    (a sale burst the pool cannot keep up with) a render falls back to a
+    plain qrcode.make QR in the calling thread instead of queueing up.
+    """
+
+    def __init__(self, template_paths, workers, max_queue=8, font_paths=FONT_PATHS, font_size=60, timeout=30.0, output=None):
+        self.template_paths = list(template_paths)
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        # fork: workers must not re-import the bot's main module (spawn would)
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker, initargs=(self.template_paths, list(font_paths), font_size, output)
+        )
+        # Used in-process if the pool breaks (a worker was killed)
+        self._local = QRCardRenderer(template_paths, font_paths, font_size, output)
+        self._broken = False
+        self.fallbacks = 0
+
+    def start(self):
+        """Fork and warm every worker; call before the bot starts other threads"""
+        pids = set(self._executor.map(_worker_ping, range(self.workers * 2)))
+        logging.info(f"[QR POOL] {len(pids)} render workers ready")
+
+    def render(self, qr_data, amount):
+        if self._broken:
+            return self._local.render(qr_data, amount)
+        if not self._slots.acquire(blocking=False):
+            self.fallbacks += 1
+            logging.warning(f"[QR POOL] Pool busy, sending a plain QR ({self.fallbacks} so far)")
+            return encode_png(qrcode.make(qr_data).get_image())
+        future = None
+        try:
+            future = self._executor.submit(_worker_render, qr_data, amount)
+            # Freed when the worker is done, not when we stop waiting: a timed-out
+            # render still occupies a worker
+            future.add_done_callback(self._release_slot)
+            return future.result(timeout=self.timeout)
+        except BrokenProcessPool as e:
+            # A worker died: render in-process from now on
+            self._broken = True
+            logging.error(f"[QR POOL] Pool broken, rendering in-process from now on: {e!r}")
+            return encode_png(qrcode.make(qr_data).get_image())
+        except FutureTimeoutError:
+            # Not the builtin TimeoutError before Python 3.11; the pool is still fine
+            logging.error(f"[QR POOL] Render took over {self.timeout}s, sending a plain QR")
+            return encode_png(qrcode.make(qr_data).get_image())
+        except Exception as e:
+            logging.error(f"[QR POOL] Render failed, sending a plain QR: {e!r}")
+            return encode_png(qrcode.make(qr_data).get_image())
+        finally:
+            if future is None:
+                # Never submitted
+                self._slots.release()
+
+    def _release_slot(self, future):
+        self._slots.release()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
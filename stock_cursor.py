@@ -0,0 +1,146 @@
+"""
+Stock Cursor - the sold-offset of a stock file, shared by every process
+Items are sold from the front of database/stock_<pid>_<vid>.txt by moving a
+byte offset kept in <file>.pos, so selling never rewrites the file. The bot,
+the admin panels and the API all read (and some rewrite) these files, so
+they share this module:
+
+    with stock_lock(filename):      # threads and other processes
+        offset = read_offset(filename)
+        ...
+        write_offset(filename, new_offset)
+
+The .pos records the file's inode and a checksum of the bytes just before
+the offset. Inode numbers get reused when a file is replaced back and forth,
+so the checksum is what tells a cursor for this file from a stale one; a
+stale cursor reads as 0. Whoever rewrites a stock file writes a fresh .pos
+under the same lock (replace_lines does both).
+"""
+import os
+import json
+import zlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: locks only cover the threads of one process
+    fcntl = None
+
+# Bytes before the offset covered by the checksum
+MARK_BYTES = 64
+
+
+class StockLock:
+    """Reentrant lock on one stock file across threads and processes (flock on <file>.lock)"""
+
+    def __init__(self, filename):
+        self.path = f"{filename}.lock"
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._rlock.acquire()
+        if self._depth == 0 and fcntl:
+            try:
+                self._file = open(self.path, "a")
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            except Exception:
+                if self._file:
+                    self._file.close()
+                    self._file = None
+                self._rlock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and self._file:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._rlock.release()
+
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def stock_lock(filename):
+    """The process-wide StockLock of a stock file"""
+    with _locks_guard:
+        lock = _locks.get(filename)
+        if lock is None:
+            lock = _locks[filename] = StockLock(filename)
+        return lock
+
+
+def _mark(f, offset):
+    start = max(0, offset - MARK_BYTES)
+    f.seek(start)
+    return zlib.crc32(f.read(offset - start))
+
+
+def read_offset(filename):
+    """Byte offset of the first unsold line (0 if missing or stale)"""
+    try:
+        with open(f"{filename}.pos", "r") as f:
+            pos = json.load(f)
+        offset = pos.get("offset", 0)
+        with open(filename, "rb") as f:
+            st = os.fstat(f.fileno())
+            if pos.get("ino") != st.st_ino or offset > st.st_size:
+                return 0
+            if offset:
+                # .pos files written before the checksum existed only have the inode
+                if "mark" in pos and pos["mark"] != _mark(f, offset):
+                    return 0
+                # Never start mid-line (a truncated credential)
+                f.seek(offset - 1)
+                if f.read(1) != b"\n":
+                    return 0
+        return offset
+    except (OSError, ValueError):
+        return 0
+
+
+def write_offset(filename, offset):
+    """Atomically point the cursor of a stock file at offset"""
+    with open(filename, "rb") as f:
+        ino = os.fstat(f.fileno()).st_ino
+        mark = _mark(f, offset) if offset else 0
+    tmp_file = f"{filename}.pos.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"offset": offset, "ino": ino, "mark": mark}, f)
+    os.replace(tmp_file, f"{filename}.pos")
+
+
+def read_lines(filename):
+    """All unsold items of a stock file"""
+    with stock_lock(filename):
+        if not os.path.exists(filename):
+            return []
+        with open(filename, "rb") as f:
+            f.seek(read_offset(filename))
+            return [line.decode("utf-8").strip() for line in f if line.strip()]
+
+
+def replace_lines(filename, lines):
+    """Atomically replace a stock file with the given items, cursor at 0"""
+    with stock_lock(filename):
+        tmp_file = f"{filename}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write(f"{line}\n")
+        os.replace(tmp_file, filename)
+        write_offset(filename, 0)
+
+
+def remove(filename):
+    """Delete a stock file and its cursor"""
+    with stock_lock(filename):
+        for fname in (filename, f"{filename}.pos"):
+            if os.path.exists(fname):
+                os.remove(fname)
@@ -1,16 +1,33 @@
 import logging
-import qrcode
 import os
 import asyncio
 import json
 import random
+import secrets
 import string
+import copy
+import time
+import atexit
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from datetime import datetime
 from dotenv import load_dotenv
-from PIL import Image, ImageDraw, ImageFont
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram.error import Forbidden, TimedOut
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler
 from bakong_khqr import KHQR
+from khqr_payload import build_proxy_khqr, new_bill_number
+from qr_render import ImageOutput, QRCardRenderer, QRRenderPool
+from update_processor import ChatOrderedUpdateProcessor
+from webhook_server import WebhookServer, run_webhook
+from user_registry import UserRegistry
+from payment_poller import PaymentPoller, PaymentStats, PendingStore, parse_schedule
+from delivery_journal import DeliveryJournal
+from stock_cursor import stock_lock as _stock_lock, read_offset as _read_stock_offset, \
+    write_offset as _write_stock_offset, replace_lines as _replace_stock_lines
+from broadcast_engine import Broadcast, BroadcastJob, TokenBucket
 
 # Load environment variables from .env file
 # Try multiple locations for .env file
@@ -38,6 +55,33 @@ MERCHANT_NAME = os.getenv("MERCHANT_NAME", "SOVANNAREACH VORN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "7948968436"))
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "@dzy4u2")
 BAKONG_PROXY_URL = os.getenv("BAKONG_PROXY_URL", "")  # optional proxy endpoint hosted in Cambodia
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))  # threads for file / HTTP / QR work
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))  # updates handled at once (in order per chat), 1 = one at a time
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # public https base URL; empty = long polling
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")  # address the webhook server binds to
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") or secrets.token_urlsafe(32)  # random per start if unset
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # parallel connections Telegram may open
+WEBHOOK_RECORD_FILE = os.getenv("WEBHOOK_RECORD_FILE", "")  # append received updates here (for benchmark_webhook.py)
+BOT_DEBUG_LOOP = os.getenv("BOT_DEBUG_LOOP", "false").lower() == "true"  # log callbacks that block the loop
+SLOW_CALLBACK_MS = int(os.getenv("SLOW_CALLBACK_MS", "50"))
+# "<until age>:<interval>" steps in seconds: every 2s for the first 90s, then 5s, then 15s
+PAYMENT_CHECK_SCHEDULE = parse_schedule(os.getenv("PAYMENT_CHECK_SCHEDULE", "90:2,300:5,600:15"))
+PAYMENT_FINAL_CHECK_LEAD = float(os.getenv("PAYMENT_FINAL_CHECK_LEAD", "3"))  # last check this long before expiry
+PAYMENT_TIMEOUT = float(os.getenv("PAYMENT_TIMEOUT", "600"))  # QR validity (10 minutes)
+PAYMENT_CHECK_CONCURRENCY = int(os.getenv("PAYMENT_CHECK_CONCURRENCY", "4"))  # checks in flight at once
+PAYMENT_CHECK_BATCH_SIZE = int(os.getenv("PAYMENT_CHECK_BATCH_SIZE", "100"))  # md5s per /check_batch call
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", "0"))  # render processes for QR cards, 0 = in the bot process
+QR_RENDER_QUEUE = int(os.getenv("QR_RENDER_QUEUE", "8"))  # renders waiting for a worker before plain QRs are sent
+QR_IMAGE_FORMAT = os.getenv("QR_IMAGE_FORMAT", "png").lower()  # png, palette, jpeg, webp or auto
+QR_IMAGE_WIDTH = int(os.getenv("QR_IMAGE_WIDTH", "0"))  # QR card width in pixels, 0 = template width
+QR_IMAGE_QUALITY = int(os.getenv("QR_IMAGE_QUALITY", "80"))  # jpeg / webp quality
+QR_IMAGE_MAX_KB = int(os.getenv("QR_IMAGE_MAX_KB", "0"))  # size budget for "auto", 0 = smallest
+PRODUCTS_PAGE_SIZE = int(os.getenv("PRODUCTS_PAGE_SIZE", "20"))  # products per list page
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "28"))  # messages/second, Telegram allows ~30
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))  # sends in flight at once
+STOCK_HOLD_TTL = float(os.getenv("STOCK_HOLD_TTL", str(PAYMENT_TIMEOUT + 60)))  # stock reserved per open QR
 
 # Validate required tokens
 if not BOT_TOKEN:
@@ -56,9 +100,18 @@ if not os.path.exists(DB_FOLDER):
 PRODUCTS_FILE = f"{DB_FOLDER}/products.json"
 CONFIG_FILE = f"{DB_FOLDER}/config.json"
 USERS_FILE = f"{DB_FOLDER}/users.json"
+PAYMENT_STATS_FILE = f"{DB_FOLDER}/payment_stats.json"
+PENDING_PAYMENTS_FILE = f"{DB_FOLDER}/pending_payments.json"
+DELIVERY_JOURNAL_FILE = f"{DB_FOLDER}/deliveries.jsonl"
+BROADCAST_JOBS_FOLDER = f"{DB_FOLDER}/broadcasts"
 
 print("[OK] Using local JSON file storage")
 
+# Users are served from memory and flushed to users.json in batches
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", "5"))
+user_registry = UserRegistry(USERS_FILE, flush_interval=USERS_FLUSH_INTERVAL)
+user_registry.load()
+
 TEMPLATE_FILE = "template.png" # Keep in root folder for easy access
 
 # STATES
@@ -85,16 +138,64 @@ if BAKONG_TOKEN:
 else:
     print("[WARNING] No BAKONG_TOKEN found - KHQR will not work")
 
-# If a proxy URL is provided, we'll use HTTP requests to talk to it
+# If a proxy URL is provided, talk to it through one pooled keep-alive client
+BAKONG_PROXY_TIMEOUT = float(os.getenv("BAKONG_PROXY_TIMEOUT", "15"))  # seconds per proxy call
+BAKONG_PROXY_RETRIES = int(os.getenv("BAKONG_PROXY_RETRIES", "2"))  # retries on network errors / 5xx
+# Build the KHQR locally (same payload the proxy makes) and use the proxy only for checks
+BAKONG_LOCAL_QR = os.getenv("BAKONG_LOCAL_QR", "false").lower() == "true"
+bakong_proxy = None
 if BAKONG_PROXY_URL:
     try:
-        import requests
-    except Exception:
-        requests = None
+        from bakong_client import BakongProxyClient
+        bakong_proxy = BakongProxyClient(BAKONG_PROXY_URL, timeout=BAKONG_PROXY_TIMEOUT, retries=BAKONG_PROXY_RETRIES)
+    except Exception as e:
+        logging.error(f"[PROXY] Could not create proxy client: {e}")
+
+# --- BLOCKING WORK EXECUTOR ---
+# Handlers never touch files, Bakong/proxy HTTP or PIL directly: everything
+# blocking goes through run_blocking() onto this bounded pool, so one slow
+# proxy call or disk write cannot freeze the bot for every other user.
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="store-io")
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking helper on io_executor and await its result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
 
 # --- 1. DATA MANAGERS ---
 
+# Process-wide catalog cache. products.json is only re-parsed when its
+# mtime/size changes (e.g. edited by the admin panel) or when save_products()
+# writes it. Handlers get a read-only view of the shared copy.
+_catalog_lock = threading.Lock()
+_catalog = {"stamp": None, "data": {}, "view": MappingProxyType({}), "version": 0}
+
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def _set_catalog(data, stamp):
+    with _catalog_lock:
+        _catalog["stamp"] = stamp
+        _catalog["data"] = data
+        _catalog["view"] = _freeze(data)
+        _catalog["version"] += 1
+        return _catalog["view"]
+
+def catalog_version():
+    """Bumped on every catalog (re)load; keys caches derived from the catalog"""
+    load_products()
+    return _catalog["version"]
+
 def load_products():
+    """Return a read-only view of the catalog (use load_products_for_update() to edit)"""
     try:
         if not os.path.exists(PRODUCTS_FILE):
             data = {
@@ -105,29 +206,54 @@ def load_products():
                     "variants": {"1M": {"name": "1 Month", "price": 0.01, "tutorial": None}}
                 }
             }
-            with open(PRODUCTS_FILE, 'w') as f:
-                json.dump(data, f, indent=2)
+            save_products(data)
             
             # Create dummy stock
             stock_path = f"{DB_FOLDER}/stock_1_1M.txt"
             if not os.path.exists(stock_path):
                 with open(stock_path, "w") as f:
                     f.write("user: test@gmail.com | pass: 123456\n" * 5)
-            return data
+            return _catalog["view"]
+        
+        stamp = _file_stamp(PRODUCTS_FILE)
+        if stamp == _catalog["stamp"]:
+            return _catalog["view"]
         
         with open(PRODUCTS_FILE, 'r') as f:
-            return json.load(f)
+            data = json.load(f)
+        logging.info(f"[CATALOG] Reloaded {len(data)} products from {PRODUCTS_FILE}")
+        return _set_catalog(data, stamp)
     except Exception as e:
         logging.error(f"Error loading products: {e}")
-        return {}
+        # Keep serving the last good copy (file may be mid-write by another process)
+        return _catalog["view"]
+
+def load_products_for_update():
+    """Return a private, mutable copy of the catalog to modify and pass to save_products()"""
+    load_products()
+    with _catalog_lock:
+        return copy.deepcopy(_catalog["data"])
 
 def save_products(data):
     try:
-        with open(PRODUCTS_FILE, 'w') as f:
+        tmp_file = f"{PRODUCTS_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
             json.dump(data, f, indent=2)
+        os.replace(tmp_file, PRODUCTS_FILE)
+        _set_catalog(copy.deepcopy(data), _file_stamp(PRODUCTS_FILE))
     except Exception as e:
         logging.error(f"Error saving products: {e}")
 
+_catalog_write_lock = threading.Lock()
+
+def add_product_sold(pid, qty):
+    """Increment a product's sold counter (serialized read-modify-write)"""
+    with _catalog_write_lock:
+        products = load_products_for_update()
+        if pid in products:
+            products[pid]['sold'] = products[pid].get('sold', 0) + qty
+            save_products(products)
+
 def get_config(key):
     defaults = {
         "welcome": "default", 
@@ -165,70 +291,53 @@ def update_config(key, value):
 
 def get_user_data(user_id, username=None):
     try:
-        users = {}
-        if os.path.exists(USERS_FILE):
-            try:
-                with open(USERS_FILE, 'r') as f:
-                    users = json.load(f)
-            except Exception as e:
-                logging.warning(f"Could not read users file: {e}")
-        
-        uid = str(user_id)
-        if uid not in users:
-            users[uid] = {"username": username or "Unknown", "spent": 0.0, "joined": str(datetime.now())}
-            with open(USERS_FILE, 'w') as f:
-                json.dump(users, f, indent=2)
-            logging.info(f"[USER REGISTERED] New user: {uid} (@{username})")
-        else:
-            # Update username if provided and different
-            if username and users[uid].get('username') != username:
-                users[uid]['username'] = username
-                with open(USERS_FILE, 'w') as f:
-                    json.dump(users, f, indent=2)
-                logging.info(f"[USER UPDATED] Username updated for {uid}: @{username}")
-        return users[uid]
+        return user_registry.touch(user_id, username)
     except Exception as e:
         logging.error(f"Error getting user data: {e}")
         return {"username": username or "Unknown", "spent": 0.0, "joined": str(datetime.now())}
 
-def update_user_spent(user_id, amount, username):
+def update_user_spent(user_id, amount, username, pid=None):
     try:
-        users = {}
-        if os.path.exists(USERS_FILE):
-            try:
-                with open(USERS_FILE, 'r') as f:
-                    users = json.load(f)
-            except Exception as e:
-                logging.warning(f"Could not read users file: {e}")
-        
-        uid = str(user_id)
-        if uid not in users:
-            users[uid] = {"spent": 0.0, "joined": str(datetime.now())}
-        
-        users[uid]["spent"] += amount
-        users[uid]["username"] = username
-        
-        with open(USERS_FILE, 'w') as f:
-            json.dump(users, f, indent=2)
+        user_registry.add_spent(user_id, amount, username, pid)
     except Exception as e:
         logging.error(f"Error updating user spent: {e}")
 
 def get_total_users():
-    if not os.path.exists(USERS_FILE): return 0
-    try:
-        with open(USERS_FILE, 'r') as f:
-            return len(json.load(f))
-    except:
-        return 0
+    return len(user_registry)
 
 def get_all_users():
-    if not os.path.exists(USERS_FILE): return []
-    try:
-        with open(USERS_FILE, 'r') as f:
-            users = json.load(f)
-            return [int(uid) for uid in users.keys()]
-    except:
-        return []
+    """Users who can still be messaged (not blocked / deactivated)"""
+    return [int(uid) for uid in user_registry.ids(active_only=True)]
+
+def parse_segment(args):
+    """/broadcast arguments -> UserRegistry.segment() filters
+
+    bought:<pid>  spent:<usd>  active:<days>  joined:<days>  nobuy
+    user:@a,@b  (all must match)
+    """
+    segment = {}
+    for arg in args:
+        key, _, value = arg.lower().partition(":")
+        if key == "bought" and value:
+            segment["bought"] = value
+        elif key == "spent" and value:
+            segment["min_spent"] = float(value.lstrip("$"))
+        elif key == "active" and value:
+            segment["active_days"] = int(value)
+        elif key == "joined" and value:
+            segment["joined_days"] = int(value)
+        elif key == "user" and value:
+            segment["usernames"] = [name for name in value.split(",") if name]
+        elif key == "nobuy" and not value:
+            segment["never_bought"] = True
+        else:
+            raise ValueError(f"Unknown filter: {arg}")
+    return segment
+
+def get_segment_users(segment):
+    if not segment:
+        return get_all_users()
+    return sorted(int(uid) for uid in user_registry.segment(**segment))
 
 def get_total_sold():
     products = load_products()
@@ -238,75 +347,353 @@ def get_total_sold():
     return total
 
 # --- STOCK SYSTEM ---
+# Sold items are not cut out of the stock file on every sale. A sidecar
+# "<stock file>.pos" holds the byte offset of the first unsold line (see
+# stock_cursor.py; shared with the admin panel and API, which lock the same
+# files). The consumed prefix is dropped later by compact_stock_files().
+STOCK_COMPACT_BYTES = int(os.getenv("STOCK_COMPACT_BYTES", str(256 * 1024)))
+STOCK_COMPACT_INTERVAL = int(os.getenv("STOCK_COMPACT_INTERVAL", "600"))
+
+# Unsold item count per stock file: {filename: (count, file stamp)}. Kept up to
+# date by add_stock/get_accounts/clear_stock/remove_stock_item; an entry whose
+# stamp no longer matches the file (edited by the admin panel / API) is recounted.
+_stock_counts = {}
+
 def get_stock_file(pid, vid):
     safe_vid = str(vid).replace(" ", "").upper()
     return f"{DB_FOLDER}/stock_{pid}_{safe_vid}.txt"
 
+def _stock_stamp(filename):
+    try:
+        st = os.stat(filename)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+def _set_stock_count(filename, count):
+    _stock_counts[filename] = (count, _stock_stamp(filename))
+
+def _adjust_stock_count(filename, stamp_before, delta):
+    """Apply a change to a cached count if it was still valid before the change"""
+    cached = _stock_counts.get(filename)
+    if cached and cached[1] == stamp_before:
+        _set_stock_count(filename, cached[0] + delta)
+    else:
+        _stock_counts.pop(filename, None)
+
+def _remove_stock_file(filename):
+    for fname in (filename, f"{filename}.pos"):
+        if os.path.exists(fname):
+            os.remove(fname)
+    _stock_counts.pop(filename, None)
+
+def _write_stock_lines(filename, lines):
+    """Atomically replace a stock file with the given items (cursor reset to 0)"""
+    with _stock_lock(filename):
+        _replace_stock_lines(filename, lines)
+        _set_stock_count(filename, len(lines))
+
+def read_stock_lines(pid, vid):
+    """All unsold items of a variant"""
+    filename = get_stock_file(pid, vid)
+    with _stock_lock(filename):
+        if not os.path.exists(filename): return []
+        with open(filename, "rb") as f:
+            f.seek(_read_stock_offset(filename))
+            return [l.decode("utf-8").strip() for l in f if l.strip()]
+
 def get_stock_count(pid, vid):
     try:
         filename = get_stock_file(pid, vid)
-        if not os.path.exists(filename): return 0
-        with open(filename, "r") as f:
-            lines = [l for l in f.readlines() if l.strip()]
-        return len(lines)
+        with _stock_lock(filename):
+            stamp = _stock_stamp(filename)
+            if stamp is None: return 0
+            cached = _stock_counts.get(filename)
+            if cached and cached[1] == stamp:
+                return cached[0]
+            count = len(read_stock_lines(pid, vid))
+            _set_stock_count(filename, count)
+            return count
     except Exception as e:
         logging.error(f"Error getting stock count: {e}")
         return 0
 
+def get_product_stock(pid, available=False):
+    """{vid: count} for every variant of a product (available: minus held items)"""
+    products = load_products()
+    count = get_available_stock if available else get_stock_count
+    return {vid: count(pid, vid) for vid in products.get(pid, {}).get('variants', {})}
+
+def get_all_stock():
+    """{(pid, vid): count} for the whole catalog"""
+    products = load_products()
+    return {(pid, vid): get_stock_count(pid, vid) for pid, p in products.items() for vid in p['variants']}
+
+def verify_stock_counts():
+    """Recount every variant from its file; returns [(pid, vid, cached, actual)] mismatches"""
+    mismatches = []
+    products = load_products()
+    for pid in sorted(products.keys(), key=lambda x: int(x)):
+        for vid in products[pid]['variants']:
+            filename = get_stock_file(pid, vid)
+            with _stock_lock(filename):
+                cached = _stock_counts.get(filename, (None,))[0]
+                actual = len(read_stock_lines(pid, vid))
+                if os.path.exists(filename):
+                    _set_stock_count(filename, actual)
+                if cached is not None and cached != actual:
+                    mismatches.append((pid, vid, cached, actual))
+    return mismatches
+
 def add_stock(pid, vid, content):
     try:
         filename = get_stock_file(pid, vid)
-        with open(filename, "a") as f:
-            f.write(f"{content}\n")
+        with _stock_lock(filename):
+            stamp = _stock_stamp(filename)
+            with open(filename, "a") as f:
+                f.write(f"{content}\n")
+            if stamp is None:
+                _set_stock_count(filename, 1 if str(content).strip() else 0)
+            else:
+                _adjust_stock_count(filename, stamp, 1 if str(content).strip() else 0)
     except Exception as e:
         logging.error(f"Error adding stock: {e}")
 
+def add_stock_lines(pid, vid, lines):
+    count = 0
+    for line in lines:
+        if line.strip(): add_stock(pid, vid, line.strip()); count += 1
+    return count
+
 def clear_stock(pid, vid):
     filename = get_stock_file(pid, vid)
-    if os.path.exists(filename):
-        os.remove(filename)
+    with _stock_lock(filename):
+        _remove_stock_file(filename)
+
+def remove_stock_item(pid, vid, item):
+    """Delete one specific item; returns the remaining count or None if not found"""
+    filename = get_stock_file(pid, vid)
+    with _stock_lock(filename):
+        lines = read_stock_lines(pid, vid)
+        if item not in lines:
+            return None
+        lines.remove(item)
+        _write_stock_lines(filename, lines)
+        return len(lines)
+
+def _peek_stock(filename, qty):
+    """(cursor, next qty items, cursor after them) without taking anything"""
+    offset = _read_stock_offset(filename)
+    accounts = []
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        while len(accounts) < qty:
+            line = f.readline()
+            if not line: break
+            if line.strip(): accounts.append(line.decode("utf-8").strip())
+        return offset, accounts, f.tell()
 
 def get_accounts(pid, vid, qty):
     try:
         filename = get_stock_file(pid, vid)
         logging.info(f"[GET ACCOUNTS] Looking for stock file: {filename}")
-        if not os.path.exists(filename):
-            logging.warning(f"[GET ACCOUNTS] Stock file NOT found: {filename}")
-            return None
-        
-        with open(filename, "r") as f:
-            lines = f.readlines()
-        
-        logging.info(f"[GET ACCOUNTS] Stock file has {len(lines)} lines")
-        valid = [l for l in lines if l.strip()]
-        logging.info(f"[GET ACCOUNTS] Valid lines after filtering: {len(valid)}")
-        
-        if len(valid) < qty:
-            logging.warning(f"[GET ACCOUNTS] Not enough valid accounts. Need {qty}, have {len(valid)}")
-            return None
-        
-        accounts = [line.strip() for line in valid[:qty]]
-        logging.info(f"[GET ACCOUNTS] Got {len(accounts)} accounts, remaining: {len(valid) - qty}")
-        
-        with open(filename, "w") as f:
-            f.writelines(valid[qty:])
+        with _stock_lock(filename):
+            if not os.path.exists(filename):
+                logging.warning(f"[GET ACCOUNTS] Stock file NOT found: {filename}")
+                return None
+            
+            # Only read the next `qty` items after the cursor
+            offset, accounts, new_offset = _peek_stock(filename, qty)
+            
+            if len(accounts) < qty:
+                logging.warning(f"[GET ACCOUNTS] Not enough valid accounts. Need {qty}, have {len(accounts)}")
+                return None
+            
+            _write_stock_offset(filename, new_offset)
+            _adjust_stock_count(filename, _stock_stamp(filename), -qty)
         
-        logging.info(f"[GET ACCOUNTS] Successfully returned {len(accounts)} accounts")
+        logging.info(f"[GET ACCOUNTS] Successfully returned {len(accounts)} accounts (cursor {offset} -> {new_offset})")
         return accounts
     except Exception as e:
         logging.error(f"[GET ACCOUNTS] Error getting accounts: {e}")
         return None
 
+# --- STOCK HOLDS ---
+# Issuing a QR reserves its items until the order is paid, cancelled or
+# expires, so two buyers are never shown a QR for the same last item.
+# Per stock file: {hold_id: (qty, expires_at)} in insertion order plus the held
+# total. Holds share one TTL, so insertion order is expiry order and expired
+# holds are dropped from the front - every call is O(1) amortised.
+_holds = {}
+_held = {}
+
+def _purge_holds(filename, now):
+    holds = _holds.get(filename)
+    while holds:
+        hold_id, (qty, expires_at) = next(iter(holds.items()))
+        if expires_at > now: break
+        del holds[hold_id]
+        _held[filename] -= qty
+        logging.info(f"[STOCK HOLD] {hold_id} expired ({qty} pcs released)")
+
+def _drop_hold(filename, hold_id):
+    hold = _holds.get(filename, {}).pop(hold_id, None)
+    if hold:
+        _held[filename] -= hold[0]
+    return hold
+
+def get_available_stock(pid, vid):
+    """Unsold items not held by an open QR"""
+    filename = get_stock_file(pid, vid)
+    with _stock_lock(filename):
+        _purge_holds(filename, time.time())
+        return max(0, get_stock_count(pid, vid) - _held.get(filename, 0))
+
+def reserve_stock(pid, vid, qty, hold_id, ttl=STOCK_HOLD_TTL, force=False):
+    """Hold qty items for an order; False if not enough are available (force: hold anyway)"""
+    filename = get_stock_file(pid, vid)
+    with _stock_lock(filename):
+        now = time.time()
+        _purge_holds(filename, now)
+        if not force and get_stock_count(pid, vid) - _held.get(filename, 0) < qty:
+            return False
+        _drop_hold(filename, hold_id)
+        _holds.setdefault(filename, {})[hold_id] = (qty, now + ttl)
+        _held[filename] = _held.get(filename, 0) + qty
+        return True
+
+def release_stock(pid, vid, hold_id):
+    """Give a cancelled / expired order's items back"""
+    filename = get_stock_file(pid, vid)
+    with _stock_lock(filename):
+        if _drop_hold(filename, hold_id):
+            logging.info(f"[STOCK HOLD] {hold_id} released")
+
+def commit_stock(pid, vid, qty, hold_id):
+    """Turn a paid order's hold into the actual items (get_accounts)"""
+    filename = get_stock_file(pid, vid)
+    with _stock_lock(filename):
+        _drop_hold(filename, hold_id)
+        return get_accounts(pid, vid, qty)
+
+def restore_stock_holds(orders):
+    """Re-hold stock for orders the payment poller resumed after a restart"""
+    now = time.time()
+    for order in orders:
+        ttl = max(0.0, order['expires_at'] - now) + (STOCK_HOLD_TTL - PAYMENT_TIMEOUT)
+        reserve_stock(order['pid'], order['vid'], order['qty'], order_hold_id(order), ttl=ttl, force=True)
+
+def order_hold_id(order):
+    # Orders saved before bill numbers existed are held under their md5
+    return order.get('bill_number') or order['md5']
+
+def compact_stock_file(filename):
+    """Drop the already-sold prefix of a stock file once it gets large"""
+    with _stock_lock(filename):
+        if not os.path.exists(filename): return False
+        offset = _read_stock_offset(filename)
+        if offset < STOCK_COMPACT_BYTES: return False
+        size = os.path.getsize(filename)
+        tmp_file = f"{filename}.tmp"
+        with open(filename, "rb") as src, open(tmp_file, "wb") as dst:
+            src.seek(offset)
+            dst.write(src.read())
+        # Another process (admin panel / API) appended meanwhile; try next round
+        stamp = _stock_stamp(filename)
+        if stamp[1] != size:
+            os.remove(tmp_file)
+            return False
+        os.replace(tmp_file, filename)
+        _write_stock_offset(filename, 0)
+        _adjust_stock_count(filename, stamp, 0)
+    logging.info(f"[STOCK COMPACT] {filename}: dropped {offset} sold bytes")
+    return True
+
+def compact_stock_files():
+    compacted = 0
+    for fname in os.listdir(DB_FOLDER):
+        if fname.startswith("stock_") and fname.endswith(".txt"):
+            try:
+                if compact_stock_file(f"{DB_FOLDER}/{fname}"): compacted += 1
+            except Exception as e:
+                logging.error(f"[STOCK COMPACT] Failed for {fname}: {e}")
+    return compacted
+
+def _stock_compactor():
+    while True:
+        time.sleep(STOCK_COMPACT_INTERVAL)
+        compact_stock_files()
+
+def export_stock_data(pid, vid, prod_name, vname):
+    """Write database/datastock_<pid>_<vid>.txt; returns (file bytes, item count)"""
+    accounts = read_stock_lines(pid, vid)
+    if not accounts:
+        return None, 0
+    
+    output_file = f"{DB_FOLDER}/datastock_{pid}_{vid}.txt"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write(f"=" * 50 + "\n")
+        f.write(f"Product: {prod_name}\n")
+        f.write(f"Variant: {vname}\n")
+        f.write(f"Total Stock: {len(accounts)}\n")
+        f.write(f"=" * 50 + "\n\n")
+        
+        for idx, account in enumerate(accounts, 1):
+            f.write(f"{idx}. {account}\n")
+    
+    with open(output_file, 'rb') as f:
+        return f.read(), len(accounts)
+
+def build_backup_archive():
+    """tar.gz of the database folder, built in memory"""
+    import io
+    import tarfile
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        tar.add(DB_FOLDER, arcname="database")
+    return buf.getvalue()
+
 def delete_product_files(pid):
     products = load_products()
     if pid in products:
         for vid in products[pid]['variants']:
-            fname = get_stock_file(pid, vid)
-            if os.path.exists(fname):
-                os.remove(fname)
+            clear_stock(pid, vid)
+
+def add_product_variant(name, var_name, price, desc):
+    with _catalog_write_lock:
+        products = load_products_for_update()
+        pid = next((k for k, v in products.items() if v['name'].lower() == name.lower()), None)
+        if not pid:
+            pid = str(max([int(k) for k in products.keys()] or [0]) + 1)
+            products[pid] = {"name": name, "desc": desc, "sold": 0, "variants": {}}
+        vid = var_name.replace(" ", "").upper()[:3]
+        products[pid]['variants'][vid] = {"name": var_name, "price": price}
+        save_products(products)
+        return pid, vid
+
+def set_variant_tutorial(pid, vid, link):
+    with _catalog_write_lock:
+        products = load_products_for_update()
+        if vid not in products.get(pid, {}).get('variants', {}):
+            return False
+        products[pid]['variants'][vid]['tutorial'] = link
+        save_products(products)
+        return True
+
+def delete_product(pid):
+    with _catalog_write_lock:
+        products = load_products_for_update()
+        if pid in products:
+            delete_product_files(pid); del products[pid]; save_products(products); reindex_products()
+
+def delete_variant(pid, vid):
+    with _catalog_write_lock:
+        products = load_products_for_update()
+        if pid in products and vid in products[pid]['variants']:
+            clear_stock(pid, vid); del products[pid]['variants'][vid]; save_products(products)
 
 def reindex_products():
-    products = load_products()
+    products = load_products_for_update()
     new_products = {}
     sorted_keys = sorted(products.keys(), key=lambda x: int(x))
     
@@ -323,23 +710,31 @@ def reindex_products():
         new_f = get_stock_file(new_id, vid)
         if os.path.exists(old_f):
             try:
-                with open(old_f, 'r') as f: content = f.read()
-                with open(new_f, 'w') as f: f.write(content)
-                os.remove(old_f)
+                _write_stock_lines(new_f, read_stock_lines(old_id, vid))
+                clear_stock(old_id, vid)
             except: pass
             
     save_products(new_products)
 
 # --- 2. QR GENERATOR ---
-def generate_qr_data(amount):
+async def generate_qr_data(amount, bill_number=None):
     """Generate official Bakong KHQR code for Cambodia payments"""
+    # Each order gets its own bill number, so equal amounts never share a QR / md5
+    bill_number = bill_number or new_bill_number()
     # If a proxy is configured (must be hosted in Cambodia), use it to create QR
-    if BAKONG_PROXY_URL and requests:
+    if bakong_proxy and BAKONG_LOCAL_QR:
         try:
-            payload = {"amount": amount, "bank_account": BAKONG_ACCOUNT, "merchant_name": MERCHANT_NAME}
-            resp = requests.post(f"{BAKONG_PROXY_URL.rstrip('/')}/create_qr", json=payload, timeout=15)
-            resp.raise_for_status()
-            data = resp.json()
+            qr_code, md5 = build_proxy_khqr(BAKONG_ACCOUNT, MERCHANT_NAME, amount, bill_number=bill_number)
+            logging.info(f"[KHQR GENERATED] Official Bakong KHQR built locally - Amount: ${amount}, MD5: {md5}")
+            return qr_code, md5
+        except Exception as e:
+            logging.error(f"[KHQR ERROR] Failed to build KHQR locally: {e}")
+            return None, None
+
+    if bakong_proxy:
+        try:
+            payload = {"amount": amount, "bank_account": BAKONG_ACCOUNT, "merchant_name": MERCHANT_NAME, "bill_number": bill_number}
+            data = await bakong_proxy.create_qr(payload)
             logging.info(f"[KHQR GENERATED] Official Bakong KHQR via Proxy - Amount: ${amount}")
             return data.get("qr_code"), data.get("md5")
         except Exception as e:
@@ -347,99 +742,50 @@ def generate_qr_data(amount):
             return None, None
 
     if khqr and BAKONG_TOKEN:
-        try:
-            # Generate official Bakong KHQR code
-            qr_code = khqr.create_qr(
-                bank_account=BAKONG_ACCOUNT, 
-                merchant_name=MERCHANT_NAME, 
-                merchant_city="Phnom Penh",
-                amount=amount, 
-                currency="USD", 
-                store_label="TelegramStore", 
-                phone_number="85512345678",
-                bill_number=f"INV{datetime.now().strftime('%Y%m%d%H%M%S')}", 
-                terminal_label="TeleBot"
-            )
-            md5 = khqr.generate_md5(qr_code)
-            logging.info(f"[KHQR GENERATED] Official Bakong KHQR - Amount: ${amount}, MD5: {md5}")
-            return qr_code, md5
-        except Exception as e:
-            logging.error(f"[KHQR ERROR] Failed to generate KHQR: {e}")
-            return None, None
+        return await run_blocking(create_direct_khqr, amount, bill_number)
 
     # No valid KHQR method available
     logging.error(f"[QR FAILED] No valid KHQR configuration available!")
     return None, None
 
-def create_styled_qr(qr_data, amount):
-    """Create Bakong KHQR image with official green color"""
-    possible_paths = [TEMPLATE_FILE, f"/storage/emulated/0/Download/{TEMPLATE_FILE}"]
-    found_path = None
-    for p in possible_paths:
-        if os.path.exists(p): found_path = p; break
-    
-    # Generate basic KHQR image if no template
-    if not found_path:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        # Official Bakong green color
-        img = qr.make_image(fill_color="#107c42", back_color="white")
-        fname = f"qr_{random.randint(1000,9999)}.png"
-        img.save(fname)
-        logging.info(f"[QR IMAGE] Generated basic Bakong KHQR image: {fname}")
-        return fname
-
+def create_direct_khqr(amount, bill_number):
+    """Build the KHQR locally with the bakong_khqr package (direct mode)"""
     try:
-        # Create styled KHQR with template
-        card = Image.open(found_path).convert("RGBA")
-        W, H = card.size
-        qr = qrcode.QRCode(box_size=20, border=0) 
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        # Official Bakong green color (#107c42)
-        qr_img = qr.make_image(fill_color="#107c42", back_color="white").convert("RGBA")
-        
-        qr_target_size = int(W * 0.55)
-        qr_img = qr_img.resize((qr_target_size, qr_target_size), Image.LANCZOS) 
-        pos_x = (W - qr_target_size) // 2; pos_y = (H - qr_target_size) // 2
-        card.paste(qr_img, (pos_x, pos_y))
-        
-        draw = ImageDraw.Draw(card)
-        try: font = ImageFont.truetype("/system/fonts/Roboto-Bold.ttf", 60)
-        except: font = ImageFont.load_default()
-            
-        text = f"${amount:.2f}"
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_w = bbox[2] - bbox[0]
-        text_x = (W - text_w) // 2
-        text_y = pos_y + qr_target_size + 30
-        
-        for off in [(-2,-2), (-2,2), (2,-2), (2,2)]:
-            draw.text((text_x+off[0], text_y+off[1]), text, font=font, fill="black")
-        draw.text((text_x, text_y), text, font=font, fill="white")
-        
-        filename = f"qr_card_{random.randint(1000,9999)}.png"
-        card.save(filename) 
-        return filename
+        # Generate official Bakong KHQR code
+        qr_code = khqr.create_qr(
+            bank_account=BAKONG_ACCOUNT, 
+            merchant_name=MERCHANT_NAME, 
+            merchant_city="Phnom Penh",
+            amount=amount, 
+            currency="USD", 
+            store_label="TelegramStore", 
+            phone_number="85512345678",
+            bill_number=bill_number, 
+            terminal_label="TeleBot"
+        )
+        md5 = khqr.generate_md5(qr_code)
+        logging.info(f"[KHQR GENERATED] Official Bakong KHQR - Amount: ${amount}, MD5: {md5}")
+        return qr_code, md5
     except Exception as e:
-        print(f"QR Error: {e}")
-        img = qrcode.make(qr_data)
-        fname = f"qr_basic_{random.randint(1000,9999)}.png"
-        img.save(fname)
-        return fname
+        logging.error(f"[KHQR ERROR] Failed to generate KHQR: {e}")
+        return None, None
+
+# Template and font are decoded once; cards are encoded straight to memory.
+# With QR_RENDER_WORKERS > 0 they are rendered in a process pool instead.
+qr_template_paths = [TEMPLATE_FILE, f"/storage/emulated/0/Download/{TEMPLATE_FILE}"]
+qr_output = ImageOutput(QR_IMAGE_FORMAT, QR_IMAGE_WIDTH, QR_IMAGE_QUALITY, QR_IMAGE_MAX_KB * 1024)
+qr_renderer = QRCardRenderer(qr_template_paths, output=qr_output)
+qr_pool = QRRenderPool(qr_template_paths, QR_RENDER_WORKERS, QR_RENDER_QUEUE, output=qr_output) if QR_RENDER_WORKERS > 0 else None
 
-def safe_check_payment(md5):
+def create_styled_qr(qr_data, amount):
+    """Bakong KHQR card (official green), encoded as QR_IMAGE_FORMAT"""
+    return (qr_pool or qr_renderer).render(qr_data, amount)
+
+async def safe_check_payment(md5):
     # If proxy is configured, ask proxy to check payment (proxy should be in Cambodia)
-    if BAKONG_PROXY_URL and requests:
+    if bakong_proxy:
         try:
-            resp = requests.get(f"{BAKONG_PROXY_URL.rstrip('/')}/check/{md5}", timeout=15)
-            data = resp.json()
+            data = await bakong_proxy.check(md5)
             logging.info(f"[PROXY KHQR CHECK] MD5={md5}, Result={data}")
             return data
         except Exception as e:
@@ -447,174 +793,262 @@ def safe_check_payment(md5):
             return None
 
     if khqr:
-        try:
-            result = khqr.check_payment(md5)
-            logging.info(f"[KHQR CHECK] MD5={md5}, Result={result}")
-            return result
-        except Exception as e:
-            error_msg = str(e)
-            logging.error(f"[KHQR CHECK] Error checking payment for MD5={md5}: {e}")
-            
-            # Check if it's an IP restriction error
-            if "IP" in error_msg.upper() or "403" in error_msg or "FORBIDDEN" in error_msg.upper():
-                logging.error("[KHQR IP BLOCK] Bakong API blocked this IP! You need Cambodia IP or use BAKONG_PROXY_URL")
-            
-            return None
+        return await run_blocking(check_direct_khqr, md5)
     
     logging.error("[KHQR CHECK] No payment method configured (no KHQR or Proxy)")
     return None
 
+def check_direct_khqr(md5):
+    """Ask the Bakong API directly (needs a Cambodia IP)"""
+    try:
+        result = khqr.check_payment(md5)
+        logging.info(f"[KHQR CHECK] MD5={md5}, Result={result}")
+        return result
+    except Exception as e:
+        error_msg = str(e)
+        logging.error(f"[KHQR CHECK] Error checking payment for MD5={md5}: {e}")
+        
+        # Check if it's an IP restriction error
+        if "IP" in error_msg.upper() or "403" in error_msg or "FORBIDDEN" in error_msg.upper():
+            logging.error("[KHQR IP BLOCK] Bakong API blocked this IP! You need Cambodia IP or use BAKONG_PROXY_URL")
+        
+        return None
+
 def generate_trx_id():
     date_str = datetime.now().strftime("%d%m%Y")
     random_str = ''.join(random.choices(string.ascii_uppercase, k=5))
     return f"DZPREM-{date_str}-{random_str}"
 
-# --- 3. BACKGROUND PAYMENT LOOP ---
-async def check_payment_loop(update, context, md5_hash, qr_msg_id, pid, vid, qty):
-    chat_id = update.effective_chat.id
-    loop = asyncio.get_running_loop()
-    products = load_products()
+# --- 3. BACKGROUND PAYMENT POLLER ---
+def is_payment_confirmed(response):
+    """True if a Bakong / proxy check response means the QR was paid"""
+    if str(response).strip().upper() == "PAID": 
+        logging.info(f"[PAYMENT CHECK] Payment detected as PAID (string response)")
+        return True
+    if isinstance(response, dict) and response.get('responseCode') == 0: 
+        logging.info(f"[PAYMENT CHECK] Payment confirmed via responseCode=0 (dict response)")
+        return True
+    if isinstance(response, dict) and (response.get('data') or {}).get('responseCode') == 0:
+        logging.info(f"[PAYMENT CHECK] Payment confirmed via data.responseCode=0")
+        return True
+    return False
+
+async def check_payment_paid(md5_hash):
+    response = await safe_check_payment(md5_hash)
+    return is_payment_confirmed(response)
+
+async def check_payments_batch(md5_list):
+    """{md5: paid} through the proxy's /check_batch; None if the proxy doesn't offer it"""
+    if not bakong_proxy or not await bakong_proxy.supports("check_batch"):
+        return None
+    batch_max = (await bakong_proxy.features())["batch_max"]
+    paid = {}
+    try:
+        for i in range(0, len(md5_list), batch_max):
+            results = await bakong_proxy.check_batch(md5_list[i:i + batch_max])
+            paid.update({md5: is_payment_confirmed(results.get(md5)) for md5 in md5_list[i:i + batch_max]})
+    except Exception as e:
+        logging.error(f"[PROXY KHQR CHECK] Batch check of {len(md5_list)} failed: {e}")
+        # Maybe an older proxy after a redeploy; look at /health again next time
+        bakong_proxy.forget_features()
+        return None
+    logging.info(f"[PROXY KHQR CHECK] Batch of {len(md5_list)}: {sum(paid.values())} paid")
+    return paid
+
+def take_order_stock(order, entry=None):
+    """commit_stock for a paid order, journaled so a crash mid-take never takes its items twice
+
+    Where the items start (cursor and file inode) is journaled as "taking"
+    before the cursor moves. Replaying a "taking" entry returns those items
+    if the cursor already got past them, and only takes stock if it did not.
+    """
+    pid, vid, qty = order['pid'], order['vid'], order['qty']
+    filename = get_stock_file(pid, vid)
+    with _stock_lock(filename):
+        if entry and entry['state'] == 'taking' and _stock_taken(filename, pid, vid, entry['stock']):
+            _drop_hold(filename, order_hold_id(order))
+            logging.info(f"[GET ACCOUNTS] md5={order['md5']} items were taken before the restart")
+            return entry['stock']['accounts']
+        if os.path.exists(filename):
+            offset, accounts, _ = _peek_stock(filename, qty)
+            if len(accounts) == qty:
+                delivery_journal.taking(order['md5'], {"offset": offset, "ino": os.stat(filename).st_ino, "accounts": accounts})
+        return commit_stock(pid, vid, qty, order_hold_id(order))
+
+def _stock_taken(filename, pid, vid, stock):
+    """Whether the cursor moved past the items a "taking" entry recorded"""
+    try:
+        ino = os.stat(filename).st_ino
+    except FileNotFoundError:
+        return True
+    if ino == stock['ino']:
+        return _read_stock_offset(filename) > stock['offset']
+    # Rewritten since (compaction / admin edit): taken unless still unsold
+    unsold = set(read_stock_lines(pid, vid))
+    return not any(acc in unsold for acc in stock['accounts'])
+
+def claim_delivery(order):
+    """Journal a paid order before the poller drops it from the pending store; False if claimed before"""
+    return delivery_journal.begin(order['md5'], order)
+
+async def deliver_order(bot, order):
+    """Deliver a paid order the poller has claimed in the delivery journal"""
+    logging.info(f"[PAYMENT SUCCESS] Processing confirmed payment md5={order['md5']}")
+    await complete_delivery(bot, order)
+
+async def complete_delivery(bot, order, entry=None):
+    """Pull stock, record the sale and message the buyer
+
+    entry is the journal entry when finishing a delivery after a restart; if
+    its accounts were already taken they are re-sent rather than taken again.
+    """
+    chat_id = order['chat_id']; qr_msg_id = order['qr_msg_id']
+    pid, vid, qty = order['pid'], order['vid'], order['qty']
+    md5 = order['md5']
+    
+    try: 
+        await bot.delete_message(chat_id, qr_msg_id)
+        logging.info(f"[PAYMENT SUCCESS] QR message deleted")
+    except Exception as e: 
+        logging.error(f"[PAYMENT SUCCESS] Could not delete QR message: {e}")
+
+    products = await run_blocking(load_products)
+    prod_name = products.get(pid, {}).get('name', 'Unknown')
+    var_name = products.get(pid, {}).get('variants', {}).get(vid, {}).get('name', 'Unknown')
+    price = products.get(pid, {}).get('variants', {}).get(vid, {}).get('price', 0)
+    total = price * qty
+
+    if entry and entry['state'] == 'taken':
+        accounts, trx_id = entry['accounts'], entry['trx_id']
+        logging.info(f"[PAYMENT SUCCESS] Re-sending journaled accounts for md5={md5}")
+    else:
+        accounts = await run_blocking(take_order_stock, order, entry)
+        trx_id = generate_trx_id()
+        await run_blocking(delivery_journal.taken, md5, accounts, trx_id)
+        if accounts:
+            await run_blocking(update_user_spent, chat_id, total, order['username'], pid)
+            await run_blocking(add_product_sold, pid, qty)
     
-    logging.info(f"[PAYMENT CHECK] Started for md5={md5_hash}, qr_msg_id={qr_msg_id}, product={pid}, variant={vid}, qty={qty}")
+    logging.info(f"[PAYMENT SUCCESS] Got accounts: {accounts}")
 
-    for attempt in range(120):  # Check for 10 minutes (120 * 5 seconds)
-        await asyncio.sleep(5)  # Wait 5 seconds before checking
-        
-        try:
-            # Check if KHQR is available (not in testing mode)
-            if not khqr and not BAKONG_PROXY_URL:
-                logging.error(f"[PAYMENT CHECK] KHQR not initialized! Cannot verify payment. MD5={md5_hash}")
-                try:
-                    await context.bot.edit_message_caption(
-                        chat_id, qr_msg_id, 
-                        caption="[ERROR] Payment system not configured properly. Please contact admin."
-                    )
-                except:
-                    pass
-                return
-            
-            # Verify payment through KHQR or Proxy
-            response = await loop.run_in_executor(None, safe_check_payment, md5_hash)
-            logging.info(f"[PAYMENT CHECK] Attempt {attempt+1}/120: Response = {response}")
+    if accounts:
+        logging.info(f"[PAYMENT SUCCESS] Processing {len(accounts)} accounts")
+
+        acc_text = ""
+        # Build detailed account text with emojis and tutorial link
+        tutorial_url = products.get(pid, {}).get('variants', {}).get(vid, {}).get('tutorial')
+        for i, acc in enumerate(accounts):
+            acc_text += f"\n📦 **Item Details #{i+1}**\n"
+            acc_text += "- - - - - - - - - - - - - - - - - - - - - -\n"
             
-            is_paid = False
+            if "," in acc:
+                parts = [p.strip() for p in acc.split(",")]
+                email = parts[0] if len(parts) > 0 else "N/A"
+                password = parts[1] if len(parts) > 1 else "N/A"
+                details_parts = parts[2:]
+            else:
+                parts = [acc.strip()]
+                email = parts[0]
+                password = "N/A"
+                details_parts = []
+
+            acc_text += f"💌 : `{email}`\n"
+            acc_text += f"🔑 : `{password}`\n\n"
             
-            # Check response format
-            if str(response).strip().upper() == "PAID": 
-                is_paid = True
-                logging.info(f"[PAYMENT CHECK] Payment detected as PAID (string response)")
-            elif isinstance(response, dict) and response.get('responseCode') == 0: 
-                is_paid = True
-                logging.info(f"[PAYMENT CHECK] Payment confirmed via responseCode=0 (dict response)")
-            elif isinstance(response, dict) and response.get('data', {}).get('responseCode') == 0:
-                is_paid = True
-                logging.info(f"[PAYMENT CHECK] Payment confirmed via data.responseCode=0")
-
-            if is_paid:
-                logging.info(f"[PAYMENT SUCCESS] Processing confirmed payment")
-                try: 
-                    await context.bot.delete_message(chat_id, qr_msg_id)
-                    logging.info(f"[PAYMENT SUCCESS] QR message deleted")
-                except Exception as e: 
-                    logging.error(f"[PAYMENT SUCCESS] Could not delete QR message: {e}")
-
-                accounts = get_accounts(pid, vid, qty)
-                prod_name = products.get(pid, {}).get('name', 'Unknown')
-                var_name = products.get(pid, {}).get('variants', {}).get(vid, {}).get('name', 'Unknown')
-                price = products.get(pid, {}).get('variants', {}).get(vid, {}).get('price', 0)
-                total = price * qty
-                trx_id = generate_trx_id()
-                
-                logging.info(f"[PAYMENT SUCCESS] Got accounts: {accounts}")
-
-                if accounts:
-                    logging.info(f"[PAYMENT SUCCESS] Processing {len(accounts)} accounts")
-                    username = update.effective_user.username if update.effective_user.username else f"user_{chat_id}"
-                    update_user_spent(chat_id, total, username)
-                    if pid in products:
-                        products[pid]['sold'] = products[pid].get('sold', 0) + qty
-                        save_products(products)
-
-                    acc_text = ""
-                    # Build detailed account text with emojis and tutorial link
-                    tutorial_url = products.get(pid, {}).get('variants', {}).get(vid, {}).get('tutorial')
-                    for i, acc in enumerate(accounts):
-                        acc_text += f"\n📦 **Item Details #{i+1}**\n"
-                        acc_text += "- - - - - - - - - - - - - - - - - - - - - -\n"
-                        
-                        if "," in acc:
-                            parts = [p.strip() for p in acc.split(",")]
-                            email = parts[0] if len(parts) > 0 else "N/A"
-                            password = parts[1] if len(parts) > 1 else "N/A"
-                            details_parts = parts[2:]
-                        else:
-                            parts = [acc.strip()]
-                            email = parts[0]
-                            password = "N/A"
-                            details_parts = []
-
-                        acc_text += f"💌 : `{email}`\n"
-                        acc_text += f"🔑 : `{password}`\n\n"
-                        
-                        if details_parts:
-                            acc_text += "**More Info** ...\n\n"
-                            for detail in details_parts:
-                                acc_text += f"{detail}\n"
-                            acc_text += "\n"
-
-                        # Add tutorial link if set for this variant
-                        if tutorial_url:
-                            acc_text += f"📚 [Tutorial Sign In]({tutorial_url})\n"
-                        acc_text += "\n"
-
-                    text = (
-                        "[OK] PAYMENT CONFIRMED\n"
-                        "Thank you, your payment has been received!\n\n"
-                        "Order Details:\n"
-                        "= = = = = = = = = = = = = = = = = = = = = =\n"
-                        f"Product: {prod_name}\n"
-                        f"Variant: {var_name}\n"
-                        f"Quantity: x{qty}\n"
-                        f"Total: ${total:.2f}\n"
-                        "= = = = = = = = = = = = = = = = = = = = = =\n"
-                        f"{acc_text}\n"
-                        f"Transaction ID: `{trx_id}`"
-                    )
-                    logging.info(f"[PAYMENT SUCCESS] Accounts found and message prepared")
-                else:
-                    logging.warning(f"[PAYMENT SUCCESS] No accounts found! get_accounts returned None")
-                    text = f"[OK] PAID\n[ALERT] OUT OF STOCK!\nAdmin notified."
-                    try:
-                        await context.bot.send_message(ADMIN_ID, f"[ALERT] OOS: {prod_name} ({qty} pcs) Paid but empty!")
-                        logging.info(f"[PAYMENT SUCCESS] Out of stock alert sent to admin")
-                    except Exception as e:
-                        logging.error(f"[PAYMENT SUCCESS] Failed to notify admin: {e}")
+            if details_parts:
+                acc_text += "**More Info** ...\n\n"
+                for detail in details_parts:
+                    acc_text += f"{detail}\n"
+                acc_text += "\n"
 
-                try:
-                    await context.bot.send_message(chat_id, text, parse_mode='Markdown', disable_web_page_preview=False)
-                    logging.info(f"[PAYMENT SUCCESS] Confirmation message sent to user")
-                except Exception as e:
-                    logging.error(f"[PAYMENT SUCCESS] Failed to send confirmation: {e}")
-                    # Try sending without markdown if it fails
-                    try:
-                        await context.bot.send_message(chat_id, text)
-                        logging.info(f"[PAYMENT SUCCESS] Confirmation sent (plain text fallback)")
-                    except Exception as e2:
-                        logging.error(f"[PAYMENT SUCCESS] Failed to send even with fallback: {e2}")
-                return
+            # Add tutorial link if set for this variant
+            if tutorial_url:
+                acc_text += f"📚 [Tutorial Sign In]({tutorial_url})\n"
+            acc_text += "\n"
+
+        text = (
+            "[OK] PAYMENT CONFIRMED\n"
+            "Thank you, your payment has been received!\n\n"
+            "Order Details:\n"
+            "= = = = = = = = = = = = = = = = = = = = = =\n"
+            f"Product: {prod_name}\n"
+            f"Variant: {var_name}\n"
+            f"Quantity: x{qty}\n"
+            f"Total: ${total:.2f}\n"
+            "= = = = = = = = = = = = = = = = = = = = = =\n"
+            f"{acc_text}\n"
+            f"Transaction ID: `{trx_id}`"
+        )
+        logging.info(f"[PAYMENT SUCCESS] Accounts found and message prepared")
+    else:
+        logging.warning(f"[PAYMENT SUCCESS] No accounts found! get_accounts returned None")
+        text = f"[OK] PAID\n[ALERT] OUT OF STOCK!\nAdmin notified."
+        try:
+            await bot.send_message(ADMIN_ID, f"[ALERT] OOS: {prod_name} ({qty} pcs) Paid but empty!")
+            logging.info(f"[PAYMENT SUCCESS] Out of stock alert sent to admin")
         except Exception as e:
-            logging.error(f"[PAYMENT CHECK] Error in loop iteration {attempt+1}: {e}")
+            logging.error(f"[PAYMENT SUCCESS] Failed to notify admin: {e}")
 
-    # Timeout - no payment received
+    try:
+        await bot.send_message(chat_id, text, parse_mode='Markdown', disable_web_page_preview=False)
+        logging.info(f"[PAYMENT SUCCESS] Confirmation message sent to user")
+    except Forbidden as e:
+        # Buyer blocked the bot; retrying on every restart would not help
+        logging.error(f"[PAYMENT SUCCESS] Buyer unreachable: {e}")
+    except Exception as e:
+        logging.error(f"[PAYMENT SUCCESS] Failed to send confirmation: {e}")
+        # Try sending without markdown if it fails
+        try:
+            await bot.send_message(chat_id, text)
+            logging.info(f"[PAYMENT SUCCESS] Confirmation sent (plain text fallback)")
+        except Exception as e2:
+            logging.error(f"[PAYMENT SUCCESS] Failed to send even with fallback: {e2}")
+            # Left unfinished in the journal; resent on next startup
+            return
+    await run_blocking(delivery_journal.done, md5)
+
+async def replay_deliveries(bot):
+    """Finish deliveries a crash / restart interrupted (see delivery_journal.py)"""
+    for entry in await run_blocking(delivery_journal.unfinished):
+        logging.warning(f"[DELIVERY] Resuming md5={entry['md5']} from state {entry['state']}")
+        try:
+            await complete_delivery(bot, entry['order'], entry)
+        except Exception as e:
+            logging.error(f"[DELIVERY] Resume failed for md5={entry['md5']}: {e}")
+
+async def expire_order(bot, order):
+    """Timeout - no payment received"""
+    await run_blocking(release_stock, order['pid'], order['vid'], order_hold_id(order))
     try: 
-        await context.bot.edit_message_caption(
-            chat_id, qr_msg_id, 
+        await bot.edit_message_caption(
+            order['chat_id'], order['qr_msg_id'], 
             caption="[EXPIRED] Payment timeout after 10 minutes.\n\nNo payment was detected. Please try again or contact admin if you already paid."
         )
-        logging.warning(f"[PAYMENT TIMEOUT] No payment received after 10 minutes for MD5={md5_hash}")
+        logging.warning(f"[PAYMENT TIMEOUT] No payment received after 10 minutes for MD5={order['md5']}")
     except Exception as e:
         logging.error(f"[PAYMENT TIMEOUT] Failed to update timeout message: {e}")
 
+# Single scheduler for every open QR: checks run in rounds, paced per order by
+# PAYMENT_CHECK_SCHEDULE, at most PAYMENT_CHECK_CONCURRENCY at a time. Proxies
+# that advertise check_batch on /health get each round's orders in batches.
+# Which attempt caught each payment is kept in payment_stats.json (/paystats).
+# Open orders are mirrored to pending_payments.json and resumed after a restart.
+payment_stats = PaymentStats(PAYMENT_STATS_FILE)
+payment_stats.load()
+# Paid orders pass through deliveries.jsonl so each md5 is delivered once
+pending_store = PendingStore(PENDING_PAYMENTS_FILE)
+# A paid order's done entry is needed only while its payment can be confirmed again
+delivery_journal = DeliveryJournal(DELIVERY_JOURNAL_FILE, retention=PAYMENT_TIMEOUT, keep=pending_store.load)
+delivery_journal.load()
+payment_poller = PaymentPoller(
+    check_payment_paid, deliver_order, expire_order,
+    check_batch=check_payments_batch, batch_size=PAYMENT_CHECK_BATCH_SIZE,
+    schedule=PAYMENT_CHECK_SCHEDULE, timeout=PAYMENT_TIMEOUT,
+    concurrency=PAYMENT_CHECK_CONCURRENCY, final_check_lead=PAYMENT_FINAL_CHECK_LEAD,
+    stats=payment_stats, executor=io_executor,
+    store=pending_store, claim=claim_delivery
+)
+
 # --- 4. UI HANDLERS ---
 
 async def cmd_forceconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -640,7 +1074,7 @@ async def cmd_forceconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Quantity must be a number")
             return
 
-        products = load_products()
+        products = await run_blocking(load_products)
         if pid not in products:
             await update.message.reply_text(f"Product {pid} not found")
             return
@@ -651,13 +1085,15 @@ async def cmd_forceconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"Variant {vid} not found for product {pid}")
             return
 
-        stock = get_stock_count(pid, vid)
-        if stock < qty:
-            await update.message.reply_text(f"Not enough stock: have {stock}, need {qty}")
+        # Through a hold like a real checkout, so items held for open QRs are left alone
+        hold_id = f"force-{secrets.token_hex(4)}"
+        if not await run_blocking(reserve_stock, pid, vid, qty, hold_id):
+            stock = await run_blocking(get_available_stock, pid, vid)
+            await update.message.reply_text(f"Not enough stock: {stock} available (not held by open orders), need {qty}")
             return
 
         # Pull accounts and deliver
-        accounts = get_accounts(pid, vid, qty)
+        accounts = await run_blocking(commit_stock, pid, vid, qty, hold_id)
         if not accounts:
             await update.message.reply_text("No accounts available to deliver")
             return
@@ -666,9 +1102,8 @@ async def cmd_forceconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
         total = var.get('price', 0) * qty
         username = update.effective_user.username if update.effective_user.username else f"user_{chat_id}"
-        update_user_spent(chat_id, total, username)
-        products[pid]['sold'] = products[pid].get('sold', 0) + qty
-        save_products(products)
+        await run_blocking(update_user_spent, chat_id, total, username, pid)
+        await run_blocking(add_product_sold, pid, qty)
 
         # Build message identical to normal delivery
         acc_text = ""
@@ -729,13 +1164,13 @@ async def cmd_forceconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     username = user.username if user.username else f"user_{user.id}"
-    user_data = get_user_data(user.id, username)
+    user_data = await run_blocking(get_user_data, user.id, username)
     
     now = datetime.now().strftime("%A, %d %B %Y %H:%M:%S")
-    sold = get_total_sold()
+    sold = await run_blocking(get_total_sold)
     total_users = get_total_users()
     
-    raw_welcome = get_config("welcome")
+    raw_welcome = await run_blocking(get_config, "welcome")
     
     if raw_welcome == "default":
          welcome_text = (
@@ -760,48 +1195,122 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user.id == ADMIN_ID: keyboard.append(["🛠 Admin Panel"])
     markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    banner = get_config("banner_welcome")
+    banner = await run_blocking(get_config, "banner_welcome")
     if banner:
         try: await update.message.reply_photo(banner, caption=welcome_text, reply_markup=markup, parse_mode='Markdown')
         except: await update.message.reply_text(welcome_text, reply_markup=markup, parse_mode='Markdown')
     else:
         await update.message.reply_text(welcome_text, reply_markup=markup, parse_mode='Markdown')
 
+# Rendered list / product screens as (text, markup) - both immutable, so one
+# object is shared by every tap. Keyed by what they are built from: the
+# catalog version, plus each variant's in/out-of-stock state for view screens.
+# Admin and customer screens are cached separately.
+_screens = {}
+
+def _cached_screen(key, version, build):
+    cached = _screens.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    screen = build()
+    _screens[key] = (version, screen)
+    return screen
+
+# Product ids in display order plus each id's position, rebuilt only when the
+# catalog version changes: (version, pids, {pid: index})
+_pid_index = {"current": (None, (), {})}
+
+def product_index():
+    version = catalog_version()
+    current = _pid_index["current"]
+    if current[0] != version:
+        pids = tuple(sorted(load_products().keys(), key=lambda x: int(x)))
+        current = (version, pids, {pid: i for i, pid in enumerate(pids)})
+        _pid_index["current"] = current
+    return current
+
+def page_of(pid):
+    """List page a product is on (1-based)"""
+    return product_index()[2].get(pid, 0) // PRODUCTS_PAGE_SIZE + 1
+
+def render_product_list(page=1, is_admin=False):
+    """(text, markup) of one page of the product list"""
+    version, pids, _ = product_index()
+    pages = max(1, -(-len(pids) // PRODUCTS_PAGE_SIZE))
+    page = min(max(1, page), pages)
+    
+    def build():
+        products = load_products()
+        list_text = f"╭ - - - - - - - - - - - - - - - - - - - ╮\n┊  **PRODUCT LIST**\n┊  _page {page} / {pages}_\n┊- - - - - - - - - - - - - - - - - - - - -\n"
+        keyboard = []; row = []
+        
+        start = (page - 1) * PRODUCTS_PAGE_SIZE
+        for pid in pids[start:start + PRODUCTS_PAGE_SIZE]:
+            data = products[pid]
+            list_text += f"┊ [{pid}] {data['name'].upper()}\n"
+            row.append(InlineKeyboardButton(f"{pid}", callback_data=f"view_{pid}"))
+            if len(row) == 4: keyboard.append(row); row = []
+        if row: keyboard.append(row)
+        if pages > 1:
+            nav = []
+            if page > 1: nav.append(InlineKeyboardButton("« Prev", callback_data=f"list_{page - 1}"))
+            nav.append(InlineKeyboardButton(f"{page} / {pages}", callback_data="noop"))
+            if page < pages: nav.append(InlineKeyboardButton("Next »", callback_data=f"list_{page + 1}"))
+            keyboard.append(nav)
+        list_text += "╰ - - - - - - - - - - - - - - - - - - - ╯"
+        return list_text, InlineKeyboardMarkup(keyboard)
+    return _cached_screen(("list", page, is_admin), version, build)
+
+def render_product_view(pid, is_admin=False):
+    """(text, markup) of one product's variant screen, or None if it does not exist"""
+    version = catalog_version()
+    products = load_products()
+    if pid not in products: return None
+    in_stock = tuple(count > 0 for count in get_product_stock(pid, True).values())
+    
+    def build():
+        prod = products[pid]
+        text = f"╭ - - - - - - - - - - - - - - - - - - - ╮\n┊ • **Product:** {prod['name']}\n┊ • **Sold:** {prod['sold']} pcs\n┊ • **Desc:** {prod['desc']}\n╰ - - - - - - - - - - - - - - - - - - - ╯\n╭ - - - - - - - - - - - - - - - - - - - ╮\n┊ **Select Variation:**\n"
+        keyboard = []
+        if is_admin:
+             keyboard.append([InlineKeyboardButton("🗑 DELETE PRODUCT", callback_data=f"delprod_{pid}")])
+        for (vid, var), available in zip(prod['variants'].items(), in_stock):
+            status = "🟢" if available else "🔴"
+            tutorial_icon = "📚" if var.get('tutorial') else "➕"
+            text += f"┊ • {var['name']} (${var['price']:.2f}) - {status}\n"
+            row = [InlineKeyboardButton(f"{var['name']} - ${var['price']:.2f}", callback_data=f"confirm_{pid}_{vid}_1")]
+            if is_admin:
+                row.append(InlineKeyboardButton("🗑", callback_data=f"delvar_{pid}_{vid}"))
+                row.append(InlineKeyboardButton(f"{tutorial_icon}", callback_data=f"tutorial_{pid}_{vid}"))
+            keyboard.append(row)
+        text += "╰ - - - - - - - - - - - - - - - - - - - ╯"
+        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data=f"list_{page_of(pid)}")])
+        return text, InlineKeyboardMarkup(keyboard)
+    return _cached_screen(("view", pid, is_admin), (version, in_stock), build)
+
 async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Register user if not already registered
     user = update.effective_user
     username = user.username if user.username else f"user_{user.id}"
-    get_user_data(user.id, username)
-    
-    products = load_products()
-    list_text = "╭ - - - - - - - - - - - - - - - - - - - ╮\n┊  **PRODUCT LIST**\n┊  _page 1 / 1_\n┊- - - - - - - - - - - - - - - - - - - - -\n"
-    keyboard = []; row = []
+    await run_blocking(get_user_data, user.id, username)
     
-    sorted_pids = sorted(products.keys(), key=lambda x: int(x))
-
-    for pid in sorted_pids:
-        data = products[pid]
-        list_text += f"┊ [{pid}] {data['name'].upper()}\n"
-        row.append(InlineKeyboardButton(f"{pid}", callback_data=f"view_{pid}"))
-        if len(row) == 4: keyboard.append(row); row = []
-    if row: keyboard.append(row)
-    list_text += "╰ - - - - - - - - - - - - - - - - - - - ╯"
-    markup = InlineKeyboardMarkup(keyboard)
+    list_text, markup = await run_blocking(render_product_list, 1, user.id == ADMIN_ID)
     
-    banner = get_config("banner_products")
+    banner = await run_blocking(get_config, "banner_products")
     if banner:
         try: await update.message.reply_photo(banner, caption=list_text, reply_markup=markup, parse_mode='Markdown')
         except: await update.message.reply_text(list_text, reply_markup=markup, parse_mode='Markdown')
     else: await update.message.reply_text(list_text, reply_markup=markup, parse_mode='Markdown')
 
 async def show_stock_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    products = load_products()
+    products = await run_blocking(load_products)
+    stock = await run_blocking(get_all_stock)
     msg = "**PRODUCT STOCK REPORT**\n╭ - - - - - - - - - - - - - - - - - - - - - ╮\n"
     has = False
     for pid in sorted(products.keys(), key=lambda x: int(x)):
         p = products[pid]
         for vid, v in p['variants'].items():
-            count = get_stock_count(pid, vid); icon = "✅" if count > 0 else "❌"
+            count = stock.get((pid, vid), 0); icon = "✅" if count > 0 else "❌"
             msg += f"┊ {icon} {p['name']} {v['name']} : {count}x\n"; has = True
     if not has: msg += "┊ No products.\n"
     msg += "╰ - - - - - - - - - - - - - - - - - - - - - ╯"
@@ -819,13 +1328,13 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Register user on any interaction
     user = update.effective_user
     username = user.username if user.username else f"user_{user.id}"
-    get_user_data(user.id, username)
+    await run_blocking(get_user_data, user.id, username)
     
     if callback_data.startswith("stock"): 
         logging.info("Stock action detected, returning")
         return 
 
-    products = load_products()
+    products = await run_blocking(load_products)
     
     # Parse the callback data
     if callback_data == "back_list":
@@ -839,25 +1348,9 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if action == "view":
         pid = data[1]
-        if pid not in products: return
-        prod = products[pid]
-        text = f"╭ - - - - - - - - - - - - - - - - - - - ╮\n┊ • **Product:** {prod['name']}\n┊ • **Sold:** {prod['sold']} pcs\n┊ • **Desc:** {prod['desc']}\n╰ - - - - - - - - - - - - - - - - - - - ╯\n╭ - - - - - - - - - - - - - - - - - - - ╮\n┊ **Select Variation:**\n"
-        keyboard = []
-        if query.from_user.id == ADMIN_ID:
-             keyboard.append([InlineKeyboardButton("🗑 DELETE PRODUCT", callback_data=f"delprod_{pid}")])
-        for vid, var in prod['variants'].items():
-            stock = get_stock_count(pid, vid)
-            status = "🟢" if stock > 0 else "🔴"
-            tutorial_icon = "📚" if var.get('tutorial') else "➕"
-            text += f"┊ • {var['name']} (${var['price']:.2f}) - {status}\n"
-            row = [InlineKeyboardButton(f"{var['name']} - ${var['price']:.2f}", callback_data=f"confirm_{pid}_{vid}_1")]
-            if query.from_user.id == ADMIN_ID:
-                row.append(InlineKeyboardButton("🗑", callback_data=f"delvar_{pid}_{vid}"))
-                row.append(InlineKeyboardButton(f"{tutorial_icon}", callback_data=f"tutorial_{pid}_{vid}"))
-            keyboard.append(row)
-        text += "╰ - - - - - - - - - - - - - - - - - - - ╯"
-        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_list")])
-        markup = InlineKeyboardMarkup(keyboard)
+        screen = await run_blocking(render_product_view, pid, query.from_user.id == ADMIN_ID)
+        if not screen: return
+        text, markup = screen
         try:
             if query.message.photo: await query.edit_message_caption(caption=text, reply_markup=markup, parse_mode='Markdown')
             else: await query.edit_message_text(text=text, reply_markup=markup, parse_mode='Markdown')
@@ -870,7 +1363,6 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         vid = data[2]
         context.user_data['tutorial_pid'] = pid
         context.user_data['tutorial_vid'] = vid
-        products = load_products()
         prod_name = products.get(pid, {}).get('name', 'Unknown')
         var_name = products.get(pid, {}).get('variants', {}).get(vid, {}).get('name', 'Unknown')
         current_tutorial = products.get(pid, {}).get('variants', {}).get(vid, {}).get('tutorial', 'Not set')
@@ -885,21 +1377,10 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             pass
 
-    elif action == "back_list":
-        products = load_products()
-        list_text = "╭ - - - - - - - - - - - - - - - - - - - ╮\n┊  **PRODUCT LIST**\n┊  _page 1 / 1_\n┊- - - - - - - - - - - - - - - - - - - - -\n"
-        keyboard = []; row = []
-        
-        sorted_pids = sorted(products.keys(), key=lambda x: int(x))
-
-        for pid in sorted_pids:
-            prod_data = products[pid]
-            list_text += f"┊ [{pid}] {prod_data['name'].upper()}\n"
-            row.append(InlineKeyboardButton(f"{pid}", callback_data=f"view_{pid}"))
-            if len(row) == 4: keyboard.append(row); row = []
-        if row: keyboard.append(row)
-        list_text += "╰ - - - - - - - - - - - - - - - - - - - ╯"
-        markup = InlineKeyboardMarkup(keyboard)
+    elif action in ("back_list", "list"):
+        # back_list: buttons on messages sent before the list had pages
+        page = int(data[1]) if action == "list" and len(data) > 1 and data[1].isdigit() else 1
+        list_text, markup = await run_blocking(render_product_list, page, query.from_user.id == ADMIN_ID)
         
         try:
             if query.message.photo:
@@ -913,7 +1394,7 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif action == "confirm":
         if len(data) < 4: return
         pid, vid, qty = data[1], data[2], int(data[3])
-        prod = products[pid]; var = prod['variants'][vid]; stock = get_stock_count(pid, vid)
+        prod = products[pid]; var = prod['variants'][vid]; stock = await run_blocking(get_available_stock, pid, vid)
         
         if qty > stock and stock > 0:
              await query.answer(f"⚠️ Max available is {stock}", show_alert=True)
@@ -936,6 +1417,10 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except: pass
 
     elif action == "cancel":
+        if len(data) > 1:
+            order = payment_poller.cancel(data[1], chat_id=query.message.chat_id)
+            if order:
+                await run_blocking(release_stock, order['pid'], order['vid'], order_hold_id(order))
         try: await query.message.delete(); await context.bot.send_message(query.message.chat_id, "❌ Order Cancelled.", parse_mode='Markdown')
         except: pass
 
@@ -943,74 +1428,96 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if len(data) < 4: return
         pid, vid, qty = data[1], data[2], int(data[3])
         prod = products[pid]; var = prod['variants'][vid]; total = var['price'] * qty
-        if get_stock_count(pid, vid) < qty:
+        # Hold the items now; released on cancel / expiry, taken on payment
+        bill_number = new_bill_number()
+        if not await run_blocking(reserve_stock, pid, vid, qty, bill_number):
             await query.message.reply_text("❌ **Sold Out!** Please check back later.", parse_mode='Markdown'); return
         
-        await query.message.reply_text(f"⏳ Generating Bakong KHQR code...")
-        qr_text, md5 = generate_qr_data(total)
+        try:
+            await query.message.reply_text(f"⏳ Generating Bakong KHQR code...")
+            qr_text, md5 = await generate_qr_data(total, bill_number)
         
-        # Check if QR generation failed
-        if not qr_text or not md5:
-            error_msg = (
-                "❌ **Payment System Error**\n\n"
-                "Unable to generate KHQR payment code.\n"
-                "This usually means:\n"
-                "• BAKONG_TOKEN is not configured\n"
-                "• BAKONG_PROXY_URL is not working\n\n"
-                f"Please contact admin: {ADMIN_USERNAME}"
-            )
-            await query.message.reply_text(error_msg, parse_mode='Markdown')
-            
-            # Notify admin
-            try:
-                await context.bot.send_message(
-                    ADMIN_ID, 
-                    f"⚠️ KHQR Generation Failed!\n"
-                    f"User: {query.from_user.id}\n"
-                    f"Product: {prod['name']}\n"
-                    f"Amount: ${total}\n\n"
-                    f"Check BAKONG_TOKEN or BAKONG_PROXY_URL configuration!"
+            # Check if QR generation failed
+            if not qr_text or not md5:
+                await run_blocking(release_stock, pid, vid, bill_number)
+                error_msg = (
+                    "❌ **Payment System Error**\n\n"
+                    "Unable to generate KHQR payment code.\n"
+                    "This usually means:\n"
+                    "• BAKONG_TOKEN is not configured\n"
+                    "• BAKONG_PROXY_URL is not working\n\n"
+                    f"Please contact admin: {ADMIN_USERNAME}"
                 )
-            except:
-                pass
-            return
+                await query.message.reply_text(error_msg, parse_mode='Markdown')
+            
+                # Notify admin
+                try:
+                    await context.bot.send_message(
+                        ADMIN_ID, 
+                        f"⚠️ KHQR Generation Failed!\n"
+                        f"User: {query.from_user.id}\n"
+                        f"Product: {prod['name']}\n"
+                        f"Amount: ${total}\n\n"
+                        f"Check BAKONG_TOKEN or BAKONG_PROXY_URL configuration!"
+                    )
+                except:
+                    pass
+                return
         
-        filename = create_styled_qr(qr_text, total)
-        markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel Transaction", callback_data="cancel")]])
+            photo = await run_blocking(create_styled_qr, qr_text, total)
+            markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel Transaction", callback_data=f"cancel_{md5}")]])
         
-        caption = (
-            f"💳 **BAKONG KHQR PAYMENT**\n"
-            f"Amount: **${total:.2f}**\n"
-            f"Product: {prod['name']} x{qty}\n\n"
-            f"🇰🇭 Scan with any Bakong app:\n"
-            f"• ABA Mobile\n"
-            f"• Wing Money\n"
-            f"• TrueMoney\n"
-            f"• Pi Pay\n"
-            f"• Any bank app with Bakong\n\n"
-            f"⏳ _Waiting for payment..._"
-        )
+            caption = (
+                f"💳 **BAKONG KHQR PAYMENT**\n"
+                f"Amount: **${total:.2f}**\n"
+                f"Product: {prod['name']} x{qty}\n\n"
+                f"🇰🇭 Scan with any Bakong app:\n"
+                f"• ABA Mobile\n"
+                f"• Wing Money\n"
+                f"• TrueMoney\n"
+                f"• Pi Pay\n"
+                f"• Any bank app with Bakong\n\n"
+                f"⏳ _Waiting for payment..._"
+            )
         
-        msg = await query.message.reply_photo(
-            photo=open(filename, 'rb'), 
-            caption=caption,
-            parse_mode='Markdown', 
-            reply_markup=markup
-        )
-        os.remove(filename)
-        asyncio.create_task(check_payment_loop(update, context, md5, msg.message_id, pid, vid, qty))
+            username = query.from_user.username if query.from_user.username else f"user_{query.message.chat_id}"
+            # Watched before it is shown: a QR the buyer can pay is never untracked
+            payment_poller.register(md5, {
+                "chat_id": query.message.chat_id, "qr_msg_id": None,
+                "pid": pid, "vid": vid, "qty": qty, "username": username,
+                "bill_number": bill_number
+            })
+            try:
+                msg = await query.message.reply_photo(
+                    photo=photo, 
+                    caption=caption,
+                    parse_mode='Markdown', 
+                    reply_markup=markup
+                )
+            except TimedOut:
+                # The photo may have arrived anyway; the order keeps its hold and expires normally
+                logging.warning(f"[PAYMENT] Sending the QR for md5={md5} timed out, still watching it")
+                return
+            except Exception:
+                payment_poller.cancel(md5)
+                raise
+            payment_poller.update(md5, qr_msg_id=msg.message_id)
+        except Exception:
+            # Nothing else releases the hold until it expires
+            await run_blocking(release_stock, pid, vid, bill_number)
+            raise
 
     elif action == "delprod":
         pid = data[1]
         if query.from_user.id != ADMIN_ID: return
-        delete_product_files(pid); del products[pid]; reindex_products()
+        await run_blocking(delete_product, pid)
         await query.message.delete(); await context.bot.send_message(query.message.chat_id, f"🗑 Product {pid} Deleted."); await show_products(update, context)
 
     elif action == "delvar":
         pid, vid = data[1], data[2]
         if query.from_user.id != ADMIN_ID: return
         if pid in products and vid in products[pid]['variants']:
-            clear_stock(pid, vid); del products[pid]['variants'][vid]; save_products(products)
+            await run_blocking(delete_variant, pid, vid)
             await context.bot.send_message(query.message.chat_id, f"🗑 Variant {vid} Deleted."); await show_products(update, context)
 
     elif action == "tutprod":
@@ -1048,7 +1555,7 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def start_add_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return ConversationHandler.END
-    products = load_products()
+    products = await run_blocking(load_products)
     if not products: await update.message.reply_text("❌ No products."); return ConversationHandler.END
     keyboard = []
     for pid in sorted(products.keys(), key=lambda x: int(x)):
@@ -1063,7 +1570,7 @@ async def select_product_callback(update: Update, context: ContextTypes.DEFAULT_
     if query.data == "stock_cancel": await query.message.edit_text("❌ Cancelled."); return ConversationHandler.END
     pid = query.data.split("_")[2]
     context.user_data['stock_pid'] = pid
-    products = load_products(); prod = products[pid]
+    products = await run_blocking(load_products); prod = products[pid]
     keyboard = []
     for vid, var in prod['variants'].items():
         keyboard.append([InlineKeyboardButton(f"{var['name']}", callback_data=f"stock_var_{vid}")])
@@ -1084,9 +1591,8 @@ async def receive_stock_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
     pid = context.user_data.get('stock_pid')
     vid = context.user_data.get('stock_vid')
     text = update.message.text
-    lines = text.split('\n'); count = 0
-    for line in lines:
-        if line.strip(): add_stock(pid, vid, line.strip()); count += 1
+    lines = text.split('\n')
+    count = await run_blocking(add_stock_lines, pid, vid, lines)
     await update.message.reply_text(f"✅ **Success!** Added {count} items.", parse_mode='Markdown')
     return ConversationHandler.END
 
@@ -1121,27 +1627,36 @@ async def cmd_add_product_easy(update: Update, context: ContextTypes.DEFAULT_TYP
             await update.message.reply_text("❌ Price must be a valid number.", parse_mode='Markdown')
             return
         
-        products = load_products()
-        pid = next((k for k, v in products.items() if v['name'].lower() == name.lower()), None)
-        if not pid:
-            pid = str(max([int(k) for k in products.keys()] or [0]) + 1)
-            products[pid] = {"name": name, "desc": desc, "sold": 0, "variants": {}}
-        vid = var_name.replace(" ", "").upper()[:3]
-        products[pid]['variants'][vid] = {"name": var_name, "price": price}
-        save_products(products)
+        await run_blocking(add_product_variant, name, var_name, price, desc)
         await update.message.reply_text(f"✅ Added! **{name}** ({var_name}) - ${price:.2f}", parse_mode='Markdown')
     except Exception as e:
         logging.error(f"Error adding product: {e}")
         await update.message.reply_text(f"❌ Error: {e}")
 
 # ==================== BROADCAST (New Version) ====================
+# One bucket for every broadcast, so two running at once still share Telegram's limit
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+
 async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start broadcast - ask admin to send message"""
     if update.effective_user.id != ADMIN_ID: return ConversationHandler.END
     
+    try:
+        context.user_data['broadcast_segment'] = parse_segment(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ {e}\n\n"
+            "Usage: `/broadcast [bought:<pid>] [spent:<usd>] [active:<days>] [joined:<days>] [user:@a,@b] [nobuy]`\n"
+            "e.g. `/broadcast bought:3 active:30` - buyers of product 3 seen this month",
+            parse_mode='Markdown'
+        )
+        return ConversationHandler.END
+    target = " ".join(context.args) if context.args else "all users"
+    
     await update.message.reply_text(
         "📢 *Broadcast Message*\n\n"
-        "Send me the message you want to broadcast to all users.\n\n"
+        f"Target: {target}\n\n"
+        "Send me the message you want to broadcast.\n\n"
         "You can send:\n"
         "• Text message\n"
         "• Photo with caption\n"
@@ -1159,7 +1674,7 @@ async def broadcast_receive_msg(update: Update, context: ContextTypes.DEFAULT_TY
     context.user_data['broadcast_photo'] = msg.photo[-1].file_id if msg.photo else None
     context.user_data['broadcast_document'] = msg.document.file_id if msg.document else None
     
-    users = get_all_users()
+    users = await run_blocking(get_segment_users, context.user_data.get('broadcast_segment'))
     
     preview = context.user_data['broadcast_text'] or "[Media]"
     if len(preview) > 100:
@@ -1180,38 +1695,112 @@ async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Broadcast cancelled.")
         return ConversationHandler.END
     
-    users = get_all_users()
-    text = context.user_data.get('broadcast_text', '')
-    photo = context.user_data.get('broadcast_photo')
-    document = context.user_data.get('broadcast_document')
-    
-    await update.message.reply_text(f"📢 Broadcasting to {len(users)} users...")
-    
-    success = 0
-    failed = 0
+    users = await run_blocking(get_segment_users, context.user_data.get('broadcast_segment'))
+    message = {
+        "text": context.user_data.get('broadcast_text', ''),
+        "photo": context.user_data.get('broadcast_photo'),
+        "document": context.user_data.get('broadcast_document'),
+    }
     
-    for uid in users:
+    status = await update.message.reply_text(f"📢 Broadcasting to {len(users)} users...")
+    job = await run_blocking(BroadcastJob.create, BROADCAST_JOBS_FOLDER, message, users,
+                             {"status_chat": status.chat_id, "status_msg": status.message_id})
+    # Runs in the background so the bot keeps answering while it sends
+    start_broadcast(context.bot, job)
+    return ConversationHandler.END
+
+# Running broadcasts. Not started with application.create_task: Application.stop()
+# waits for those, and a big broadcast would hold up shutdown for minutes.
+broadcast_tasks = set()
+
+def start_broadcast(bot, job):
+    task = asyncio.create_task(run_broadcast(bot, job))
+    broadcast_tasks.add(task)
+    task.add_done_callback(_broadcast_done)
+    return task
+
+def _broadcast_done(task):
+    broadcast_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error(f"[BROADCAST] Broadcast failed: {task.exception()}")
+
+async def stop_broadcasts():
+    """Cancel running broadcasts on shutdown; their job log lets them resume on the next start"""
+    for task in list(broadcast_tasks):
+        task.cancel()
+    for task in list(broadcast_tasks):
         try:
-            if photo:
-                await context.bot.send_photo(uid, photo, caption=f"📢 *NOTICE*\n\n{text}", parse_mode='Markdown')
-            elif document:
-                await context.bot.send_document(uid, document, caption=f"📢 *NOTICE*\n\n{text}", parse_mode='Markdown')
-            else:
-                await context.bot.send_message(uid, f"📢 *NOTICE*\n\n{text}", parse_mode='Markdown')
-            success += 1
+            await task
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
-            logging.warning(f"Failed to send to {uid}: {e}")
-            failed += 1
+            logging.error(f"[BROADCAST] Broadcast failed while stopping: {e}")
+
+async def run_broadcast(bot, job):
+    """Send (or resume) a broadcast job, editing its status message with progress"""
+    message = job.message
+    caption = f"📢 *NOTICE*\n\n{message['text']}"
+    status_chat, status_msg = job.extra.get("status_chat"), job.extra.get("status_msg")
+    
+    async def send(uid):
+        if message['photo']:
+            await bot.send_photo(uid, message['photo'], caption=caption, parse_mode='Markdown')
+        elif message['document']:
+            await bot.send_document(uid, message['document'], caption=caption, parse_mode='Markdown')
+        else:
+            await bot.send_message(uid, caption, parse_mode='Markdown')
     
-    await update.message.reply_text(f"✅ Broadcast complete!\n\nSent: {success}\nFailed: {failed}")
-    return ConversationHandler.END
+    async def show_progress(b):
+        if status_chat:
+            await bot.edit_message_text(b.progress_text(), status_chat, status_msg)
+    
+    async def flush_log():
+        # The job log is written off the event loop, once a second
+        while True:
+            await asyncio.sleep(1)
+            try:
+                await run_blocking(job.flush)
+            except Exception as e:
+                logging.error(f"[BROADCAST] Could not write job log {job.id}: {e}")
+    
+    broadcast = Broadcast(job.recipients, send, broadcast_bucket, concurrency=BROADCAST_CONCURRENCY,
+                          on_result=job.record, outcomes=job.outcomes)
+    flusher = asyncio.create_task(flush_log())
+    try:
+        await broadcast.run(on_progress=show_progress)
+    except asyncio.CancelledError:
+        # Shutting down: keep what was sent so the job resumes from here
+        job.close()
+        raise
+    finally:
+        flusher.cancel()
+    
+    # Blocked / deactivated users are skipped from now on (until they write to the bot again)
+    blocked = [uid for uid, outcome in broadcast.outcomes.items() if outcome == "blocked"]
+    try:
+        if blocked:
+            await run_blocking(user_registry.set_inactive, blocked)
+        await run_blocking(job.finish)
+    except Exception as e:
+        logging.error(f"[BROADCAST] Could not finish job {job.id}: {e}")
+    c = broadcast.counts
+    if status_chat:
+        await bot.send_message(status_chat, f"✅ Broadcast complete!\n\nSent: {c['sent']}\nBlocked: {c['blocked']}\nFailed: {c['failed']}",
+                               reply_to_message_id=status_msg)
+
+async def resume_broadcasts(app):
+    """Carry on with broadcasts a restart interrupted"""
+    for job in await run_blocking(BroadcastJob.unfinished, BROADCAST_JOBS_FOLDER):
+        logging.warning(f"[BROADCAST] Resuming job {job.id} at {len(job.outcomes)}/{len(job.recipients)}")
+        # Called from post_init, before the application runs: app.create_task would not track it
+        start_broadcast(app.bot, job)
 
 # ==================== DATA STOCK ====================
 async def cmd_datastock(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Export all stock to text files"""
     if update.effective_user.id != ADMIN_ID: return
     
-    products = load_products()
+    products = await run_blocking(load_products)
     
     if not products:
         await update.message.reply_text("❌ No products found.")
@@ -1222,39 +1811,19 @@ async def cmd_datastock(update: Update, context: ContextTypes.DEFAULT_TYPE):
     total_files = 0
     for pid, product in products.items():
         for vid, vname in product.get('variants', {}).items():
-            stock_file = f"{DB_FOLDER}/stock_{pid}_{vid}.txt"
-            
-            if not os.path.exists(stock_file):
-                continue
+            content, count = await run_blocking(export_stock_data, pid, vid, product['name'], vname)
             
-            # Read stock
-            with open(stock_file, 'r', encoding='utf-8') as f:
-                accounts = [line.strip() for line in f if line.strip()]
-            
-            if not accounts:
+            if not count:
                 continue
             
-            # Create detailed stock file
-            output_file = f"{DB_FOLDER}/datastock_{pid}_{vid}.txt"
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(f"=" * 50 + "\n")
-                f.write(f"Product: {product['name']}\n")
-                f.write(f"Variant: {vname}\n")
-                f.write(f"Total Stock: {len(accounts)}\n")
-                f.write(f"=" * 50 + "\n\n")
-                
-                for idx, account in enumerate(accounts, 1):
-                    f.write(f"{idx}. {account}\n")
-            
             # Send file to admin
-            with open(output_file, 'rb') as f:
-                await context.bot.send_document(
-                    update.effective_user.id,
-                    document=f,
-                    filename=f"{product['name']}_{vname}.txt",
-                    caption=f"📦 *{product['name']} - {vname}*\nStock: {len(accounts)}",
-                    parse_mode='Markdown'
-                )
+            await context.bot.send_document(
+                update.effective_user.id,
+                document=content,
+                filename=f"{product['name']}_{vname}.txt",
+                caption=f"📦 *{product['name']} - {vname}*\nStock: {count}",
+                parse_mode='Markdown'
+            )
             
             total_files += 1
     
@@ -1268,7 +1837,7 @@ async def cmd_deletestock(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start delete stock process"""
     if update.effective_user.id != ADMIN_ID: return ConversationHandler.END
     
-    products = load_products()
+    products = await run_blocking(load_products)
     if not products:
         await update.message.reply_text("❌ No products available.")
         return ConversationHandler.END
@@ -1299,7 +1868,7 @@ async def deletestock_select_product(update: Update, context: ContextTypes.DEFAU
     pid = query.data.replace("delstock_prod_", "")
     context.user_data['del_pid'] = pid
     
-    products = load_products()
+    products = await run_blocking(load_products)
     product = products.get(pid, {})
     variants = product.get('variants', {})
     
@@ -1307,9 +1876,10 @@ async def deletestock_select_product(update: Update, context: ContextTypes.DEFAU
         await query.edit_message_text("❌ No variants found.")
         return ConversationHandler.END
     
+    counts = await run_blocking(get_product_stock, pid)
     keyboard = []
     for vid, vname in variants.items():
-        count = get_stock_count(pid, vid)
+        count = counts.get(vid, 0)
         keyboard.append([InlineKeyboardButton(f"{vname} ({count} stock)", callback_data=f"delstock_var_{vid}")])
     
     keyboard.append([InlineKeyboardButton("❌ Cancel", callback_data="delstock_cancel")])
@@ -1335,18 +1905,12 @@ async def deletestock_select_variant(update: Update, context: ContextTypes.DEFAU
     context.user_data['del_vid'] = vid
     
     pid = context.user_data['del_pid']
-    products = load_products()
+    products = await run_blocking(load_products)
     product = products.get(pid, {})
     vname = product.get('variants', {}).get(vid, 'Unknown')
     
     # Get stock
-    stock_file = f"{DB_FOLDER}/stock_{pid}_{vid}.txt"
-    if not os.path.exists(stock_file):
-        await query.edit_message_text("❌ No stock available.")
-        return ConversationHandler.END
-    
-    with open(stock_file, 'r', encoding='utf-8') as f:
-        accounts = [line.strip() for line in f if line.strip()]
+    accounts = await run_blocking(read_stock_lines, pid, vid)
     
     if not accounts:
         await query.edit_message_text("❌ No stock available.")
@@ -1381,24 +1945,13 @@ async def deletestock_receive_item(update: Update, context: ContextTypes.DEFAULT
     vid = context.user_data['del_vid']
     item_to_delete = update.message.text.strip()
     
-    # Read stock
-    stock_file = f"{DB_FOLDER}/stock_{pid}_{vid}.txt"
-    with open(stock_file, 'r', encoding='utf-8') as f:
-        accounts = [line.strip() for line in f if line.strip()]
-    
     # Try to delete
-    if item_to_delete in accounts:
-        accounts.remove(item_to_delete)
-        
-        # Write back
-        with open(stock_file, 'w', encoding='utf-8') as f:
-            for acc in accounts:
-                f.write(acc + '\n')
-        
+    remaining = await run_blocking(remove_stock_item, pid, vid, item_to_delete)
+    if remaining is not None:
         count = context.user_data.get('deleted_count', 0)
         context.user_data['deleted_count'] = count + 1
         
-        await update.message.reply_text(f"✅ Deleted! Remaining: {len(accounts)}")
+        await update.message.reply_text(f"✅ Deleted! Remaining: {remaining}")
     else:
         await update.message.reply_text("❌ Item not found. Copy exact text.")
     
@@ -1419,7 +1972,7 @@ async def cmd_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     txn_id = " ".join(context.args)
     
-    users = get_user_data()
+    users = await run_blocking(user_registry.snapshot)
     found = False
     
     for uid, user_data in users.items():
@@ -1438,7 +1991,7 @@ async def cmd_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 msg += "📋 *Items Delivered:*\n"
                 
-                products = load_products()
+                products = await run_blocking(load_products)
                 items = order.get('items', [])
                 
                 for item in items:
@@ -1463,7 +2016,7 @@ async def cmd_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_tutorial(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Start interactive tutorial link setup for a product
     if update.effective_user.id != ADMIN_ID: return
-    products = load_products()
+    products = await run_blocking(load_products)
     if not products:
         await update.message.reply_text("❌ No products available.")
         return
@@ -1511,13 +2064,16 @@ async def cmd_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "`/tutorial` - Set tutorial links\n\n"
         "**Database & Stock:**\n"
         "`/viewstock` - View all stock\n"
+        "`/verifystock` - Rebuild stock counters\n"
+        "`/paystats` - Payment check statistics\n"
         "`/viewproducts` - View all products\n"
         "`/viewusers` - View all customers\n"
         "`/backup` - Backup database\n\n"
         "**Settings:**\n"
         "`/setbanner_welcome` - Set welcome banner (send photo)\n"
         "`/setbanner_products` - Set products banner (send photo)\n"
-        "`/broadcast` - Broadcast message\n\n"
+        "`/broadcast` - Broadcast message\n"
+        "`/broadcast bought:<pid> spent:<usd> active:<days> joined:<days> user:@a,@b nobuy` - To a segment\n\n"
         "**Testing:**\n"
         "`/testkhqr` - Test KHQR generation\n"
         "`/forceconfirm <pid> <vid> <qty>` - Force delivery", 
@@ -1532,7 +2088,7 @@ async def cmd_test_khqr(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Test with $0.01
     test_amount = 0.01
-    qr_text, md5 = generate_qr_data(test_amount)
+    qr_text, md5 = await generate_qr_data(test_amount)
     
     if not qr_text or not md5:
         error_msg = (
@@ -1556,7 +2112,7 @@ async def cmd_test_khqr(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Success - generate QR image
-    filename = create_styled_qr(qr_text, test_amount)
+    photo = await run_blocking(create_styled_qr, qr_text, test_amount)
     
     success_msg = (
         "✅ **KHQR Test SUCCESSFUL**\n\n"
@@ -1570,22 +2126,17 @@ async def cmd_test_khqr(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     await update.message.reply_photo(
-        photo=open(filename, 'rb'),
+        photo=photo,
         caption=success_msg,
         parse_mode='Markdown'
     )
-    
-    # Cleanup
-    try:
-        os.remove(filename)
-    except:
-        pass
 
 async def cmd_view_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """View all stock across all products"""
     if update.effective_user.id != ADMIN_ID: return
     
-    products = load_products()
+    products = await run_blocking(load_products)
+    stock = await run_blocking(get_all_stock)
     msg = "📦 **STOCK OVERVIEW**\n\n"
     total_items = 0
     
@@ -1593,7 +2144,7 @@ async def cmd_view_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
         p = products[pid]
         msg += f"**[{pid}] {p['name']}**\n"
         for vid, v in p['variants'].items():
-            count = get_stock_count(pid, vid)
+            count = stock.get((pid, vid), 0)
             total_items += count
             icon = "✅" if count > 0 else "❌"
             msg += f"  {icon} {v['name']}: `{count}` items\n"
@@ -1607,11 +2158,58 @@ async def cmd_view_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(msg, parse_mode='Markdown')
 
+async def cmd_verify_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Reconcile the cached stock counters against the stock files"""
+    if update.effective_user.id != ADMIN_ID: return
+    
+    mismatches = await run_blocking(verify_stock_counts)
+    if not mismatches:
+        await update.message.reply_text("✅ Stock counters match the stock files.")
+        return
+    
+    msg = f"⚠️ **Fixed {len(mismatches)} stock counters**\n\n"
+    for pid, vid, cached, actual in mismatches:
+        msg += f"• [{pid}] {vid}: `{cached}` → `{actual}`\n"
+    await update.message.reply_text(msg, parse_mode='Markdown')
+
+async def cmd_payment_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show when payments get detected, to tune PAYMENT_CHECK_SCHEDULE"""
+    if update.effective_user.id != ADMIN_ID: return
+    
+    if context.args and context.args[0].lower() == 'reset':
+        payment_stats.reset()
+        await run_blocking(payment_stats.save)
+        await update.message.reply_text("✅ Payment stats reset.")
+        return
+    
+    stats = payment_stats.data
+    paid = stats['paid']
+    schedule = ", ".join(f"<{int(u)}s every {i:g}s" for u, i in payment_poller.schedule)
+    msg = "📈 **PAYMENT CHECK STATS**\n\n"
+    msg += f"Since: {stats['since'][:19]}\n"
+    msg += f"Schedule: {schedule}\n"
+    msg += f"Pending now: {len(payment_poller)}\n\n"
+    msg += f"Checks: `{stats['checks']}`\n"
+    msg += f"Paid: `{paid}` | Expired: `{stats['expired']}` | Cancelled: `{stats['cancelled']}`\n"
+    if paid:
+        msg += f"Checks per paid order: `{stats['checks'] / paid:.1f}`\n"
+        msg += "\n**Paid within (order age):**\n"
+        running = 0
+        for age in sorted(stats['hit_age'], key=int):
+            running += stats['hit_age'][age]
+            msg += f"  {int(age) + PaymentStats.BUCKET}s: {running / paid * 100:.0f}%\n"
+        msg += "\n**Caught on attempt:**\n"
+        for attempt in sorted(stats['hit_attempt'], key=int)[:10]:
+            msg += f"  #{attempt}: {stats['hit_attempt'][attempt]}\n"
+    msg += "\n_Reset with_ `/paystats reset`"
+    
+    await update.message.reply_text(msg, parse_mode='Markdown')
+
 async def cmd_view_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """View all products with details"""
     if update.effective_user.id != ADMIN_ID: return
     
-    products = load_products()
+    products = await run_blocking(load_products)
     msg = "🛍 **PRODUCT DATABASE**\n\n"
     
     for pid in sorted(products.keys(), key=lambda x: int(x)):
@@ -1628,14 +2226,11 @@ async def cmd_view_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Send as file if too long
     if len(msg) > 4000:
-        with open('products_export.txt', 'w', encoding='utf-8') as f:
-            f.write(msg)
         await update.message.reply_document(
-            document=open('products_export.txt', 'rb'),
+            document=msg.encode('utf-8'),
             filename='products.txt',
             caption="📄 Product list (too long for message)"
         )
-        os.remove('products_export.txt')
     else:
         await update.message.reply_text(msg, parse_mode='Markdown')
 
@@ -1644,13 +2239,11 @@ async def cmd_view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
     
     try:
-        if not os.path.exists(USERS_FILE):
+        users = await run_blocking(user_registry.snapshot)
+        if not users:
             await update.message.reply_text("No users found yet.")
             return
         
-        with open(USERS_FILE, 'r') as f:
-            users = json.load(f)
-        
         # Check if username provided
         if context.args:
             search_username = context.args[0].replace('@', '').lower()
@@ -1691,7 +2284,7 @@ async def cmd_view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg += f"💰 Total Revenue: ${total_revenue:.2f}\n\n"
         
         # Sort by spending
-        sorted_users = sorted(users.items(), key=lambda x: x[1].get('spent', 0), reverse=True)
+        sorted_users = await run_blocking(sorted, users.items(), key=lambda x: x[1].get('spent', 0), reverse=True)
         
         msg += "**Top 10 Customers:**\n"
         for i, (uid, data) in enumerate(sorted_users[:10], 1):
@@ -1713,26 +2306,19 @@ async def cmd_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔄 Creating backup...")
     
     try:
-        import tarfile
-        from datetime import datetime
-        
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         backup_name = f"backup_{timestamp}.tar.gz"
         
         # Create tar.gz backup
-        with tarfile.open(backup_name, "w:gz") as tar:
-            tar.add(DB_FOLDER, arcname="database")
+        backup = await run_blocking(build_backup_archive)
         
         # Send backup file
         await update.message.reply_document(
-            document=open(backup_name, 'rb'),
+            document=backup,
             filename=backup_name,
             caption=f"✅ Database backup created\n{timestamp}\n\nDownload and store safely!"
         )
         
-        # Cleanup
-        os.remove(backup_name)
-        
     except Exception as e:
         await update.message.reply_text(f"❌ Backup failed: {e}")
 
@@ -1744,7 +2330,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Register user on any interaction
     user = update.effective_user
     username = user.username if user.username else f"user_{user.id}"
-    get_user_data(user.id, username)
+    await run_blocking(get_user_data, user.id, username)
     
     # Get text from message
     text = update.message.text if update.message.text else ""
@@ -1761,10 +2347,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             file_id = photo.file_id
             
             if banner_type == 'welcome':
-                update_config('banner_welcome', file_id)
+                await run_blocking(update_config, 'banner_welcome', file_id)
                 await update.message.reply_text("✅ Welcome banner updated successfully!")
             elif banner_type == 'products':
-                update_config('banner_products', file_id)
+                await run_blocking(update_config, 'banner_products', file_id)
                 await update.message.reply_text("✅ Products banner updated successfully!")
             
             context.user_data.pop('awaiting_banner', None)
@@ -1780,15 +2366,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         link = text.strip()
         pid = context.user_data.pop('tutorial_pid', None)
         vid = context.user_data.pop('tutorial_vid', None)
-        products = load_products()
+        products = await run_blocking(load_products)
         if not pid or pid not in products or vid not in products[pid].get('variants', {}):
             await update.message.reply_text("❌ Product or variant not found.")
             return
         
         # Allow removing tutorial
         if link.lower() in ['none', 'remove', 'delete', 'clear']:
-            products[pid]['variants'][vid]['tutorial'] = None
-            save_products(products)
+            await run_blocking(set_variant_tutorial, pid, vid, None)
             await update.message.reply_text("✅ Tutorial link removed!")
             return
         
@@ -1803,8 +2388,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data['tutorial_vid'] = vid
             return
         
-        products[pid]['variants'][vid]['tutorial'] = link
-        save_products(products)
+        await run_blocking(set_variant_tutorial, pid, vid, link)
         prod_name = products[pid]['name']
         var_name = products[pid]['variants'][vid]['name']
         await update.message.reply_text(
@@ -1857,14 +2441,52 @@ if __name__ == '__main__':
         print("   2. Set BAKONG_PROXY_URL (for non-Cambodia deployments)")
     print("="*60 + "\n")
     
+    if qr_pool:
+        # Fork the render workers now, before any other thread is running
+        qr_pool.start()
     load_products()
+    user_registry.start()
+    atexit.register(user_registry.close)
+    threading.Thread(target=_stock_compactor, name="stock-compactor", daemon=True).start()
     
     # Build application with proper error handling
     async def error_handler(update, context):
         """Handle errors in the application."""
         logging.error(f"[BOT ERROR] Update: {update}", exc_info=context.error)
     
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    async def post_init(app):
+        await run_blocking(payment_poller.restore)
+        await run_blocking(restore_stock_holds, payment_poller.orders())
+        await replay_deliveries(app.bot)
+        payment_poller.start(app.bot)
+        await resume_broadcasts(app)
+        if BOT_DEBUG_LOOP:
+            # Log any callback that holds the event loop longer than SLOW_CALLBACK_MS
+            loop = asyncio.get_running_loop()
+            loop.set_debug(True)
+            loop.slow_callback_duration = SLOW_CALLBACK_MS / 1000
+            logging.getLogger('asyncio').setLevel(logging.WARNING)
+            logging.info(f"[LOOP] Debug mode on, slow callback threshold {SLOW_CALLBACK_MS}ms")
+    
+    async def post_stop(app):
+        # Before Application.shutdown() closes the bot's HTTP client, so
+        # deliveries still in flight can message their buyers
+        await payment_poller.stop()
+        await stop_broadcasts()
+    
+    async def post_shutdown(app):
+        if bakong_proxy:
+            await bakong_proxy.aclose()
+        if qr_pool:
+            qr_pool.close()
+        io_executor.shutdown(wait=True)
+    
+    builder = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    if UPDATE_CONCURRENCY > 1:
+        # Different chats run side by side; each chat's updates stay in order,
+        # which the ConversationHandlers below rely on
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+    application = builder.build()
     application.add_error_handler(error_handler)
     
     stock_conv = ConversationHandler(
@@ -1915,6 +2537,8 @@ if __name__ == '__main__':
     application.add_handler(CommandHandler('forceconfirm', cmd_forceconfirm))
     application.add_handler(CommandHandler('testkhqr', cmd_test_khqr))
     application.add_handler(CommandHandler('viewstock', cmd_view_stock))
+    application.add_handler(CommandHandler('verifystock', cmd_verify_stock))
+    application.add_handler(CommandHandler('paystats', cmd_payment_stats))
     application.add_handler(CommandHandler('viewproducts', cmd_view_products))
     application.add_handler(CommandHandler('viewusers', cmd_view_users))
     application.add_handler(CommandHandler('backup', cmd_backup))
@@ -1924,4 +2548,9 @@ if __name__ == '__main__':
     application.add_handler(MessageHandler((filters.TEXT | filters.PHOTO) & (~filters.COMMAND), handle_message))
     
     print("[OK] Store Bot Final V33 Running...")
-    application.run_polling()
\ No newline at end of file
+    if WEBHOOK_URL:
+        server = WebhookServer(application, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT,
+                               record_path=WEBHOOK_RECORD_FILE or None)
+        run_webhook(application, server, f"{WEBHOOK_URL}{server.path}", WEBHOOK_MAX_CONNECTIONS)
+    else:
+        application.run_polling()
\ No newline at end of file
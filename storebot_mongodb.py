@@ -1,5 +1,4 @@
 import logging
-import qrcode
 import os
 import asyncio
 import json
@@ -7,10 +6,12 @@ import random
 import string
 from datetime import datetime
 from dotenv import load_dotenv
-from PIL import Image, ImageDraw, ImageFont
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler
 from bakong_khqr import KHQR
+from khqr_payload import build_proxy_khqr, new_bill_number
+from qr_render import ImageOutput, QRCardRenderer
+from broadcast_engine import Broadcast, TokenBucket
 
 # MongoDB support
 from pymongo import MongoClient
@@ -41,6 +42,12 @@ MERCHANT_NAME = os.getenv("MERCHANT_NAME", "SOVANNAREACH VORN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "7948968436"))
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "@dzy4u2")
 BAKONG_PROXY_URL = os.getenv("BAKONG_PROXY_URL", "")
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "28"))  # messages/second, Telegram allows ~30
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))  # sends in flight at once
+QR_IMAGE_FORMAT = os.getenv("QR_IMAGE_FORMAT", "png").lower()  # png, palette, jpeg, webp or auto
+QR_IMAGE_WIDTH = int(os.getenv("QR_IMAGE_WIDTH", "0"))  # QR card width in pixels, 0 = template width
+QR_IMAGE_QUALITY = int(os.getenv("QR_IMAGE_QUALITY", "80"))  # jpeg / webp quality
+QR_IMAGE_MAX_KB = int(os.getenv("QR_IMAGE_MAX_KB", "0"))  # size budget for "auto", 0 = smallest
 
 # MongoDB Configuration
 MONGODB_URI = os.getenv("MONGODB_URI", "")
@@ -106,12 +113,18 @@ if BAKONG_TOKEN:
 else:
     print("[WARNING] No BAKONG_TOKEN found - KHQR will not work")
 
-# If a proxy URL is provided, we'll use HTTP requests to talk to it
+# If a proxy URL is provided, talk to it through one pooled keep-alive client
+BAKONG_PROXY_TIMEOUT = float(os.getenv("BAKONG_PROXY_TIMEOUT", "15"))  # seconds per proxy call
+BAKONG_PROXY_RETRIES = int(os.getenv("BAKONG_PROXY_RETRIES", "2"))  # retries on network errors / 5xx
+# Build the KHQR locally (same payload the proxy makes) and use the proxy only for checks
+BAKONG_LOCAL_QR = os.getenv("BAKONG_LOCAL_QR", "false").lower() == "true"
+bakong_proxy = None
 if BAKONG_PROXY_URL:
     try:
-        import requests
-    except Exception:
-        requests = None
+        from bakong_client import BakongProxyClient
+        bakong_proxy = BakongProxyClient(BAKONG_PROXY_URL, timeout=BAKONG_PROXY_TIMEOUT, retries=BAKONG_PROXY_RETRIES)
+    except Exception as e:
+        logging.error(f"[PROXY] Could not create proxy client: {e}")
 
 # --- 1. MONGODB DATA MANAGERS ---
 
@@ -340,14 +353,23 @@ async def reindex_products():
         logging.error(f"Error reindexing products: {e}")
 
 # --- 2. QR GENERATOR ---
-def generate_qr_data(amount):
+async def generate_qr_data(amount, bill_number=None):
     """Generate official Bakong KHQR code for Cambodia payments"""
-    if BAKONG_PROXY_URL and requests:
+    # Each order gets its own bill number, so equal amounts never share a QR / md5
+    bill_number = bill_number or new_bill_number()
+    if bakong_proxy and BAKONG_LOCAL_QR:
+        try:
+            qr_code, md5 = build_proxy_khqr(BAKONG_ACCOUNT, MERCHANT_NAME, amount, bill_number=bill_number)
+            logging.info(f"[KHQR GENERATED] Official Bakong KHQR built locally - Amount: ${amount}, MD5: {md5}")
+            return qr_code, md5
+        except Exception as e:
+            logging.error(f"[KHQR ERROR] Failed to build KHQR locally: {e}")
+            return None, None
+
+    if bakong_proxy:
         try:
-            payload = {"amount": amount, "bank_account": BAKONG_ACCOUNT, "merchant_name": MERCHANT_NAME}
-            resp = requests.post(f"{BAKONG_PROXY_URL.rstrip('/')}/create_qr", json=payload, timeout=15)
-            resp.raise_for_status()
-            data = resp.json()
+            payload = {"amount": amount, "bank_account": BAKONG_ACCOUNT, "merchant_name": MERCHANT_NAME, "bill_number": bill_number}
+            data = await bakong_proxy.create_qr(payload)
             logging.info(f"[KHQR GENERATED] Official Bakong KHQR via Proxy - Amount: ${amount}")
             return data.get("qr_code"), data.get("md5")
         except Exception as e:
@@ -355,92 +377,44 @@ def generate_qr_data(amount):
             return None, None
 
     if khqr and BAKONG_TOKEN:
-        try:
-            qr_code = khqr.create_qr(
-                bank_account=BAKONG_ACCOUNT, 
-                merchant_name=MERCHANT_NAME, 
-                merchant_city="Phnom Penh",
-                amount=amount, 
-                currency="USD", 
-                store_label="TelegramStore", 
-                phone_number="85512345678",
-                bill_number=f"INV{datetime.now().strftime('%Y%m%d%H%M%S')}", 
-                terminal_label="TeleBot"
-            )
-            md5 = khqr.generate_md5(qr_code)
-            logging.info(f"[KHQR GENERATED] Official Bakong KHQR - Amount: ${amount}, MD5: {md5}")
-            return qr_code, md5
-        except Exception as e:
-            logging.error(f"[KHQR ERROR] Failed to generate KHQR: {e}")
-            return None, None
+        return await asyncio.get_running_loop().run_in_executor(None, create_direct_khqr, amount, bill_number)
 
     logging.error(f"[QR FAILED] No valid KHQR configuration available!")
     return None, None
 
-def create_styled_qr(qr_data, amount):
-    """Create Bakong KHQR image with official green color"""
-    possible_paths = [TEMPLATE_FILE, f"/storage/emulated/0/Download/{TEMPLATE_FILE}"]
-    found_path = None
-    for p in possible_paths:
-        if os.path.exists(p): found_path = p; break
-    
-    if not found_path:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="#107c42", back_color="white")
-        fname = f"qr_{random.randint(1000,9999)}.png"
-        img.save(fname)
-        logging.info(f"[QR IMAGE] Generated basic Bakong KHQR image: {fname}")
-        return fname
-
+def create_direct_khqr(amount, bill_number):
+    """Build the KHQR locally with the bakong_khqr package (direct mode)"""
     try:
-        card = Image.open(found_path).convert("RGBA")
-        W, H = card.size
-        qr = qrcode.QRCode(box_size=20, border=0) 
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        qr_img = qr.make_image(fill_color="#107c42", back_color="white").convert("RGBA")
-        
-        qr_target_size = int(W * 0.55)
-        qr_img = qr_img.resize((qr_target_size, qr_target_size), Image.LANCZOS) 
-        pos_x = (W - qr_target_size) // 2; pos_y = (H - qr_target_size) // 2
-        card.paste(qr_img, (pos_x, pos_y))
-        
-        draw = ImageDraw.Draw(card)
-        try: font = ImageFont.truetype("/system/fonts/Roboto-Bold.ttf", 60)
-        except: font = ImageFont.load_default()
-            
-        text = f"${amount:.2f}"
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_w = bbox[2] - bbox[0]
-        text_x = (W - text_w) // 2
-        text_y = pos_y + qr_target_size + 30
-        
-        for off in [(-2,-2), (-2,2), (2,-2), (2,2)]:
-            draw.text((text_x+off[0], text_y+off[1]), text, font=font, fill="black")
-        draw.text((text_x, text_y), text, font=font, fill="white")
-        
-        filename = f"qr_card_{random.randint(1000,9999)}.png"
-        card.save(filename) 
-        return filename
+        qr_code = khqr.create_qr(
+            bank_account=BAKONG_ACCOUNT, 
+            merchant_name=MERCHANT_NAME, 
+            merchant_city="Phnom Penh",
+            amount=amount, 
+            currency="USD", 
+            store_label="TelegramStore", 
+            phone_number="85512345678",
+            bill_number=bill_number, 
+            terminal_label="TeleBot"
+        )
+        md5 = khqr.generate_md5(qr_code)
+        logging.info(f"[KHQR GENERATED] Official Bakong KHQR - Amount: ${amount}, MD5: {md5}")
+        return qr_code, md5
     except Exception as e:
-        print(f"QR Error: {e}")
-        img = qrcode.make(qr_data)
-        fname = f"qr_basic_{random.randint(1000,9999)}.png"
-        img.save(fname)
-        return fname
-
-def safe_check_payment(md5):
-    if BAKONG_PROXY_URL and requests:
+        logging.error(f"[KHQR ERROR] Failed to generate KHQR: {e}")
+        return None, None
+
+# Template and font are decoded once; cards are encoded straight to memory
+qr_renderer = QRCardRenderer([TEMPLATE_FILE, f"/storage/emulated/0/Download/{TEMPLATE_FILE}"],
+                             output=ImageOutput(QR_IMAGE_FORMAT, QR_IMAGE_WIDTH, QR_IMAGE_QUALITY, QR_IMAGE_MAX_KB * 1024))
+
+def create_styled_qr(qr_data, amount):
+    """Bakong KHQR card (official green), encoded as QR_IMAGE_FORMAT"""
+    return qr_renderer.render(qr_data, amount)
+
+async def safe_check_payment(md5):
+    if bakong_proxy:
         try:
-            resp = requests.get(f"{BAKONG_PROXY_URL.rstrip('/')}/check/{md5}", timeout=15)
-            data = resp.json()
+            data = await bakong_proxy.check(md5)
             logging.info(f"[PROXY KHQR CHECK] MD5={md5}, Result={data}")
             return data
         except Exception as e:
@@ -448,22 +422,26 @@ def safe_check_payment(md5):
             return None
 
     if khqr:
-        try:
-            result = khqr.check_payment(md5)
-            logging.info(f"[KHQR CHECK] MD5={md5}, Result={result}")
-            return result
-        except Exception as e:
-            error_msg = str(e)
-            logging.error(f"[KHQR CHECK] Error checking payment for MD5={md5}: {e}")
-            
-            if "IP" in error_msg.upper() or "403" in error_msg or "FORBIDDEN" in error_msg.upper():
-                logging.error("[KHQR IP BLOCK] Bakong API blocked this IP! You need Cambodia IP or use BAKONG_PROXY_URL")
-            
-            return None
+        return await asyncio.get_running_loop().run_in_executor(None, check_direct_khqr, md5)
     
     logging.error("[KHQR CHECK] No payment method configured (no KHQR or Proxy)")
     return None
 
+def check_direct_khqr(md5):
+    """Ask the Bakong API directly (needs a Cambodia IP)"""
+    try:
+        result = khqr.check_payment(md5)
+        logging.info(f"[KHQR CHECK] MD5={md5}, Result={result}")
+        return result
+    except Exception as e:
+        error_msg = str(e)
+        logging.error(f"[KHQR CHECK] Error checking payment for MD5={md5}: {e}")
+        
+        if "IP" in error_msg.upper() or "403" in error_msg or "FORBIDDEN" in error_msg.upper():
+            logging.error("[KHQR IP BLOCK] Bakong API blocked this IP! You need Cambodia IP or use BAKONG_PROXY_URL")
+        
+        return None
+
 def generate_trx_id():
     date_str = datetime.now().strftime("%d%m%Y")
     random_str = ''.join(random.choices(string.ascii_uppercase, k=5))
@@ -472,7 +450,6 @@ def generate_trx_id():
 # --- 3. BACKGROUND PAYMENT LOOP ---
 async def check_payment_loop(update, context, md5_hash, qr_msg_id, pid, vid, qty):
     chat_id = update.effective_chat.id
-    loop = asyncio.get_running_loop()
     products = await load_products()
     
     logging.info(f"[PAYMENT CHECK] Started for md5={md5_hash}, product={pid}, variant={vid}, qty={qty}")
@@ -492,7 +469,7 @@ async def check_payment_loop(update, context, md5_hash, qr_msg_id, pid, vid, qty
                     pass
                 return
             
-            response = await loop.run_in_executor(None, safe_check_payment, md5_hash)
+            response = await safe_check_payment(md5_hash)
             logging.info(f"[PAYMENT CHECK] Attempt {attempt+1}/120: Response = {response}")
             
             is_paid = False
@@ -794,7 +771,7 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         await query.message.reply_text(f"⏳ Generating Bakong KHQR code...")
-        qr_text, md5 = generate_qr_data(total)
+        qr_text, md5 = await generate_qr_data(total)
         
         if not qr_text or not md5:
             error_msg = (
@@ -809,7 +786,7 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 pass
             return
         
-        filename = create_styled_qr(qr_text, total)
+        photo = await asyncio.get_running_loop().run_in_executor(None, create_styled_qr, qr_text, total)
         markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel Transaction", callback_data="cancel")]])
         
         caption = (
@@ -821,12 +798,11 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         msg = await query.message.reply_photo(
-            photo=open(filename, 'rb'), 
+            photo=photo, 
             caption=caption,
             parse_mode='Markdown', 
             reply_markup=markup
         )
-        os.remove(filename)
         asyncio.create_task(check_payment_loop(update, context, md5, msg.message_id, pid, vid, qty))
 
     elif action == "delprod":
@@ -934,6 +910,35 @@ async def cmd_add_product_easy(update: Update, context: ContextTypes.DEFAULT_TYP
         logging.error(f"Error adding product: {e}")
         await update.message.reply_text(f"❌ Error: {e}")
 
+# Shared by every broadcast so they stay under Telegram's limit together
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+# Running broadcasts. Not application.create_task(): Application.stop() waits
+# for those, so a long broadcast would hold up shutdown / restart
+broadcast_tasks = set()
+
+def start_broadcast(coro):
+    task = asyncio.create_task(coro)
+    broadcast_tasks.add(task)
+    task.add_done_callback(_broadcast_done)
+    return task
+
+def _broadcast_done(task):
+    broadcast_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error(f"[BROADCAST] Broadcast failed: {task.exception()}")
+
+async def stop_broadcasts():
+    """Cancel running broadcasts on shutdown"""
+    for task in list(broadcast_tasks):
+        task.cancel()
+    for task in list(broadcast_tasks):
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f"[BROADCAST] Broadcast failed while stopping: {e}")
+
 async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
     
@@ -948,17 +953,20 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("ℹ️ No users to broadcast to.")
         return
     
-    await update.message.reply_text(f"📢 Sending to {len(users)} users...")
-    success = 0; failed = 0
+    status = await update.message.reply_text(f"📢 Sending to {len(users)} users...")
     
-    for uid in users:
-        try:
-            await context.bot.send_message(uid, f"📢 **NOTICE:**\n{msg}", parse_mode='Markdown')
-            success += 1
-        except Exception as e:
-            failed += 1
+    async def send(uid):
+        await context.bot.send_message(uid, f"📢 **NOTICE:**\n{msg}", parse_mode='Markdown')
+    
+    async def show_progress(b):
+        await status.edit_text(b.progress_text())
+    
+    async def run():
+        b = await Broadcast(users, send, broadcast_bucket, concurrency=BROADCAST_CONCURRENCY).run(on_progress=show_progress)
+        await status.reply_text(f"✅ Done. Sent: {b.counts['sent']}, Blocked: {b.counts['blocked']}, Failed: {b.counts['failed']}")
     
-    await update.message.reply_text(f"✅ Done. Sent: {success}, Failed: {failed}")
+    # In the background so the bot keeps answering while it sends
+    start_broadcast(run())
 
 async def cmd_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
@@ -979,18 +987,16 @@ async def cmd_test_khqr(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text("🧪 Testing KHQR generation...")
     test_amount = 0.01
-    qr_text, md5 = generate_qr_data(test_amount)
+    qr_text, md5 = await generate_qr_data(test_amount)
     
     if not qr_text or not md5:
         await update.message.reply_text("❌ **KHQR Test FAILED**\nCheck configuration!", parse_mode='Markdown')
         return
     
-    filename = create_styled_qr(qr_text, test_amount)
+    photo = await asyncio.get_running_loop().run_in_executor(None, create_styled_qr, qr_text, test_amount)
     success_msg = f"✅ **KHQR Test SUCCESS**\n• Amount: ${test_amount}\n• MD5: `{md5[:16]}...`"
     
-    await update.message.reply_photo(photo=open(filename, 'rb'), caption=success_msg, parse_mode='Markdown')
-    try: os.remove(filename)
-    except: pass
+    await update.message.reply_photo(photo=photo, caption=success_msg, parse_mode='Markdown')
 
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show MongoDB database statistics"""
@@ -1064,7 +1070,14 @@ if __name__ == '__main__':
     async def error_handler(update, context):
         logging.error(f"[BOT ERROR] Update: {update}", exc_info=context.error)
     
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    async def post_stop(app):
+        await stop_broadcasts()
+    
+    async def post_shutdown(app):
+        if bakong_proxy:
+            await bakong_proxy.aclose()
+    
+    application = ApplicationBuilder().token(BOT_TOKEN).post_stop(post_stop).post_shutdown(post_shutdown).build()
     application.add_error_handler(error_handler)
     
     stock_conv = ConversationHandler(
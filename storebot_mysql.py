@@ -5,7 +5,6 @@ Uses MySQL database instead of MongoDB for better Hostinger compatibility
 """
 
 import logging
-import qrcode
 import os
 import asyncio
 import json
@@ -13,10 +12,11 @@ import random
 import string
 from datetime import datetime
 from dotenv import load_dotenv
-from PIL import Image, ImageDraw, ImageFont
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler
 from bakong_khqr import KHQR
+from khqr_payload import build_proxy_khqr, new_bill_number
+from qr_render import ImageOutput, QRCardRenderer
 
 # MySQL support
 import mysql.connector
@@ -47,6 +47,10 @@ MERCHANT_NAME = os.getenv("MERCHANT_NAME", "SOVANNAREACH VORN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "7948968436"))
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "@dzy4u2")
 BAKONG_PROXY_URL = os.getenv("BAKONG_PROXY_URL", "")
+QR_IMAGE_FORMAT = os.getenv("QR_IMAGE_FORMAT", "png").lower()  # png, palette, jpeg, webp or auto
+QR_IMAGE_WIDTH = int(os.getenv("QR_IMAGE_WIDTH", "0"))  # QR card width in pixels, 0 = template width
+QR_IMAGE_QUALITY = int(os.getenv("QR_IMAGE_QUALITY", "80"))  # jpeg / webp quality
+QR_IMAGE_MAX_KB = int(os.getenv("QR_IMAGE_MAX_KB", "0"))  # size budget for "auto", 0 = smallest
 
 # MySQL Configuration for Hostinger
 MYSQL_HOST = os.getenv("MYSQL_HOST", "")
@@ -194,12 +198,18 @@ if BAKONG_TOKEN:
 else:
     print("[WARNING] No BAKONG_TOKEN found - KHQR will not work")
 
-# If a proxy URL is provided, we'll use HTTP requests to talk to it
+# If a proxy URL is provided, talk to it through one pooled keep-alive client
+BAKONG_PROXY_TIMEOUT = float(os.getenv("BAKONG_PROXY_TIMEOUT", "15"))  # seconds per proxy call
+BAKONG_PROXY_RETRIES = int(os.getenv("BAKONG_PROXY_RETRIES", "2"))  # retries on network errors / 5xx
+# Build the KHQR locally (same payload the proxy makes) and use the proxy only for checks
+BAKONG_LOCAL_QR = os.getenv("BAKONG_LOCAL_QR", "false").lower() == "true"
+bakong_proxy = None
 if BAKONG_PROXY_URL:
     try:
-        import requests
-    except Exception:
-        requests = None
+        from bakong_client import BakongProxyClient
+        bakong_proxy = BakongProxyClient(BAKONG_PROXY_URL, timeout=BAKONG_PROXY_TIMEOUT, retries=BAKONG_PROXY_RETRIES)
+    except Exception as e:
+        logging.error(f"[PROXY] Could not create proxy client: {e}")
 
 # --- 1. MYSQL DATA MANAGERS ---
 
@@ -484,14 +494,23 @@ async def get_accounts(pid, vid, qty):
 # The structure remains the same as MongoDB version, just using MySQL functions
 
 # --- 2. QR GENERATOR ---
-def generate_qr_data(amount):
+async def generate_qr_data(amount, bill_number=None):
     """Generate official Bakong KHQR code for Cambodia payments"""
-    if BAKONG_PROXY_URL and requests:
+    # Each order gets its own bill number, so equal amounts never share a QR / md5
+    bill_number = bill_number or new_bill_number()
+    if bakong_proxy and BAKONG_LOCAL_QR:
         try:
-            payload = {"amount": amount, "bank_account": BAKONG_ACCOUNT, "merchant_name": MERCHANT_NAME}
-            resp = requests.post(f"{BAKONG_PROXY_URL.rstrip('/')}/create_qr", json=payload, timeout=15)
-            resp.raise_for_status()
-            data = resp.json()
+            qr_code, md5 = build_proxy_khqr(BAKONG_ACCOUNT, MERCHANT_NAME, amount, bill_number=bill_number)
+            logging.info(f"[KHQR GENERATED] Official Bakong KHQR built locally - Amount: ${amount}, MD5: {md5}")
+            return qr_code, md5
+        except Exception as e:
+            logging.error(f"[KHQR ERROR] Failed to build KHQR locally: {e}")
+            return None, None
+
+    if bakong_proxy:
+        try:
+            payload = {"amount": amount, "bank_account": BAKONG_ACCOUNT, "merchant_name": MERCHANT_NAME, "bill_number": bill_number}
+            data = await bakong_proxy.create_qr(payload)
             logging.info(f"[KHQR GENERATED] Official Bakong KHQR via Proxy - Amount: ${amount}")
             return data.get("qr_code"), data.get("md5")
         except Exception as e:
@@ -499,92 +518,44 @@ def generate_qr_data(amount):
             return None, None
 
     if khqr and BAKONG_TOKEN:
-        try:
-            qr_code = khqr.create_qr(
-                bank_account=BAKONG_ACCOUNT, 
-                merchant_name=MERCHANT_NAME, 
-                merchant_city="Phnom Penh",
-                amount=amount, 
-                currency="USD", 
-                store_label="TelegramStore", 
-                phone_number="85512345678",
-                bill_number=f"INV{datetime.now().strftime('%Y%m%d%H%M%S')}", 
-                terminal_label="TeleBot"
-            )
-            md5 = khqr.generate_md5(qr_code)
-            logging.info(f"[KHQR GENERATED] Official Bakong KHQR - Amount: ${amount}, MD5: {md5}")
-            return qr_code, md5
-        except Exception as e:
-            logging.error(f"[KHQR ERROR] Failed to generate KHQR: {e}")
-            return None, None
+        return await asyncio.get_running_loop().run_in_executor(None, create_direct_khqr, amount, bill_number)
 
     logging.error(f"[QR FAILED] No valid KHQR configuration available!")
     return None, None
 
-def create_styled_qr(qr_data, amount):
-    """Create Bakong KHQR image with official green color"""
-    possible_paths = [TEMPLATE_FILE, f"/storage/emulated/0/Download/{TEMPLATE_FILE}"]
-    found_path = None
-    for p in possible_paths:
-        if os.path.exists(p): found_path = p; break
-    
-    if not found_path:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="#107c42", back_color="white")
-        fname = f"qr_{random.randint(1000,9999)}.png"
-        img.save(fname)
-        logging.info(f"[QR IMAGE] Generated basic Bakong KHQR image: {fname}")
-        return fname
-
+def create_direct_khqr(amount, bill_number):
+    """Build the KHQR locally with the bakong_khqr package (direct mode)"""
     try:
-        card = Image.open(found_path).convert("RGBA")
-        W, H = card.size
-        qr = qrcode.QRCode(box_size=20, border=0) 
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        qr_img = qr.make_image(fill_color="#107c42", back_color="white").convert("RGBA")
-        
-        qr_target_size = int(W * 0.55)
-        qr_img = qr_img.resize((qr_target_size, qr_target_size), Image.LANCZOS) 
-        pos_x = (W - qr_target_size) // 2; pos_y = (H - qr_target_size) // 2
-        card.paste(qr_img, (pos_x, pos_y))
-        
-        draw = ImageDraw.Draw(card)
-        try: font = ImageFont.truetype("/system/fonts/Roboto-Bold.ttf", 60)
-        except: font = ImageFont.load_default()
-            
-        text = f"${amount:.2f}"
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_w = bbox[2] - bbox[0]
-        text_x = (W - text_w) // 2
-        text_y = pos_y + qr_target_size + 30
-        
-        for off in [(-2,-2), (-2,2), (2,-2), (2,2)]:
-            draw.text((text_x+off[0], text_y+off[1]), text, font=font, fill="black")
-        draw.text((text_x, text_y), text, font=font, fill="white")
-        
-        filename = f"qr_card_{random.randint(1000,9999)}.png"
-        card.save(filename) 
-        return filename
+        qr_code = khqr.create_qr(
+            bank_account=BAKONG_ACCOUNT, 
+            merchant_name=MERCHANT_NAME, 
+            merchant_city="Phnom Penh",
+            amount=amount, 
+            currency="USD", 
+            store_label="TelegramStore", 
+            phone_number="85512345678",
+            bill_number=bill_number, 
+            terminal_label="TeleBot"
+        )
+        md5 = khqr.generate_md5(qr_code)
+        logging.info(f"[KHQR GENERATED] Official Bakong KHQR - Amount: ${amount}, MD5: {md5}")
+        return qr_code, md5
     except Exception as e:
-        print(f"QR Error: {e}")
-        img = qrcode.make(qr_data)
-        fname = f"qr_basic_{random.randint(1000,9999)}.png"
-        img.save(fname)
-        return fname
-
-def safe_check_payment(md5):
-    if BAKONG_PROXY_URL and requests:
+        logging.error(f"[KHQR ERROR] Failed to generate KHQR: {e}")
+        return None, None
+
+# Template and font are decoded once; cards are encoded straight to memory
+qr_renderer = QRCardRenderer([TEMPLATE_FILE, f"/storage/emulated/0/Download/{TEMPLATE_FILE}"],
+                             output=ImageOutput(QR_IMAGE_FORMAT, QR_IMAGE_WIDTH, QR_IMAGE_QUALITY, QR_IMAGE_MAX_KB * 1024))
+
+def create_styled_qr(qr_data, amount):
+    """Bakong KHQR card (official green), encoded as QR_IMAGE_FORMAT"""
+    return qr_renderer.render(qr_data, amount)
+
+async def safe_check_payment(md5):
+    if bakong_proxy:
         try:
-            resp = requests.get(f"{BAKONG_PROXY_URL.rstrip('/')}/check/{md5}", timeout=15)
-            data = resp.json()
+            data = await bakong_proxy.check(md5)
             logging.info(f"[PROXY KHQR CHECK] MD5={md5}, Result={data}")
             return data
         except Exception as e:
@@ -592,22 +563,26 @@ def safe_check_payment(md5):
             return None
 
     if khqr:
-        try:
-            result = khqr.check_payment(md5)
-            logging.info(f"[KHQR CHECK] MD5={md5}, Result={result}")
-            return result
-        except Exception as e:
-            error_msg = str(e)
-            logging.error(f"[KHQR CHECK] Error checking payment for MD5={md5}: {e}")
-            
-            if "IP" in error_msg.upper() or "403" in error_msg or "FORBIDDEN" in error_msg.upper():
-                logging.error("[KHQR IP BLOCK] Bakong API blocked this IP! You need Cambodia IP or use BAKONG_PROXY_URL")
-            
-            return None
+        return await asyncio.get_running_loop().run_in_executor(None, check_direct_khqr, md5)
     
     logging.error("[KHQR CHECK] No payment method configured (no KHQR or Proxy)")
     return None
 
+def check_direct_khqr(md5):
+    """Ask the Bakong API directly (needs a Cambodia IP)"""
+    try:
+        result = khqr.check_payment(md5)
+        logging.info(f"[KHQR CHECK] MD5={md5}, Result={result}")
+        return result
+    except Exception as e:
+        error_msg = str(e)
+        logging.error(f"[KHQR CHECK] Error checking payment for MD5={md5}: {e}")
+        
+        if "IP" in error_msg.upper() or "403" in error_msg or "FORBIDDEN" in error_msg.upper():
+            logging.error("[KHQR IP BLOCK] Bakong API blocked this IP! You need Cambodia IP or use BAKONG_PROXY_URL")
+        
+        return None
+
 def generate_trx_id():
     date_str = datetime.now().strftime("%d%m%Y")
     random_str = ''.join(random.choices(string.ascii_uppercase, k=5))
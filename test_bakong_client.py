@@ -0,0 +1,126 @@
+"""
+Test Script - Bakong proxy client against a local stand-in proxy
+Starts a fake bakong_proxy on localhost and checks that the pooled client
+reuses its connection, retries transient failures, gives up on bad ones and
+finds /check_batch through /health.
+No Bakong account or Cambodia IP needed: python test_bakong_client.py
+"""
+
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bakong_client import BakongProxyClient, HTTP2_AVAILABLE
+
+connections = set()
+flaky = {"left": 0}
+batch_calls = {"count": 0}
+
+
+class StandInProxy(BaseHTTPRequestHandler):
+    """Minimal copy of the bakong_proxy.py endpoints"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        connections.add(self.client_address)
+        if self.path.startswith("/check/"):
+            md5 = self.path.rsplit("/", 1)[-1]
+            if md5 == "flaky" and flaky["left"] > 0:
+                flaky["left"] -= 1
+                return self._send(503, {"status": "error"})
+            if md5 == "broken":
+                return self._send(500, {"error": "boom", "status": "error"})
+            code = 0 if md5 == "paid" else 1
+            return self._send(200, {"responseCode": code, "md5": md5})
+        if self.path == "/health":
+            return self._send(200, {"status": "ok", "features": ["check_batch"], "batch_max": 500})
+        self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        connections.add(self.client_address)
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self.path == "/check_batch":
+            batch_calls["count"] += 1
+            results = {md5: "PAID" if md5.startswith("paid") else "UNPAID" for md5 in payload["md5_list"]}
+            return self._send(200, {"results": results, "status": "success"})
+        self._send(200, {"qr_code": f"000201...{payload.get('amount')}", "md5": "abc123", "status": "success"})
+
+    def log_message(self, *args):
+        pass
+
+
+async def run_checks(url):
+    client = BakongProxyClient(url, timeout=5, retries=2, backoff=0.05)
+    ok = True
+
+    data = await client.create_qr({"amount": 1.5, "bank_account": "test@bank", "merchant_name": "Test"})
+    print(f"create_qr -> {data}")
+    ok &= data.get("md5") == "abc123"
+
+    start = time.perf_counter()
+    for _ in range(50):
+        await client.check("unpaid")
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"50 sequential checks: {elapsed:.0f}ms, {len(connections)} TCP connection(s) used")
+    ok &= len(connections) == 1
+
+    results = await asyncio.gather(*(client.check("paid") for _ in range(20)))
+    print(f"20 concurrent checks: {len(connections)} connection(s) in pool")
+    ok &= all(r["responseCode"] == 0 for r in results)
+
+    flaky["left"] = 2
+    data = await client.check("flaky")
+    print(f"503 twice then OK -> {data}")
+    ok &= data["responseCode"] == 1
+
+    try:
+        await client.check("broken")
+        print("❌ 500 should have raised")
+        ok = False
+    except Exception as e:
+        print(f"500 raised without retry: {type(e).__name__}")
+
+    print(f"/health features -> {await client.features()}")
+    ok &= await client.supports("check_batch")
+    md5s = [f"paid{i}" for i in range(150)] + [f"open{i}" for i in range(150)]
+    results = await client.check_batch(md5s)
+    paid = sum(1 for v in results.values() if v == "PAID")
+    print(f"check_batch of {len(md5s)} -> {paid} paid in {batch_calls['count']} request(s)")
+    ok &= paid == 150 and batch_calls["count"] == 1
+
+    await client.aclose()
+    return ok
+
+
+def main():
+    print("=" * 60)
+    print("BAKONG PROXY CLIENT TEST")
+    print("=" * 60)
+    print(f"HTTP/2 available: {HTTP2_AVAILABLE} (stand-in proxy speaks HTTP/1.1)\n")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInProxy)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        ok = asyncio.run(run_checks(url))
+    finally:
+        server.shutdown()
+
+    print("\n✅ All checks passed" if ok else "\n❌ Some checks failed")
+
+
+if __name__ == "__main__":
+    main()
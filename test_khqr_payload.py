@@ -0,0 +1,144 @@
+"""
+Test Script - Local KHQR payloads vs. the bakong_khqr library
+Every case in khqr_golden.json is rebuilt with khqr_payload and must match
+the stored payload and md5 byte for byte. If bakong_khqr is installed, the
+library is run on the same inputs (with its clock pinned) as well, so a
+library upgrade that changes the format shows up here. The golden file
+records the bakong-khqr version it was generated with; keep it equal to the
+version pinned in requirements / proxy_requirements.txt / deploy.sh.
+
+    python test_khqr_payload.py              # verify
+    python test_khqr_payload.py --regenerate # rewrite golden file from the library
+"""
+
+import json
+import os
+import sys
+import warnings
+from importlib import metadata
+from unittest import mock
+
+from khqr_payload import build_khqr, build_proxy_khqr, khqr_md5, PROXY_MERCHANT
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "khqr_golden.json")
+NOW_MS = 1767225600000  # 2026-01-01 00:00:00 UTC
+
+ACCOUNT = "store_test@aclb"
+
+# (name, kwargs for build_khqr / KHQR.create_qr)
+CASES = [
+    ("proxy_1usd", dict(amount=1.0, bill_number="INV-1000", **PROXY_MERCHANT)),
+    ("proxy_cents", dict(amount=0.01, bill_number="INV-10", **PROXY_MERCHANT)),
+    ("proxy_odd_float", dict(amount=0.1 + 0.2, bill_number="INV-300", **PROXY_MERCHANT)),
+    ("proxy_large", dict(amount=1234567.89, bill_number="INV-1234567890", **PROXY_MERCHANT)),
+    ("direct_storebot", dict(amount=12.5, merchant_city="Phnom Penh", store_label="TelegramStore",
+                             phone_number="85512345678", bill_number="INV20260101000000",
+                             terminal_label="TeleBot")),
+    ("round_amount", dict(amount=100, merchant_city="Siem Reap")),
+    ("trailing_zero", dict(amount=10.10, merchant_city="PP", bill_number="ORDER-1")),
+    ("khr", dict(amount=40000, currency="KHR", merchant_city="Phnom Penh", bill_number="KHR-1")),
+    ("static_qr", dict(amount=0, merchant_city="Phnom Penh", store_label="Store")),
+    ("phone_local", dict(amount=5, merchant_city="PP", phone_number="012 345 678")),
+    ("phone_plain", dict(amount=5, merchant_city="PP", phone_number="98765432")),
+    ("max_lengths", dict(amount=9.99, merchant_city="A" * 15, store_label="S" * 25,
+                         bill_number="B" * 25, terminal_label="T" * 25)),
+    ("expiry_7_days", dict(amount=3, merchant_city="PP", expiration=7)),
+    ("unicode_name", dict(amount=2.75, merchant_city="ភ្នំពេញ", merchant_name="ហាង Store")),
+]
+
+DEFAULT_NAME = "Test Store"
+
+
+def case_kwargs(kwargs):
+    kwargs = dict(kwargs)
+    kwargs.setdefault("merchant_name", DEFAULT_NAME)
+    kwargs.setdefault("currency", "USD")
+    return kwargs
+
+
+def build_local(kwargs):
+    kwargs = case_kwargs(kwargs)
+    expiration = kwargs.pop("expiration", 1)
+    qr = build_khqr(ACCOUNT, expiration_days=expiration, now_ms=NOW_MS, **kwargs)
+    return qr, khqr_md5(qr)
+
+
+def build_library(kwargs):
+    from bakong_khqr import KHQR
+    khqr = KHQR("")
+    with mock.patch("time.time", return_value=NOW_MS / 1000), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        qr = khqr.create_qr(account_id=ACCOUNT, **case_kwargs(kwargs))
+    return str(qr), khqr.generate_md5(str(qr))
+
+
+def regenerate():
+    golden = {}
+    for name, kwargs in CASES:
+        qr, md5 = build_library(kwargs)
+        golden[name] = {"qr": qr, "md5": md5}
+    with open(GOLDEN_FILE, "w", encoding="utf-8") as f:
+        json.dump({"library_version": library_version(), "now_ms": NOW_MS, "account": ACCOUNT, "cases": golden},
+                  f, indent=2, ensure_ascii=False)
+    print(f"✅ Wrote {len(golden)} cases from bakong-khqr {library_version()} to {GOLDEN_FILE}")
+
+
+def library_version():
+    try:
+        return metadata.version("bakong-khqr")
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def verify():
+    print("=" * 60)
+    print("KHQR PAYLOAD GOLDEN TEST")
+    print("=" * 60)
+    with open(GOLDEN_FILE, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    golden = data["cases"]
+    print(f"Golden file generated with bakong-khqr {data.get('library_version', 'unknown')}")
+
+    try:
+        import bakong_khqr  # noqa: F401
+        have_library = True
+        installed = library_version()
+        if installed != data.get("library_version"):
+            print(f"⚠️  bakong-khqr {installed} installed - the library comparison below is against that version")
+        print()
+    except ImportError:
+        have_library = False
+        print("ℹ️  bakong_khqr not installed - comparing against golden file only\n")
+
+    failures = 0
+    for name, kwargs in CASES:
+        expected = golden.get(name)
+        if not expected:
+            print(f"❌ {name}: missing from golden file (run --regenerate)")
+            failures += 1
+            continue
+        local = build_local(kwargs)
+        ok = local == (expected["qr"], expected["md5"])
+        if have_library:
+            ok &= build_library(kwargs) == local
+        print(f"{'✅' if ok else '❌'} {name}: {local[1]}")
+        if not ok:
+            print(f"   expected {expected['qr']}")
+            print(f"   local    {local[0]}")
+            failures += 1
+
+    # The proxy shortcut must equal the proxy_1usd case exactly
+    qr, md5 = build_proxy_khqr(ACCOUNT, DEFAULT_NAME, 1.0, now_ms=NOW_MS)
+    ok = md5 == golden["proxy_1usd"]["md5"]
+    print(f"{'✅' if ok else '❌'} build_proxy_khqr matches proxy_1usd")
+    failures += not ok
+
+    print(f"\n{'✅ All' if not failures else f'❌ {failures} of'} {len(CASES) + 1} checks {'passed' if not failures else 'failed'}")
+    return failures == 0
+
+
+if __name__ == "__main__":
+    if "--regenerate" in sys.argv:
+        regenerate()
+    else:
+        sys.exit(0 if verify() else 1)
@@ -0,0 +1,154 @@
+"""
+Test Script - KHQR cards still scan at every output setting
+Renders payment cards with qr_render.ImageOutput in each format, quality and
+width, decodes them locally and checks the payload comes back byte for byte.
+Each image is decoded as uploaded and again after a "phone photo" pass
+(downscaled, blurred, re-saved as a poor JPEG) to leave a safety margin.
+
+Every rung of AUTO_LADDER must pass at every width tested; the rows below
+the ladder's quality floor are informational and show how much margin is
+left. Uses ./template.png if present, otherwise a generated stand-in.
+
+Needs one QR decoder: zxing-cpp, opencv-python-headless or pyzbar.
+
+    python test_qr_scan.py [width ...]    # default widths: template, 720, 540
+"""
+
+import io
+import os
+import random
+import sys
+import tempfile
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from khqr_payload import build_proxy_khqr, new_bill_number
+from qr_render import AUTO_LADDER, ImageOutput, QRCardRenderer
+
+WIDTHS = [int(w) for w in sys.argv[1:]] or [0, 720, ImageOutput.MIN_WIDTH]
+# Below the ladder, to show the margin (not required to pass)
+EXTRA = (("png", None), ("jpeg", 50), ("jpeg", 30), ("webp", 40), ("webp", 20))
+BUDGETS_KB = (150, 60, 30)
+
+
+def find_decoder():
+    """(name, decode(PIL image) -> list of payload strings) for the first decoder installed"""
+    try:
+        import zxingcpp
+        return "zxing-cpp", lambda img: [r.text for r in zxingcpp.read_barcodes(img)]
+    except ImportError:
+        pass
+    try:
+        import cv2
+        import numpy
+        detector = cv2.QRCodeDetector()
+
+        def decode_cv2(img):
+            text, _, _ = detector.detectAndDecode(numpy.asarray(img.convert("L")))
+            return [text] if text else []
+        return "opencv", decode_cv2
+    except ImportError:
+        pass
+    try:
+        from pyzbar import pyzbar
+        return "pyzbar", lambda img: [r.data.decode() for r in pyzbar.decode(img.convert("L"))]
+    except ImportError:
+        pass
+    return None, None
+
+
+def find_template(workdir):
+    here = os.path.join(os.path.dirname(os.path.abspath(__file__)), "template.png")
+    if os.path.exists(here):
+        return here, "template.png"
+    # Busy background so palette/JPEG/WebP have real work to do
+    rnd = random.Random(7)
+    img = Image.new("RGB", (1080, 1600), (16, 124, 66))
+    draw = ImageDraw.Draw(img)
+    for _ in range(400):
+        x, y, r = rnd.randrange(1080), rnd.randrange(1600), rnd.randrange(10, 80)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=(rnd.randrange(256), rnd.randrange(80, 200), rnd.randrange(120)))
+    img = img.filter(ImageFilter.GaussianBlur(6))
+    path = os.path.join(workdir, "template.png")
+    img.save(path)
+    return path, "generated 1080x1600 stand-in"
+
+
+def phone_photo(img):
+    """Roughly what a phone camera gets from a screen: smaller, softer, lossy"""
+    img = img.convert("RGB")
+    img = img.resize((img.width * 6 // 10, img.height * 6 // 10), Image.BILINEAR).filter(ImageFilter.GaussianBlur(1))
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=40)
+    return Image.open(io.BytesIO(buf.getvalue()))
+
+
+def scans(decode, data, payload):
+    """(decodes as uploaded, decodes after phone_photo)"""
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return payload in decode(img), payload in decode(phone_photo(img))
+
+
+def label(fmt, quality):
+    return f"{fmt} q{quality}" if quality else fmt
+
+
+def main():
+    print("=" * 60)
+    print("KHQR CARD SCAN TEST")
+    print("=" * 60)
+    name, decode = find_decoder()
+    if not decode:
+        print("❌ No QR decoder installed: pip install zxing-cpp (or opencv-python-headless / pyzbar)")
+        return False
+    workdir = tempfile.mkdtemp(prefix="qr-scan-")
+    template, source = find_template(workdir)
+    print(f"Decoder: {name} | Template: {source}\n")
+
+    payloads = [build_proxy_khqr("store_test@aclb", "Test Store", amount, bill_number=new_bill_number())[0]
+                for amount in (0.5, 12.5, 1234.99)]
+    failures = 0
+    for width in WIDTHS:
+        print(f"--- width {width or 'template'} ---")
+        for fmt, quality in AUTO_LADDER + EXTRA:
+            renderer = QRCardRenderer([template], output=ImageOutput(fmt, width, quality or 80))
+            sizes, ok_plain, ok_photo = [], 0, 0
+            for i, payload in enumerate(payloads):
+                data = renderer.render(payload, 12.5 * (i + 1))
+                plain, photo = scans(decode, data, payload)
+                sizes.append(len(data)); ok_plain += plain; ok_photo += photo
+            passed = ok_plain == ok_photo == len(payloads)
+            required = (fmt, quality) in AUTO_LADDER
+            mark = "✅" if passed else ("❌" if required else "⚠️")
+            failures += required and not passed
+            print(f"{mark} {label(fmt, quality):<12} {max(sizes) / 1024:7.1f} KB  "
+                  f"scans {ok_plain}/{len(payloads)}, after phone photo {ok_photo}/{len(payloads)}"
+                  f"{'' if required else '  (below ladder)'}")
+
+        # auto must respect the budget when a rung fits and must still scan
+        for budget in BUDGETS_KB:
+            renderer = QRCardRenderer([template], output=ImageOutput("auto", width, max_bytes=budget * 1024))
+            data = renderer.render(payloads[1], 25.0)
+            ok = all(scans(decode, data, payloads[1]))
+            fmt = Image.open(io.BytesIO(data)).format
+            print(f"{'✅' if ok else '❌'} auto, {budget} KB budget -> {fmt} {len(data) / 1024:.1f} KB")
+            failures += not ok
+        print()
+
+    # Without a template: the plain green QR
+    renderer = QRCardRenderer([os.path.join(workdir, "missing.png")], output=ImageOutput("auto", 540))
+    ok = all(scans(decode, renderer.render(payloads[0], 0.5), payloads[0]))
+    print(f"{'✅' if ok else '❌'} plain QR (no template) at 540px, auto")
+    failures += not ok
+
+    ok = ImageOutput("webp", 400).width == ImageOutput.MIN_WIDTH
+    print(f"{'✅' if ok else '❌'} widths below {ImageOutput.MIN_WIDTH}px are raised to it")
+    failures += not ok
+
+    print(f"\n{'✅ All required settings scan' if not failures else f'❌ {failures} required checks failed'}")
+    return failures == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,188 @@
+"""
+Test Script - concurrent update processing, in order per chat
+Runs a real python-telegram-bot Application (offline: getMe is answered
+locally, nothing is sent to Telegram) with ChatOrderedUpdateProcessor and
+feeds it updates through its update queue, like polling would:
+
+    - updates of one chat run in arrival order and never overlap
+    - different chats run side by side, up to the limit
+    - a chat flooding taps behind a slow handler does not stall other chats
+    - ConversationHandler flows (like /addstock) end in the right state
+      when many users step through them at the same time
+
+    python test_update_processor.py
+"""
+
+import asyncio
+import json
+import time
+
+from telegram import Update
+from telegram.ext import (ApplicationBuilder, ConversationHandler, MessageHandler, SimpleUpdateProcessor,
+                          TypeHandler, filters)
+from telegram.request import BaseRequest
+
+from update_processor import ChatOrderedUpdateProcessor
+
+LIMIT = 8
+
+
+class OfflineRequest(BaseRequest):
+    """Answers the Bot API locally so the Application can start without a network"""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        result = {"id": 1, "is_bot": True, "first_name": "Test", "username": "test_bot"} if url.endswith("getMe") else True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_update(update_id, chat_id, text, bot):
+    return Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}}}, bot)
+
+
+async def run(processor, handlers, updates):
+    """Feed (chat_id, text) pairs through an Application; returns seconds taken"""
+    app = ApplicationBuilder().token("1:offline").request(OfflineRequest()) \
+        .get_updates_request(OfflineRequest()).concurrent_updates(processor).build()
+    for handler in handlers:
+        app.add_handler(handler)
+    async with app:
+        await app.start()
+        start = time.perf_counter()
+        for i, (chat_id, text) in enumerate(updates, 1):
+            await app.update_queue.put(make_update(i, chat_id, text, app.bot))
+        await app.update_queue.join()
+        elapsed = time.perf_counter() - start
+        await app.stop()
+    return elapsed
+
+
+def check(ok, text):
+    print(f"{'✅' if ok else '❌'} {text}")
+    return ok
+
+
+async def test_order_and_limit():
+    events = []
+    state = {"running": 0, "peak": 0}
+
+    async def handler(update, context):
+        chat, seq = update.effective_chat.id, int(update.message.text)
+        state["running"] += 1
+        state["peak"] = max(state["peak"], state["running"])
+        events.append(("start", chat, seq))
+        await asyncio.sleep(0.002 * (seq % 5))
+        events.append(("end", chat, seq))
+        state["running"] -= 1
+
+    updates = [(chat, str(seq)) for seq in range(20) for chat in range(1, 11)]
+    processor = ChatOrderedUpdateProcessor(LIMIT)
+    await run(processor, [MessageHandler(filters.TEXT, handler)], updates)
+
+    ok = True
+    for chat in range(1, 11):
+        mine = [(kind, seq) for kind, c, seq in events if c == chat]
+        expected = [(kind, seq) for seq in range(20) for kind in ("start", "end")]
+        ok &= mine == expected
+    passed = check(ok, "each chat's 20 updates ran in order, one at a time")
+    passed &= check(1 < state["peak"] <= LIMIT, f"chats ran side by side, at most {LIMIT} at once (peak {state['peak']})")
+    passed &= check(processor.active_chats == 0, "no per-chat locks left behind")
+    return passed
+
+
+async def test_flood_does_not_stall():
+    finished = {}
+
+    async def handler(update, context):
+        await asyncio.sleep(0.05)
+        finished.setdefault(update.effective_chat.id, time.perf_counter())
+
+    # Chat 1 taps 100 times (5s of work); chats 2..6 send one update each after it
+    updates = [(1, "tap")] * 100 + [(chat, "hi") for chat in range(2, 7)]
+    start = time.perf_counter()
+    processor = ChatOrderedUpdateProcessor(LIMIT)
+    await run(processor, [MessageHandler(filters.TEXT, handler)], updates)
+    slowest = max(finished[chat] for chat in range(2, 7)) - start
+    passed = check(slowest < 0.5, f"other chats answered in {slowest * 1000:.0f}ms while one chat flooded 100 taps")
+    passed &= check(processor.waited >= 99, f"the flood waited its turn ({processor.waited} updates queued behind their chat)")
+    return passed
+
+
+def conversation(results):
+    """A 3-step flow shaped like /addstock: pick product -> pick variant -> send stock"""
+    PRODUCT, VARIANT = range(2)
+
+    async def begin(update, context):
+        await asyncio.sleep(0.01)
+        return PRODUCT
+
+    async def product(update, context):
+        context.user_data["product"] = update.message.text
+        await asyncio.sleep(0.01)
+        return VARIANT
+
+    async def variant(update, context):
+        await asyncio.sleep(0.01)
+        results[update.effective_chat.id] = (context.user_data["product"], update.message.text)
+        return ConversationHandler.END
+
+    return ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex("^addstock$"), begin)],
+        states={PRODUCT: [MessageHandler(filters.TEXT, product)], VARIANT: [MessageHandler(filters.TEXT, variant)]},
+        fallbacks=[],
+    )
+
+
+async def test_conversations():
+    chats = range(1, 31)
+    expected = {chat: ("product", "variant") for chat in chats}
+    passed = True
+    # Steps of different users interleaved, then each user's steps back to back
+    for name, updates in (
+            ("interleaved", [(chat, text) for text in ("addstock", "product", "variant") for chat in chats]),
+            ("back to back", [(chat, text) for chat in chats for text in ("addstock", "product", "variant")])):
+        results = {}
+        await run(ChatOrderedUpdateProcessor(LIMIT), [conversation(results)], updates)
+        passed &= check(results == expected, f"{len(results)}/{len(expected)} concurrent conversations finished correctly ({name})")
+
+    # For comparison: plain concurrency without per-chat ordering
+    results = {}
+    await run(SimpleUpdateProcessor(LIMIT), [conversation(results)], updates)
+    print(f"   (without per-chat ordering: {len(results)}/{len(expected)} finished)")
+    return passed
+
+
+async def test_throughput():
+    async def handler(update, context):
+        await asyncio.sleep(0.02)  # e.g. waiting on a QR render or the proxy
+
+    updates = [(chat, "hi") for chat in range(1, 201)]
+    sequential = await run(SimpleUpdateProcessor(1), [TypeHandler(Update, handler)], updates[:50]) * 4
+    concurrent = await run(ChatOrderedUpdateProcessor(LIMIT), [TypeHandler(Update, handler)], updates)
+    print(f"   200 updates with 20ms handlers: ~{sequential:.1f}s one at a time, {concurrent:.2f}s with limit {LIMIT}")
+    return check(concurrent < sequential / 2, f"{sequential / concurrent:.1f}x faster")
+
+
+async def main():
+    print("=" * 60)
+    print("UPDATE PROCESSOR TEST")
+    print("=" * 60)
+    passed = await test_order_and_limit()
+    passed &= await test_flood_does_not_stall()
+    passed &= await test_conversations()
+    passed &= await test_throughput()
+    print(f"\n{'✅ All checks passed' if passed else '❌ Some checks failed'}")
+    return passed
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if asyncio.run(main()) else 1)
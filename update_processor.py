@@ -0,0 +1,77 @@
+"""
+Update Processor - concurrent update handling, in order within each chat
+python-telegram-bot handles updates one at a time by default, so one slow
+handler (a QR render, /datastock, /backup) holds up every other user.
+ChatOrderedUpdateProcessor runs updates from different chats at the same
+time but keeps each chat's updates strictly in arrival order, one after
+another, so button taps apply in the order they were made and
+ConversationHandler flows see their updates one by one, as they expect.
+"""
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def chat_key(update):
+    """What an update is serialized on: its chat, else its user, else nothing"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        # e.g. a button on an inline message: no chat, but one user
+        return ("user", update.effective_user.id)
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Up to max_concurrent_updates handlers at once, one at a time per chat
+
+    A chat's later updates wait for its lock *before* taking one of the
+    max_concurrent_updates slots, so a user tapping repeatedly behind a slow
+    handler cannot fill every slot and stall the other chats. The library's
+    own semaphore (max_pending) only bounds how many updates may be waiting
+    or running in total.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending=None):
+        super().__init__(max_pending or max_concurrent_updates * 16)
+        self.max_running = max_concurrent_updates
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # chat key -> [lock, updates holding or waiting for it]
+        self._chats = {}
+        self.waited = 0  # updates that had to wait for an earlier one from their chat
+
+    @property
+    def active_chats(self):
+        return len(self._chats)
+
+    async def do_process_update(self, update, coroutine):
+        key = chat_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self.waited += 1
+            # asyncio.Lock wakes waiters first come, first served: arrival order
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+
+    async def initialize(self):
+        logging.info(f"[UPDATES] Processing up to {self.max_running} updates at once, in order per chat")
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,339 @@
+"""
+User Registry - in-memory users.json with write-behind flushing
+Lookups are served from memory; changes are appended to a journal right away
+and the full users.json is rewritten (atomically) in batches on a timer.
+
+An attribute index (spent, joined, last active, username, products bought)
+is kept next to the records, so broadcast segments resolve without walking
+every user.
+"""
+import os
+import json
+import bisect
+import logging
+import threading
+from datetime import datetime, timedelta
+
+
+def _timestamp(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class SortedIndex:
+    """uids ordered by a numeric key; range lookups by bisect"""
+
+    def __init__(self):
+        self._items = []
+        self._key_of = {}
+
+    def load(self, keys):
+        """Replace the contents from {uid: key} with one sort (set() per uid would be O(N^2))"""
+        self._key_of = {uid: key for uid, key in keys.items() if key is not None}
+        self._items = sorted((key, uid) for uid, key in self._key_of.items())
+
+    def set(self, uid, key):
+        old = self._key_of.get(uid)
+        if old == key:
+            return
+        if old is not None:
+            del self._items[bisect.bisect_left(self._items, (old, uid))]
+            del self._key_of[uid]
+        if key is not None:
+            bisect.insort(self._items, (key, uid))
+            self._key_of[uid] = key
+
+    def at_least(self, key):
+        return {uid for _, uid in self._items[bisect.bisect_left(self._items, (key,)):]}
+
+    def above(self, key):
+        return {uid for _, uid in self._items[bisect.bisect_right(self._items, (key, "\uffff")):]}
+
+
+class UserRegistry:
+    """Process-wide user store backed by users.json + an append-only journal"""
+
+    def __init__(self, path, flush_interval=5.0):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        # Journal being folded into users.json by an in-progress flush
+        self.flushing_path = f"{path}.journal.flushing"
+        self.flush_interval = flush_interval
+        self._users = {}
+        self._dirty = set()
+        # Attribute index, updated by _record
+        self._spent = SortedIndex()
+        self._active = SortedIndex()
+        self._joined = SortedIndex()
+        self._buyers = {}  # product id -> set of uids
+        self._usernames = {}  # lowercase username -> set of uids
+        self._inactive = set()
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._journal = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ---------- loading ----------
+
+    def load(self):
+        """Read users.json once and replay any journal left by a crash"""
+        with self._lock:
+            users = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r') as f:
+                        users = json.load(f)
+                except Exception as e:
+                    logging.error(f"[USERS] Could not read {self.path}: {e}")
+            self._users = users
+
+            replayed = 0
+            for journal in (self.flushing_path, self.journal_path):
+                replayed += self._replay(journal)
+
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            keys = {uid: self._sort_keys(data) for uid, data in self._users.items()}
+            for i, index in enumerate((self._spent, self._active, self._joined)):
+                index.load({uid: k[i] for uid, k in keys.items()})
+            for uid, data in self._users.items():
+                for pid in data.get('purchases', ()):
+                    self._buyers.setdefault(pid, set()).add(uid)
+                name = self._username_key(data)
+                if name:
+                    self._usernames.setdefault(name, set()).add(uid)
+                if data.get('inactive'):
+                    self._inactive.add(uid)
+            logging.info(f"[USERS] Loaded {len(self._users)} users ({replayed} journal entries replayed)")
+
+        if replayed:
+            self.flush()
+
+    def _replay(self, journal):
+        if not os.path.exists(journal):
+            return 0
+        count = 0
+        with open(journal, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn last line from a crash mid-append
+                    continue
+                self._users[entry["uid"]] = entry["data"]
+                self._dirty.add(entry["uid"])
+                count += 1
+        return count
+
+    # ---------- background flushing ----------
+
+    def start(self):
+        """Start the timer thread that flushes dirty users"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name="user-registry-flush", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"[USERS] Background flush failed: {e}")
+
+    def close(self):
+        """Stop the timer and write out everything that is still dirty"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.flush_interval + 5)
+            self._thread = None
+        self.flush()
+        with self._lock:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+
+    def flush(self):
+        """Atomically rewrite users.json if anything changed since the last flush"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                dirty = len(self._dirty)
+                # Records are replaced on every change, never mutated in place,
+                # so a shallow copy is a consistent snapshot.
+                snapshot = dict(self._users)
+                self._dirty.clear()
+                # Rotate the journal: entries from here on belong to the next flush
+                if self._journal:
+                    self._journal.close()
+                    if os.path.exists(self.flushing_path):
+                        # A previous flush failed; keep its entries as well
+                        with open(self.journal_path, 'r', encoding='utf-8') as src, \
+                                open(self.flushing_path, 'a', encoding='utf-8') as dst:
+                            dst.write(src.read())
+                        os.remove(self.journal_path)
+                    else:
+                        os.replace(self.journal_path, self.flushing_path)
+                    self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(snapshot, f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except Exception:
+                with self._lock:
+                    self._dirty.update(snapshot.keys())
+                raise
+            if os.path.exists(self.flushing_path):
+                os.remove(self.flushing_path)
+            logging.info(f"[USERS] Flushed {dirty} changed users ({len(snapshot)} total)")
+            return dirty
+
+    @staticmethod
+    def _sort_keys(data):
+        """(spent, last active, joined) keys of a record"""
+        joined = _timestamp(data.get('joined'))
+        return float(data.get('spent', 0.0)), _timestamp(data.get('last_active')) or joined, joined
+
+    def _index(self, uid, old, new):
+        spent, active, joined = self._sort_keys(new)
+        self._spent.set(uid, spent)
+        self._active.set(uid, active)
+        self._joined.set(uid, joined)
+        self._index_sets(uid, old, new)
+
+    @staticmethod
+    def _username_key(data):
+        name = (data.get('username') or '').lstrip('@').lower()
+        # Placeholder given to users without a username
+        return '' if name == 'unknown' else name
+
+    def _index_sets(self, uid, old, new):
+        old = old or {}
+        for pid in set(new.get('purchases', [])) - set(old.get('purchases', [])):
+            self._buyers.setdefault(pid, set()).add(uid)
+        name, old_name = self._username_key(new), self._username_key(old)
+        if old_name != name:
+            holders = self._usernames.get(old_name)
+            if holders is not None:
+                holders.discard(uid)
+                if not holders:
+                    del self._usernames[old_name]
+        if name:
+            self._usernames.setdefault(name, set()).add(uid)
+        if new.get('inactive'):
+            self._inactive.add(uid)
+        else:
+            self._inactive.discard(uid)
+
+    def _record(self, uid, data):
+        """Store a new version of a user record and journal it"""
+        self._index(uid, self._users.get(uid), data)
+        self._users[uid] = data
+        self._dirty.add(uid)
+        if self._journal:
+            self._journal.write(json.dumps({"uid": uid, "data": data}) + "\n")
+            self._journal.flush()
+
+    # ---------- lookups / updates ----------
+
+    def touch(self, user_id, username=None):
+        """Get a user, registering them or refreshing their username if needed"""
+        uid = str(user_id)
+        now = str(datetime.now())
+        with self._lock:
+            user = self._users.get(uid)
+            if user is None:
+                user = {"username": username or "Unknown", "spent": 0.0, "joined": now, "last_active": now}
+                self._record(uid, user)
+                logging.info(f"[USER REGISTERED] New user: {uid} (@{username})")
+            elif user.get('inactive') or (username and user.get('username') != username):
+                # Writing to the bot again also undoes an earlier "blocked" mark
+                user = dict(user, username=username or user.get('username'), last_active=now)
+                user.pop('inactive', None)
+                self._record(uid, user)
+                logging.info(f"[USER UPDATED] Refreshed {uid}: @{user['username']}")
+            elif user.get('last_active', '')[:10] != now[:10]:
+                # Day resolution is enough for "active in the last N days"
+                user = dict(user, last_active=now)
+                self._record(uid, user)
+            return dict(user)
+
+    def add_spent(self, user_id, amount, username, pid=None):
+        uid = str(user_id)
+        with self._lock:
+            user = dict(self._users.get(uid) or {"spent": 0.0, "joined": str(datetime.now())})
+            user["spent"] = user.get("spent", 0.0) + amount
+            user["username"] = username
+            user["last_active"] = str(datetime.now())
+            if pid is not None and str(pid) not in user.get("purchases", []):
+                user["purchases"] = user.get("purchases", []) + [str(pid)]
+            self._record(uid, user)
+
+    def set_inactive(self, user_ids):
+        """Mark users who blocked the bot / deleted their account"""
+        now = str(datetime.now())
+        marked = 0
+        with self._lock:
+            for user_id in user_ids:
+                uid = str(user_id)
+                user = self._users.get(uid)
+                if user is not None and not user.get('inactive'):
+                    self._record(uid, dict(user, inactive=now))
+                    marked += 1
+        logging.info(f"[USERS] Marked {marked} users inactive")
+        return marked
+
+    def segment(self, bought=None, min_spent=None, active_days=None, never_bought=False,
+                joined_days=None, usernames=None):
+        """uids of active users matching every given filter
+
+        bought: product id; min_spent: spent more than this; active_days:
+        seen in the last N days; never_bought: no purchase yet; joined_days:
+        joined in the last N days; usernames: any of these (@ optional).
+        """
+        with self._lock:
+            uids = set(self._users) - self._inactive
+            if bought is not None:
+                uids &= self._buyers.get(str(bought), set())
+            if min_spent is not None:
+                uids &= self._spent.above(min_spent)
+            if active_days is not None:
+                since = (datetime.now() - timedelta(days=active_days)).timestamp()
+                uids &= self._active.at_least(since)
+            if joined_days is not None:
+                since = (datetime.now() - timedelta(days=joined_days)).timestamp()
+                uids &= self._joined.at_least(since)
+            if usernames is not None:
+                named = set()
+                for name in usernames:
+                    named |= self._usernames.get(self._username_key({"username": name}), set())
+                uids &= named
+            if never_bought:
+                # Older records have spent but no purchases list
+                uids -= self._spent.above(0.0)
+            return uids
+
+    def get(self, user_id):
+        user = self._users.get(str(user_id))
+        return dict(user) if user is not None else None
+
+    def ids(self, active_only=False):
+        with self._lock:
+            if active_only:
+                return [uid for uid in self._users if uid not in self._inactive]
+            return list(self._users.keys())
+
+    def snapshot(self):
+        """Copy of all users ({uid: data}) for admin views"""
+        with self._lock:
+            return {uid: dict(data) for uid, data in self._users.items()}
+
+    def __len__(self):
+        return len(self._users)
@@ -0,0 +1,253 @@
+"""
+Webhook Server - receive Telegram updates over HTTP instead of polling
+A small HTTP/1.1 server on asyncio.start_server, no extra dependencies.
+Telegram POSTs each update to the webhook path on keep-alive connections;
+the body is checked against the secret token, decoded and put straight on
+the Application's update queue, and answered with 200 right away, so a
+slow handler never holds up Telegram's delivery.
+
+    POST <path>   an update (X-Telegram-Bot-Api-Secret-Token must match)
+    GET  /health  JSON counters for monitoring / load balancers
+
+run_webhook() runs an Application with the server the way run_polling()
+would: initialize, post_init, start, listen, setWebhook, and the reverse
+on SIGINT/SIGTERM. post_stop runs while the bot can still send (before
+shutdown closes its HTTP client); post_shutdown only after.
+"""
+import hmac
+import json
+import time
+import signal
+import asyncio
+import logging
+from collections import deque
+from http import HTTPStatus
+
+from telegram import Update
+
+
+class WebhookServer:
+    """Feeds POSTed updates into application.update_queue"""
+
+    # Telegram redelivers an update it got no 200 for; recently seen ids are skipped
+    RECENT_UPDATES = 2000
+    # Header lines per request (each one is capped by the stream's 64 KiB line limit)
+    MAX_HEADERS = 64
+
+    def __init__(self, application, path, secret_token=None, host="0.0.0.0", port=8443,
+                 max_body=256 * 1024, idle_timeout=75.0, read_timeout=10.0, record_path=None):
+        self.application = application
+        self.path = path if path.startswith("/") else f"/{path}"
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        # Updates are a few KB; anything far bigger is not from Telegram
+        self.max_body = max_body
+        # Between requests on a keep-alive connection
+        self.idle_timeout = idle_timeout
+        # For the rest of a request once its first line arrived, so a client
+        # that stalls mid-request cannot hold a connection open
+        self.read_timeout = read_timeout
+        # Append every accepted body here (JSONL) to replay with benchmark_webhook.py
+        self.record_path = record_path
+        self._record = None
+        self._server = None
+        self._connections = set()
+        self._recent = deque()
+        self._recent_ids = set()
+        self.started_at = None
+        self.stats = {"received": 0, "duplicates": 0, "rejected": 0, "bad_requests": 0}
+
+    async def start(self):
+        if self.record_path:
+            self._record = open(self.record_path, 'a', encoding='utf-8')
+        self._server = await asyncio.start_server(self._serve_client, self.host, self.port)
+        # port=0 picks a free port; report the real one
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.started_at = time.monotonic()
+        logging.info(f"[WEBHOOK] Listening on {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._record:
+            self._record.close()
+            self._record = None
+
+    def health(self):
+        queue = self.application.update_queue
+        return dict(self.stats, ok=self.application.running, pending=queue.qsize(),
+                    uptime=round(time.monotonic() - self.started_at, 1) if self.started_at else 0)
+
+    async def _serve_client(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readuntil(b"\r\n"), self.idle_timeout)
+                except asyncio.LimitOverrunError:
+                    await self._respond(writer, 431, keep_alive=False)
+                    return
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                try:
+                    header_lines = await asyncio.wait_for(self._read_headers(reader), self.read_timeout)
+                except (asyncio.LimitOverrunError, ValueError):
+                    await self._respond(writer, 431, keep_alive=False)
+                    return
+                except asyncio.TimeoutError:
+                    await self._respond(writer, 408, keep_alive=False)
+                    return
+                request_line = request_line[:-2].decode("latin-1")
+                headers = {}
+                for line in header_lines:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = request_line.split(" ")
+                    length = int(headers.get("content-length", "0"))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    await self._respond(writer, 400, keep_alive=False)
+                    return
+                if "transfer-encoding" in headers:
+                    # Telegram always sends Content-Length
+                    await self._respond(writer, 411, keep_alive=False)
+                    return
+                if length > self.max_body:
+                    await self._respond(writer, 413, keep_alive=False)
+                    return
+                try:
+                    body = await asyncio.wait_for(reader.readexactly(length), self.read_timeout) if length else b""
+                except asyncio.TimeoutError:
+                    await self._respond(writer, 408, keep_alive=False)
+                    return
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                status, payload = await self._route(method, target.split("?", 1)[0], headers, body, writer)
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    return
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.error(f"[WEBHOOK] Connection failed: {e}")
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _read_headers(self, reader):
+        """Header lines up to the blank line; ValueError past MAX_HEADERS"""
+        lines = []
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                return lines
+            if len(lines) == self.MAX_HEADERS:
+                raise ValueError("too many header lines")
+            lines.append(line[:-2].decode("latin-1"))
+
+    async def _route(self, method, path, headers, body, writer):
+        if path == "/health":
+            if method != "GET":
+                return 405, None
+            return 200, self.health()
+        if path != self.path:
+            return 404, None
+        if method != "POST":
+            return 405, None
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if self.secret_token and not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            self.stats["rejected"] += 1
+            logging.warning(f"[WEBHOOK] Rejected a POST with a wrong secret token from {writer.get_extra_info('peername')}")
+            return 403, None
+        try:
+            data = json.loads(body)
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            self.stats["bad_requests"] += 1
+            logging.warning(f"[WEBHOOK] Could not decode update: {e}")
+            return 400, None
+        if update is None:
+            self.stats["bad_requests"] += 1
+            return 400, None
+        if self._seen(update.update_id):
+            self.stats["duplicates"] += 1
+            return 200, None
+        self.stats["received"] += 1
+        if self._record:
+            self._record.write(body.decode("utf-8") + "\n")
+        await self.application.update_queue.put(update)
+        return 200, None
+
+    def _seen(self, update_id):
+        if update_id in self._recent_ids:
+            return True
+        self._recent_ids.add(update_id)
+        self._recent.append(update_id)
+        if len(self._recent) > self.RECENT_UPDATES:
+            self._recent_ids.discard(self._recent.popleft())
+        return False
+
+    async def _respond(self, writer, status, payload=None, keep_alive=True):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+        # A client that stops reading is dropped too
+        await asyncio.wait_for(writer.drain(), self.read_timeout)
+
+
+async def serve_webhook(application, server, webhook_url, max_connections=40, stop_event=None):
+    """Run application fed by server until SIGINT/SIGTERM (or stop_event is set)"""
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: Ctrl+C still cancels asyncio.run()
+            pass
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        try:
+            await server.start()
+            try:
+                # Updates that queued up while the bot was down are delivered, not dropped
+                await application.bot.set_webhook(url=webhook_url, secret_token=server.secret_token,
+                                                  max_connections=max_connections, allowed_updates=Update.ALL_TYPES)
+                logging.info(f"[WEBHOOK] Webhook set to {webhook_url}")
+                await stop_event.wait()
+            finally:
+                # Stop taking updates first; Telegram keeps the rest until we are back
+                await server.stop()
+        finally:
+            try:
+                # Handles whatever is still queued before returning
+                await application.stop()
+            finally:
+                # Still before shutdown(): post_stop can use the bot (finish deliveries)
+                if application.post_stop:
+                    await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application, server, webhook_url, max_connections=40):
+    """Blocking, like application.run_polling()"""
+    try:
+        asyncio.run(serve_webhook(application, server, webhook_url, max_connections))
+    except KeyboardInterrupt:
+        pass